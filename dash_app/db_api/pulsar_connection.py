@@ -8,6 +8,7 @@ from collections import defaultdict
 
 import pulsar
 import pandas
+from pipeline_utils.metrics import parse_stage_summary
 
 
 BROKER = os.environ.get("PULSAR_BROKER", 'pulsar://10.0.0.16:6650')
@@ -53,6 +54,9 @@ class LatencyTracker(object):
         self.real_time = 0
         self.peak_throughput=None
         self.average_latency=None
+        # Latest stage latency summary {stage: (count, p50, p90, p99)} of each function
+        self.stage_latency = {}
+        self.stage_time = {}
 
     def update(self, timeout=20, memory=5):
         # First check if it is time to refresh yet. 
@@ -72,6 +76,11 @@ class LatencyTracker(object):
             data = message.value()
             if isinstance(data, bytes):
                 data = data.decode()
+            if data.startswith('STAGES|'):
+                name, t, summary = parse_stage_summary(data)
+                self.stage_latency[name] = summary
+                self.stage_time[name] = t
+                continue
             self.real_time = message.event_timestamp() * 1e-3
             name, counter, event_time, t = data.split(':')
             counter = int(counter)
@@ -116,6 +125,20 @@ class LatencyTracker(object):
         if l: 
             self.average_latency = sum(self.latency['all'][-10:]) / l 
 
+    def stage_breakdown(self, memory=30):
+        """Median latency of each processing stage in ms, averaged over the functions
+        that reported within the last `memory` seconds"""
+        cutoff = time.time() - memory
+        totals = defaultdict(float)
+        counts = defaultdict(int)
+        for name, summary in self.stage_latency.items():
+            if self.stage_time[name] < cutoff:
+                continue
+            for stage, (count, p50, p90, p99) in summary.items():
+                totals[stage] += p50 * 1e3
+                counts[stage] += 1
+        return {stage: totals[stage] / counts[stage] for stage in totals}
+
 
 class SourceController(object):
     """Controller for a S3 source connector. This is done by publishing commands to
@@ -162,13 +185,14 @@ class SourceController(object):
             self.producer.send("STAT:RESUME")
 
     def set_max_rate(self, rate=100):
-        """Change the maximum publication rate in message per second"""
-        if not isinstance(rate, int):
-            raise TypeError('rate must be an integer')
-        if rate <= 0:
+        """Change the maximum publication rate in message per second.  It may be
+        fractional, e.g. 0.5 for one message every two seconds."""
+        if isinstance(rate, bool) or not isinstance(rate, (int, float)):
+            raise TypeError('rate must be a number')
+        if not 0 < rate < float('inf'):
             raise ValueError('rate must be positive')
         if self.connected:
-            self.producer.send("RATE:"+str(rate))
+            self.producer.send("RATE:"+repr(rate))
 
     def set_partition(self, partition=0):
         """Change the number of partitions"""
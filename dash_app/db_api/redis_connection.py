@@ -5,10 +5,10 @@ from ast import literal_eval
 from random import sample
 import math
 import time
-from datetime import datetime
 
 import pandas as pd
 import redis
+from pipeline_utils.timestamps import parse_timestamp
 
 
 logger = logging.getLogger(__name__)
@@ -78,7 +78,7 @@ class RedisConnector(object):
             if max_count < 2: 
                 continue
             ratio = float(ratio)
-            stamp = datetime.strptime(stamp , '%Y-%m-%d %H:%M:%S').timestamp()
+            stamp = parse_timestamp(stamp)
             if abs(self.timestamp - stamp) < 60:
                 self.timestamp = max(self.timestamp, stamp)
             else:
@@ -0,0 +1,8 @@
+"""Pulsar function running several functions of the pipeline in a single pass,
+e.g. window count, window ratio and the Redis sink"""
+from pipeline_utils.chain import ChainFunction
+
+
+class Chain(ChainFunction):
+    """The chained functions are listed in the `chain` user config"""
+    pass
@@ -1,7 +1,8 @@
 from pulsar import Function
 from pulsar.schema import AvroSchema
 
-from pipeline_utils import get_record
+from pipeline_utils import model_class_factory
+from pipeline_utils.partitioner import partition
 
 
 class HashStream(Function):
@@ -14,7 +15,7 @@ class HashStream(Function):
         shift = config['shift']
         format_str = config['topic_format']
         key = getattr(record, key_by)
-        index = hash(key) % partitions
+        index = partition(key, partitions)
         out_topic = format_str.format(index + shift)
         context.publish(out_topic, input)
         return
@@ -1,19 +1,18 @@
 """Count the number of events in a time window"""
-from collections import defaultdict, deque
-from datetime import datetime, timedelta
-
 from pipeline_utils import SchemaFunction
+from pipeline_utils.timestamps import parse_timestamp
+from pipeline_utils.window_state import make_window_state
 
 
 class WindowCount(SchemaFunction):
     """a sorted list for each key is stored on redis"""
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.state = defaultdict(deque)
+        self.state = None
 
     def kernel(self, record, context, key_by,
                date_field='date', date_format='%Y-%m-%d %H:%M:%S',
-               window=1000, output_field='count'):
+               window=1000, output_field='count', state_backend='deque', bucket_size=60):
         """Count the number of instances inside of a time window from
         the current event
 
@@ -27,6 +26,11 @@ class WindowCount(SchemaFunction):
                       numericl timestamp
             window:   Window length in seconds
             output_field:  Which field the output will be saved to
+            state_backend: How the timestamps are stored. `deque` for a deque of
+                      floats per key, `ring` for a ring buffer of doubles per key,
+                      `bucket` for approximate counts in time buckets per key.
+            bucket_size:  Length of the time buckets in seconds, for the `bucket`
+                      state backend
 
         Returns:
             The event count in the specified window will be returned in the key
@@ -38,15 +42,36 @@ class WindowCount(SchemaFunction):
         if date_format is None:
             stamp_last = record[date_field]
         else:
-            t_last = datetime.strptime(record[date_field], date_format)
-            stamp_last = t_last.timestamp()
-        stamp_start = stamp_last - window 
-        # Update the list of timestamps falling inside of the window
-        state = self.state[key]
-        state.appendleft(stamp_last)
-        while state:
-            tail = state.pop()
-            if tail > stamp_start and tail <= stamp_last:
-                state.append(tail)
-                break
-        return {output_field: len(state)}
+            stamp_last = parse_timestamp(record[date_field], date_format)
+        state = self.get_state(state_backend, bucket_size)
+        return {output_field: state.update(key, stamp_last, window)}
+
+    def kernel_batch(self, records, context, key_by,
+                     date_field='date', date_format='%Y-%m-%d %H:%M:%S',
+                     window=1000, output_field='count', state_backend='deque',
+                     bucket_size=60):
+        """Count events in the window for a batch of records.  Same arguments as
+        `kernel` but with a list of records, returning a list of outputs"""
+        update = self.get_state(state_backend, bucket_size).update
+        results = []
+        for record in records:
+            if date_format is None:
+                stamp_last = record[date_field]
+            else:
+                stamp_last = parse_timestamp(record[date_field], date_format)
+            results.append({output_field: update(record[key_by], stamp_last, window)})
+        self.counter += len(records)
+        return results
+
+    def init_state(self, state_backend='deque', bucket_size=60, **config):
+        """Create the state before restoring a snapshot"""
+        self.get_state(state_backend, bucket_size)
+
+    def get_state(self, backend, bucket_size):
+        """The per-key timestamp store, created on first use"""
+        if self.state is None:
+            if backend == 'bucket':
+                self.state = make_window_state(backend, bucket_size=bucket_size)
+            else:
+                self.state = make_window_state(backend)
+        return self.state
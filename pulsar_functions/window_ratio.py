@@ -2,10 +2,10 @@
 And use this to calculate the ratio between the current value and the max.
 """
 import time
-from collections import defaultdict, deque
-from datetime import datetime, timedelta
 
 from pipeline_utils import SchemaFunction
+from pipeline_utils.timestamps import parse_timestamp
+from pipeline_utils.window_state import MaxWindowState
 
 
 
@@ -13,55 +13,76 @@ class WindowRatio(SchemaFunction):
     """a sorted list for each key is stored on redis"""
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.state = defaultdict(deque)
+        self.state = MaxWindowState()
 
     def kernel(self, data, context, key_by,
                value_field='value', output_field='crowd_ratio', max_output='max_count',
                date_field='date', date_format='%Y-%m-%d %H:%M:%S', window=1000,
                metric_period=0, metric_topic='metric:window_ratio', timestamp=None):
         """Process the customer count and compute its maximum over a window
-        then output the ratio between the current count and max"""
+        then output the ratio between the current count and max
+
+        `window` can also be a list of windows, with `output_field` and `max_output`
+        lists of the same length.  The ratio and the max for each window are then
+        computed from a single state per key and written to the matching fields."""
         # Retrieve the `key` and `value` of the current input
         key = data[key_by] 
         value = data[value_field] 
 
         # Retrieve and parse the date field to compute time windows
         if date_format:
-            t_last = datetime.strptime(data[date_field], date_format)
-            stamp_last = t_last.timestamp()
+            stamp_last = parse_timestamp(data[date_field], date_format)
         else:
             stamp_last = data[date_field]
-        t_start = t_last - timedelta(seconds=window)
-        stamp_start = t_start.timestamp()
-
-        # The state contains a deque of uniformly decreasing max values, with the most recent
-        # value at the end.  First, pop all elements smaller than the current value
-        state = self.state[key]
-        while state:
-            t_head, value_head = state[0]
-            if value_head > value:
-                break
-            state.popleft()
-        # Push the current value to the top of the stack
-        state.appendleft((stamp_last, value))
-        # Retire elements at the bottom that are no longer within the time window.  This is
-        # actually not strictly necessary for the algorithm to work but does reduce the reading
-        # cost and decreases the memory foot print.
-        value_tail = value
-        while state:
-            t_tail, value_tail = state.pop()
-            if t_tail > stamp_start and t_tail <= stamp_last:
-                state.append((t_tail, value_tail))
-                break
+        result = self.ratios(key, value, stamp_last, window, output_field, max_output)
 
         # Record metrics for the function.  Default is to never record it.
         if metric_period and timestamp and self.counter % metric_period == 0:
-                t = time.time() 
-                event_time = data[timestamp] 
-                message = '{}:{}:{}:{}'.format(self.name, self.counter, event_time, t)
-                context.publish(metric_topic, message, 
-                                message_conf={'event_timestamp': int(stamp_last * 1000)})
-        result = {output_field: value/value_tail}
-        if max_output:
-            result[max_output] = value_tail
+            self.publish_metric(context, self.counter, data[timestamp], stamp_last,
+                                metric_topic)
         return result 
+
+    def kernel_batch(self, records, context, key_by,
+                     value_field='value', output_field='crowd_ratio', max_output='max_count',
+                     date_field='date', date_format='%Y-%m-%d %H:%M:%S', window=1000,
+                     metric_period=0, metric_topic='metric:window_ratio', timestamp=None):
+        """Compute the ratios for a batch of records.  Same arguments as `kernel`
+        but with a list of records, returning a list of outputs"""
+        ratios = self.ratios
+        counter = self.counter
+        results = []
+        for data in records:
+            value = data[value_field]
+            if date_format:
+                stamp_last = parse_timestamp(data[date_field], date_format)
+            else:
+                stamp_last = data[date_field]
+            results.append(ratios(data[key_by], value, stamp_last, window, output_field,
+                                  max_output))
+            if metric_period and timestamp and counter % metric_period == 0:
+                self.publish_metric(context, counter, data[timestamp], stamp_last,
+                                    metric_topic)
+            counter += 1
+        self.counter = counter
+        return results
+
+    def ratios(self, key, value, stamp_last, window, output_field, max_output):
+        """Update the state and returns the ratios and maxima as output fields"""
+        if not isinstance(window, (list, tuple)):
+            value_tail = self.state.update(key, value, stamp_last, window)
+            result = {output_field: value/value_tail}
+            if max_output:
+                result[max_output] = value_tail
+            return result
+        maxima = self.state.update_horizons(key, value, stamp_last, window)
+        result = {field: value/value_tail for field, value_tail in zip(output_field, maxima)}
+        if max_output:
+            result.update(zip(max_output, maxima))
+        return result
+
+    def publish_metric(self, context, counter, event_time, stamp_last, metric_topic):
+        """Publish the processing time of the current event to the metric topic"""
+        t = time.time() 
+        message = '{}:{}:{}:{}'.format(self.name, counter, event_time, t)
+        context.publish(metric_topic, message, 
+                        message_conf={'event_timestamp': int(stamp_last * 1000)})
@@ -0,0 +1,256 @@
+"""asyncio variants of the standalone window engines.
+
+Receiving, processing and publishing run as separate tasks, so the next batch
+is received while the current one is processed, and outputs are published
+asynchronously.  `add_func`, `remove_func`, `reduce_func`, `init_func`,
+`batch_func` and `output_func` may be coroutine functions, e.g. to keep the
+state in Redis through `redis.asyncio`, or plain functions as in the blocking
+engines.  Backpressure comes from two bounds: at most `max_batches` received
+batches wait to be processed, and at most `max_in_flight` outputs are waiting for
+the broker to confirm them.
+
+The settings are the same as the blocking engines, so the same YAML inputs run
+on either.  The events leaving a time window are always found with an eviction
+buffer.
+"""
+import asyncio
+import inspect
+import logging
+import time
+
+import pulsar
+
+from .callback import CallbackHandler
+from .coalesce import OutputCoalescer
+from .consume import subscribe_batches
+from .eviction import EvictionBuffer
+from .schema_model import model_class_factory
+from .time_window import output_record
+from .timestamps import parse_timestamp
+
+
+logger = logging.getLogger(__name__)
+
+ALL_FIELDS = '___all-fields___'
+
+
+async def _call(func, *args):
+    """Call a plain or coroutine function"""
+    result = func(*args)
+    if inspect.isawaitable(result):
+        result = await result
+    return result
+
+
+class AsyncEngine(object):
+    """Consumer, producer and the receive task shared by the asyncio engines"""
+    def __init__(self, topic, schema, output_topic, output_schema, name=None,
+                 timeout=None, broker='pulsar://localhost:6650', max_records=-1,
+                 batching=True, max_pending=5000, initial_position='latest',
+                 batch_size=100, batch_timeout=10, ack='cumulative',
+                 receiver_queue_size=1000, max_batches=4, max_in_flight=5000):
+        self.client = pulsar.Client(broker)
+        self.Model = model_class_factory(**schema)
+        self.OutModel = model_class_factory(**output_schema)
+        self.consumer = subscribe_batches(self.client, topic, name,
+                                          pulsar.schema.AvroSchema(self.Model),
+                                          initial_position,
+                                          receiver_queue_size=receiver_queue_size,
+                                          batch_size=batch_size, batch_timeout=batch_timeout,
+                                          ack=ack, timeout=timeout)
+        self.producer = self.client.create_producer(
+            output_topic, block_if_queue_full=True, batching_enabled=batching,
+            max_pending_messages=max_pending,
+            schema=pulsar.schema.AvroSchema(self.OutModel))
+        self.timeout = timeout
+        self.max_records = max_records
+        self.max_batches = max_batches
+        self.in_flight = asyncio.Semaphore(max_in_flight)
+        self.handler = CallbackHandler()
+        self.loop = asyncio.get_running_loop()
+        self.received = 0
+        self.published = 0
+        self.idle = 0.
+
+    async def receive(self, queue):
+        """Receive batches into `queue` until the topic is depleted or
+        `max_records` messages have been received"""
+        loop, consumer, max_records = self.loop, self.consumer, self.max_records
+        while self.received != max_records:
+            remaining = max_records - self.received if max_records > 0 else None
+            batch = await loop.run_in_executor(None, consumer.receive, remaining)
+            if not batch:
+                self.idle = self.timeout * 1e-3 if self.timeout else 0.
+                break
+            self.received += len(batch)
+            await queue.put(batch)
+        await queue.put(None)
+
+    def _sent(self, result, message_id):
+        """Producer callback, called from a client thread"""
+        self.handler.callback(result, message_id)
+        self.loop.call_soon_threadsafe(self.in_flight.release)
+
+    async def publish(self, record):
+        """Send an output record, waiting while too many are in flight"""
+        await self.in_flight.acquire()
+        self.producer.send_async(self.OutModel.from_dict(record), callback=self._sent)
+        self.published += 1
+
+    async def run(self, process_batch, finish=None, tick=None, tick_interval=None):
+        """Process every received batch with the coroutine `process_batch`.  The
+        coroutine `tick` is also awaited when no batch arrived for `tick_interval`
+        seconds."""
+        queue = asyncio.Queue(self.max_batches)
+        t0 = time.time()
+        receiver = asyncio.ensure_future(self.receive(queue))
+        while True:
+            if tick is None:
+                batch = await queue.get()
+            else:
+                try:
+                    batch = await asyncio.wait_for(queue.get(), tick_interval)
+                except asyncio.TimeoutError:
+                    await tick()
+                    continue
+            if batch is None:
+                break
+            await process_batch([self.Model.decode_dict(message.data()) for message in batch],
+                                batch)
+            self.consumer.acknowledge(batch)
+        await receiver
+        if finish is not None:
+            await finish()
+        await self.loop.run_in_executor(None, self.producer.flush)
+        t0 += self.idle
+        logger.info('Total messages processed: %d', self.received)
+        logger.info('Average processing rate: %.2f records/s',
+                    self.received / (time.time() - t0))
+        logger.info('Outputs published: %d  (%d dropped)', self.published, self.handler.dropped)
+        self.client.close()
+
+
+_engine_settings = ('name', 'timeout', 'broker', 'max_records', 'batching', 'max_pending',
+                    'initial_position', 'batch_size', 'batch_timeout', 'ack',
+                    'receiver_queue_size', 'max_batches', 'max_in_flight')
+
+
+async def process_time_window_async(state, add_func, remove_func, topic, schema,
+                                    output_topic, output_func, output_field, output_schema,
+                                    init_func=None, window=10.0, key_by=None,
+                                    date_field='date', date_format='%Y-%m-%d %H:%M:%S',
+                                    eviction_fields=None, eviction_budget=64,
+                                    eviction_dir=None, batch_func=None, coalesce=False,
+                                    coalesce_interval=100, coalesce_pending=1000,
+                                    **settings):
+    """asyncio version of `time_window.process_time_window`"""
+    if not isinstance(output_field, (list, tuple)):
+        output_field = [output_field]
+    if init_func is None:
+        init_func = add_func
+    engine = AsyncEngine(topic, schema, output_topic, output_schema,
+                         **{name: settings[name] for name in _engine_settings
+                            if name in settings})
+    fields = [field for field in output_schema if field not in output_field]
+    if key_by is not None:
+        fields.append(key_by)
+    fields.append(date_field)
+    fields.extend(schema if eviction_fields is None else eviction_fields)
+    buffer = EvictionBuffer(list(dict.fromkeys(fields)), eviction_budget * 2 ** 20, eviction_dir)
+
+    async def send(keys_changed):
+        for key, data in keys_changed.items():
+            output = await _call(output_func, state, key, data)
+            if output is not None:
+                await engine.publish(output_record(output, data, output_field, output_schema))
+
+    ready = []
+    coalescer = OutputCoalescer(ready.append, coalesce_interval, coalesce_pending) \
+        if coalesce else None
+
+    async def emit(keys_changed):
+        if coalescer is None:
+            await send(keys_changed)
+            return
+        coalescer.add(keys_changed)
+        while ready:
+            await send(ready.pop(0))
+
+    async def tick():
+        # Flush the coalesced outputs of a quiet topic
+        coalescer.tick()
+        while ready:
+            await send(ready.pop(0))
+
+    async def process_batch(records, messages):
+        added, removed, batch_changed = [], [], {}
+        for data in records:
+            key = ALL_FIELDS if key_by is None else data[key_by]
+            t_right = parse_timestamp(data[date_field], date_format)
+            if batch_func is not None:
+                added.append((key, data))
+            elif key in state:
+                await _call(add_func, state, key, data)
+            else:
+                await _call(init_func, state, key, data)
+            keys_changed = {key: data}
+            buffer.append(t_right, key, data)
+            for keyl, data in buffer.evict(t_right - window):
+                if batch_func is not None:
+                    removed.append((keyl, data))
+                else:
+                    await _call(remove_func, state, keyl, data)
+                keys_changed[keyl] = data
+            if batch_func is not None:
+                batch_changed.update(keys_changed)
+            else:
+                await emit(keys_changed)
+        if batch_func is not None:
+            await _call(batch_func, state, added, removed)
+            await emit(batch_changed)
+
+    async def finish():
+        if coalescer is not None:
+            coalescer.flush()
+            while ready:
+                await send(ready.pop(0))
+            coalescer.report()
+        if hasattr(state, 'flush'):
+            await _call(state.flush)
+        buffer.close()
+
+    if coalescer is None:
+        await engine.run(process_batch, finish)
+    else:
+        await engine.run(process_batch, finish, tick, coalesce_interval * 1e-3)
+
+
+async def process_global_window_async(state, reduce_func, topic, schema, output_topic,
+                                      output_func, output_field, output_schema,
+                                      init_func=None, key_by=None, **settings):
+    """asyncio version of `global_window.process_global_window`"""
+    if not isinstance(output_field, (list, tuple)):
+        output_field = [output_field]
+    if init_func is None:
+        init_func = reduce_func
+    engine = AsyncEngine(topic, schema, output_topic, output_schema,
+                         **{name: settings[name] for name in _engine_settings
+                            if name in settings})
+
+    async def process_batch(records, messages):
+        for data in records:
+            key = ALL_FIELDS if key_by is None else data[key_by]
+            if key in state:
+                await _call(reduce_func, state, key, data)
+            else:
+                await _call(init_func, state, key, data)
+            output = await _call(output_func, state, key, data)
+            if output is None:
+                continue
+            await engine.publish(output_record(output, data, output_field, output_schema))
+
+    async def finish():
+        if hasattr(state, 'flush'):
+            await _call(state.flush)
+
+    await engine.run(process_batch, finish)
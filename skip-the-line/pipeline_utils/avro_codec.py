@@ -0,0 +1,313 @@
+"""Schema specialized Avro codec.
+
+The generic codec of `pulsar.schema.AvroSchema` walks the schema for every value
+it encodes or decodes.  Here the schema of a record class is compiled once into
+a pair of plain Python functions with the field layout unrolled, producing the
+same bytes as the generic path.
+"""
+import struct
+
+from pulsar import schema
+
+
+_float = struct.Struct('<f')
+_double = struct.Struct('<d')
+# Zigzag encoded single byte varints, i.e. integers in [-64, 63]
+_small_longs = {n: bytes([(n << 1) ^ (n >> 63)]) for n in range(-64, 64)}
+
+
+def encode_long(n):
+    """Zigzag varint encoding of an Avro int or long"""
+    try:
+        return _small_longs[n]
+    except KeyError:
+        pass
+    n = (n << 1) ^ (n >> 63)
+    out = bytearray()
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def decode_long(data, pos):
+    """Read a zigzag varint starting at `pos`. Returns the value and new position"""
+    b = data[pos]
+    pos += 1
+    n = b & 0x7f
+    shift = 7
+    while b & 0x80:
+        b = data[pos]
+        pos += 1
+        n |= (b & 0x7f) << shift
+        shift += 7
+    return (n >> 1) ^ -(n & 1), pos
+
+
+def _primitive_writer(kind):
+    if kind == 'null':
+        return lambda out, v: None
+    if kind == 'boolean':
+        return lambda out, v: out.append(1 if v else 0)
+    if kind in ('int', 'long'):
+        return lambda out, v: out.extend(encode_long(v))
+    if kind == 'float':
+        return lambda out, v: out.extend(_float.pack(v))
+    if kind == 'double':
+        return lambda out, v: out.extend(_double.pack(v))
+    if kind == 'string':
+        def write_string(out, v):
+            v = v.encode('utf-8')
+            out += encode_long(len(v))
+            out += v
+        return write_string
+    if kind == 'bytes':
+        def write_bytes(out, v):
+            out += encode_long(len(v))
+            out += v
+        return write_bytes
+    raise TypeError('Unsupported Avro type: ' + str(kind))
+
+
+def _primitive_reader(kind):
+    if kind == 'null':
+        return lambda data, pos: (None, pos)
+    if kind == 'boolean':
+        return lambda data, pos: (data[pos] == 1, pos + 1)
+    if kind in ('int', 'long'):
+        return decode_long
+    if kind == 'float':
+        return lambda data, pos: (_float.unpack_from(data, pos)[0], pos + 4)
+    if kind == 'double':
+        return lambda data, pos: (_double.unpack_from(data, pos)[0], pos + 8)
+    if kind == 'string':
+        def read_string(data, pos):
+            n, pos = decode_long(data, pos)
+            return data[pos:pos + n].decode('utf-8'), pos + n
+        return read_string
+    if kind == 'bytes':
+        def read_bytes(data, pos):
+            n, pos = decode_long(data, pos)
+            return bytes(data[pos:pos + n]), pos + n
+        return read_bytes
+    raise TypeError('Unsupported Avro type: ' + str(kind))
+
+
+def _union_writer(branches):
+    """Only unions of null with one other type are generated by pulsar records"""
+    if len(branches) != 2 or branches[0] != 'null':
+        raise TypeError('Only ["null", <type>] unions are supported')
+    write = build_writer(branches[1])
+    def write_optional(out, v):
+        if v is None:
+            out.append(0)
+        else:
+            out.append(2)
+            write(out, v)
+    return write_optional
+
+
+def _union_reader(branches):
+    if len(branches) != 2 or branches[0] != 'null':
+        raise TypeError('Only ["null", <type>] unions are supported')
+    read = build_reader(branches[1])
+    def read_optional(data, pos):
+        index, pos = decode_long(data, pos)
+        if index == 0:
+            return None, pos
+        return read(data, pos)
+    return read_optional
+
+
+def build_writer(avro_type):
+    """Returns a function `write(out, value)` that appends the encoding of a value
+    of `avro_type` to the bytearray `out`"""
+    if isinstance(avro_type, list):
+        return _union_writer(avro_type)
+    if isinstance(avro_type, str):
+        return _primitive_writer(avro_type)
+    kind = avro_type['type']
+    if kind == 'array':
+        write_item = build_writer(avro_type['items'])
+        def write_array(out, v):
+            if v:
+                out += encode_long(len(v))
+                for item in v:
+                    write_item(out, item)
+            out.append(0)
+        return write_array
+    if kind == 'map':
+        write_value = build_writer(avro_type['values'])
+        def write_map(out, v):
+            if v:
+                out += encode_long(len(v))
+                for key, value in v.items():
+                    key = key.encode('utf-8')
+                    out += encode_long(len(key))
+                    out += key
+                    write_value(out, value)
+            out.append(0)
+        return write_map
+    if kind == 'record':
+        fields = [(field['name'], build_writer(field['type'])) for field in avro_type['fields']]
+        def write_record(out, v):
+            if not isinstance(v, dict):
+                v = v.__dict__
+            for name, write in fields:
+                write(out, v.get(name))
+        return write_record
+    return _primitive_writer(kind)
+
+
+def build_reader(avro_type):
+    """Returns a function `read(data, pos)` that decodes a value of `avro_type`
+    starting at `pos`.  It returns the value and the position after it."""
+    if isinstance(avro_type, list):
+        return _union_reader(avro_type)
+    if isinstance(avro_type, str):
+        return _primitive_reader(avro_type)
+    kind = avro_type['type']
+    if kind == 'array':
+        read_item = build_reader(avro_type['items'])
+        def read_array(data, pos):
+            items = []
+            n, pos = decode_long(data, pos)
+            while n:
+                if n < 0:   # Negative block counts are followed by the block size
+                    n = -n
+                    _, pos = decode_long(data, pos)
+                for _ in range(n):
+                    item, pos = read_item(data, pos)
+                    items.append(item)
+                n, pos = decode_long(data, pos)
+            return items, pos
+        return read_array
+    if kind == 'map':
+        read_value = build_reader(avro_type['values'])
+        def read_map(data, pos):
+            result = {}
+            n, pos = decode_long(data, pos)
+            while n:
+                if n < 0:
+                    n = -n
+                    _, pos = decode_long(data, pos)
+                for _ in range(n):
+                    size, pos = decode_long(data, pos)
+                    key = data[pos:pos + size].decode('utf-8')
+                    result[key], pos = read_value(data, pos + size)
+                n, pos = decode_long(data, pos)
+            return result, pos
+        return read_map
+    if kind == 'record':
+        fields = [(field['name'], build_reader(field['type'])) for field in avro_type['fields']]
+        def read_record(data, pos):
+            result = {}
+            for name, read in fields:
+                result[name], pos = read(data, pos)
+            return result, pos
+        return read_record
+    return _primitive_reader(kind)
+
+
+# Code templates for the top level fields of a record.  Nested values go through
+# the closures built by `build_writer` and `build_reader`.
+_write_templates = {
+    'null': [],
+    'boolean': ['out.append(1 if v else 0)'],
+    'int': ['out += encode_long(v)'],
+    'long': ['out += encode_long(v)'],
+    'float': ['out += pack_float(v)'],
+    'double': ['out += pack_double(v)'],
+    'string': ['v = v.encode("utf-8")', 'out += encode_long(len(v))', 'out += v'],
+    'bytes': ['out += encode_long(len(v))', 'out += v'],
+}
+_read_templates = {
+    'null': ['d[{name!r}] = None'],
+    'boolean': ['d[{name!r}] = data[pos] == 1', 'pos += 1'],
+    'int': ['d[{name!r}], pos = decode_long(data, pos)'],
+    'long': ['d[{name!r}], pos = decode_long(data, pos)'],
+    'float': ['d[{name!r}] = unpack_float(data, pos)[0]', 'pos += 4'],
+    'double': ['d[{name!r}] = unpack_double(data, pos)[0]', 'pos += 8'],
+    'string': ['n, pos = decode_long(data, pos)', 'd[{name!r}] = data[pos:pos + n].decode("utf-8")',
+               'pos += n'],
+    'bytes': ['n, pos = decode_long(data, pos)', 'd[{name!r}] = bytes(data[pos:pos + n])', 'pos += n'],
+}
+
+
+def _field_source(index, name, avro_type, namespace):
+    """Source lines writing and reading one top level field"""
+    optional = False
+    if isinstance(avro_type, list) and len(avro_type) == 2 and avro_type[0] == 'null':
+        optional = True
+        avro_type = avro_type[1]
+    if isinstance(avro_type, str) and avro_type in _write_templates:
+        write = list(_write_templates[avro_type])
+        read = [line.format(name=name) for line in _read_templates[avro_type]]
+    else:
+        namespace['write_%d' % index] = build_writer(avro_type)
+        namespace['read_%d' % index] = build_reader(avro_type)
+        write = ['write_%d(out, v)' % index]
+        read = ['d[{!r}], pos = read_{}(data, pos)'.format(name, index)]
+
+    write = ['v = d.get({!r})'.format(name)] + (
+        ['if v is None:', '    out.append(0)', 'else:', '    out.append(2)'] +
+        ['    ' + line for line in write] if optional else write)
+    if optional:
+        read = (['if data[pos] == 0:', '    d[{!r}] = None'.format(name), '    pos += 1',
+                 'else:', '    pos += 1'] + ['    ' + line for line in read])
+    return write, read
+
+
+def compile_record(record_schema):
+    """Compile the Avro schema (as a dict) of a record into a pair of functions
+
+    Returns:
+        encode_dict(d):  Encode a dict of field values to Avro binary
+        decode_dict(data):  Decode Avro binary into a dict of field values
+    """
+    if record_schema.get('type') != 'record':
+        raise TypeError('Only record schemas can be compiled')
+    namespace = {
+        'encode_long': encode_long, 'decode_long': decode_long,
+        'pack_float': _float.pack, 'pack_double': _double.pack,
+        'unpack_float': _float.unpack_from, 'unpack_double': _double.unpack_from,
+    }
+    write_lines = ['def encode_dict(d):', '    out = bytearray()']
+    read_lines = ['def decode_dict(data):', '    pos = 0', '    d = {}']
+    for index, field in enumerate(record_schema['fields']):
+        write, read = _field_source(index, field['name'], field['type'], namespace)
+        write_lines.extend('    ' + line for line in write)
+        read_lines.extend('    ' + line for line in read)
+    write_lines.append('    return bytes(out)')
+    read_lines.append('    return d')
+    source = '\n'.join(write_lines + read_lines) + '\n'
+    exec(compile(source, '<avro:{}>'.format(record_schema.get('name')), 'exec'), namespace)
+    return namespace['encode_dict'], namespace['decode_dict']
+
+
+class CompiledAvroSchema(schema.AvroSchema):
+    """Drop in replacement of `pulsar.schema.AvroSchema` using a compiled codec.
+
+    The schema info registered with Pulsar is unchanged, so it can also be given
+    to consumers and producers."""
+    def __init__(self, record_cls):
+        super().__init__(record_cls)
+        self.encode_dict, self.decode_dict = compile_record(record_cls.schema())
+
+    def encode(self, obj):
+        return self.encode_dict(obj.__dict__)
+
+    def decode(self, data):
+        return self._record_cls(**self.decode_dict(data))
+
+
+class PreEncodedAvroSchema(schema.AvroSchema):
+    """Producer schema for payloads already encoded, e.g. by other processes.
+
+    Bytes are sent as they are and records are encoded as usual.  The schema info
+    registered with Pulsar is the one of the record class."""
+    def encode(self, obj):
+        if isinstance(obj, bytes):
+            return obj
+        return super().encode(obj)
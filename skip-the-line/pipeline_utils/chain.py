@@ -0,0 +1,146 @@
+"""Operator chaining: run the kernels of several SchemaFunctions in one function.
+
+Each message is decoded once, goes through the kernels of the chained functions
+in-process as a dict, and only the final output is encoded.  The output of each
+kernel is merged into the record given to the next one, exactly as if it had
+been encoded to a topic and decoded by the next function.  The intermediate
+topics become optional taps.
+"""
+import importlib
+import sys
+
+from .schema_functions import SchemaFunction
+from .schema_model import model_class_factory
+from .window_state import KeyedState
+
+
+def load_class(path):
+    """Import a class from a `module.Class` path, as in the `className` of a function"""
+    module, _, name = path.rpartition('.')
+    if not module:
+        raise ValueError('Expected module.Class, got ' + str(path))
+    return getattr(importlib.import_module(module), name)
+
+
+class ChainState(KeyedState):
+    """The states of the chained functions seen as a single keyed state, for the
+    checkpoints.  Keys are (index of the function, key) pairs."""
+    def __init__(self, states):
+        self.states = states
+
+    def __len__(self):
+        return sum(len(state) for state in self.states.values())
+
+    def track_changes(self):
+        for state in self.states.values():
+            state.track_changes()
+
+    def snapshot(self, changed_only=False):
+        entries = {}
+        for index, state in self.states.items():
+            entries.update(((index, key), data)
+                           for key, data in state.snapshot(changed_only).items())
+        return entries
+
+    def restore(self, entries):
+        split = {index: {} for index in self.states}
+        for (index, key), data in entries.items():
+            split[index][key] = data
+        for index, state in self.states.items():
+            state.restore(split[index])
+
+
+class Stage(object):
+    """One chained function with its kernel config and optional tap"""
+    __slots__ = ('function', 'config', 'tap_topic', 'TapClass')
+
+    def __init__(self, function, config, tap_topic=None, TapClass=None):
+        self.function = function
+        self.config = config
+        self.tap_topic = tap_topic
+        self.TapClass = TapClass
+
+
+class ChainFunction(SchemaFunction):
+    """Runs a sequence of SchemaFunction kernels on the same record.
+
+    The user config has the `schema` of the input, the `output_schema` of the
+    last function (none for a sink) and a `chain` list with one entry per function:
+        class:      `module.Class` of the function, e.g. `window_count.WindowCount`
+        config:     The user config of its kernel, without the schemas
+        tap_topic:  If given, the record after this function is also published
+                    to this topic, encoded with `tap_schema`
+    The directories in `chain_path` are added to the Python path to import them.
+
+    A function returning no output stops the chain for that record, which then
+    produces no output either.  Batching, stage metrics and checkpoints are set up
+    as for any SchemaFunction and apply to the whole chain."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stages = None
+        self.state = None
+
+    def init_state(self, chain=(), chain_path=(), **config):
+        """Create the chained functions and their states"""
+        if isinstance(chain_path, str):
+            chain_path = [chain_path]
+        for path in chain_path:
+            if path not in sys.path:
+                sys.path.append(path)
+        self.stages = []
+        states = {}
+        for index, entry in enumerate(chain):
+            function = load_class(entry['class'])()
+            function.name = self.name
+            stage_config = dict(entry.get('config') or {})
+            function.init_state(**stage_config)
+            tap_schema = entry.get('tap_schema')
+            TapClass = model_class_factory(**tap_schema) if tap_schema else None
+            self.stages.append(Stage(function, stage_config, entry.get('tap_topic'), TapClass))
+            if isinstance(getattr(function, 'state', None), KeyedState):
+                states[index] = function.state
+        if not self.stages:
+            raise ValueError('No function found in the chain')
+        self.state = ChainState(states)
+
+    def kernel(self, record, context, **config):
+        """Run the record through each function and returns the fields updated by
+        the chain, or None if a function stopped it"""
+        updates = {}
+        for stage in self.stages:
+            function = stage.function
+            result = function.kernel(record, context, **stage.config)
+            function.counter += 1
+            if not result:
+                return None
+            record = dict(record)
+            record.update(result)
+            updates.update(result)
+            if stage.tap_topic:
+                context.publish(stage.tap_topic, stage.TapClass.encode_dict(record))
+        return updates
+
+    def kernel_batch(self, records, context, **config):
+        """Run the whole batch through each function in turn, so that batched
+        kernels are used.  Records stopped by a function are not passed on."""
+        updates = [{} for _ in records]
+        live = list(range(len(records)))
+        for stage in self.stages:
+            if not live:
+                break
+            results = stage.function.kernel_batch(records, context, **stage.config)
+            merged, still_live = [], []
+            for index, record, result in zip(live, records, results):
+                if not result:
+                    updates[index] = None
+                    continue
+                record = dict(record)
+                record.update(result)
+                updates[index].update(result)
+                merged.append(record)
+                still_live.append(index)
+                if stage.tap_topic:
+                    context.publish(stage.tap_topic, stage.TapClass.encode_dict(record))
+            records, live = merged, still_live
+        self.counter += len(updates)
+        return updates
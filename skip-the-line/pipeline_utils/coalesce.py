@@ -0,0 +1,72 @@
+"""Coalescing of per-key outputs.  Only the latest update of each key is kept
+until the next flush, so a busy key produces at most one output per flush.
+
+The engines call `tick` whenever they wake up, including when a receive came
+back empty, so that the pending outputs of a quiet topic still leave on time.
+"""
+import logging
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class OutputCoalescer(object):
+    """Collects the changed keys and hands them to `send` every `interval`
+    milliseconds, or as soon as `max_pending` distinct keys are pending"""
+    def __init__(self, send, interval=100, max_pending=1000, report_interval=60):
+        """Initialize the coalescer
+
+        Args:
+            send:       Function called with a dict of key => latest data of the
+                        pending keys when they are flushed
+            interval:   Maximum time in milliseconds between flushes
+            max_pending:  Number of distinct pending keys triggering a flush
+            report_interval:  Time in seconds between two logs of the coalescing
+                        ratio"""
+        self.send = send
+        self.interval = interval * 1e-3
+        self.max_pending = max_pending
+        self.report_interval = report_interval
+        self.pending = {}
+        self.received = 0
+        self.sent = 0
+        self.deadline = time.time() + self.interval
+        self.next_report = time.time() + report_interval
+
+    def add(self, keys_changed):
+        """Register updates of a dict of key => data"""
+        self.pending.update(keys_changed)
+        self.received += len(keys_changed)
+        if len(self.pending) >= self.max_pending or time.time() >= self.deadline:
+            self.flush()
+
+    def tick(self):
+        """Flush if the interval has elapsed, even without new updates"""
+        if time.time() >= self.deadline:
+            self.flush()
+
+    def wait(self):
+        """Seconds until the next flush is due"""
+        return max(0., self.deadline - time.time())
+
+    def flush(self):
+        """Send the latest update of every pending key"""
+        if self.pending:
+            pending, self.pending = self.pending, {}
+            self.send(pending)
+            self.sent += len(pending)
+        now = time.time()
+        self.deadline = now + self.interval
+        if now >= self.next_report:
+            self.report()
+
+    def report(self):
+        """Log the number of updates and outputs so far"""
+        logger.info('Output coalescing: %d updates sent as %d outputs (ratio %.2f)',
+                    self.received, self.sent, self.ratio())
+        self.next_report = time.time() + self.report_interval
+
+    def ratio(self):
+        """Number of updates received per output sent"""
+        return self.received / self.sent if self.sent else 0.
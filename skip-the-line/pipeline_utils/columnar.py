@@ -0,0 +1,79 @@
+"""Columnar batches of records.  Numeric fields are held in NumPy arrays and
+other fields in object arrays, one array per field."""
+import sys
+
+import numpy as np
+
+
+# NumPy dtypes of the numeric schema types
+dtype_map = {
+    'Boolean': np.bool_,
+    'Integer': np.int32,
+    'Long': np.int64,
+    'Float': np.float32,
+    'Double': np.float64,
+}
+
+
+def _column(values, kind):
+    """Convert a list of field values into an array for a field of type `kind`"""
+    dtype = dtype_map.get(kind) if isinstance(kind, str) else None
+    if dtype is not None:
+        if None not in values:
+            return np.array(values, dtype=dtype)
+        if np.issubdtype(dtype, np.floating):
+            # Missing floating point values become NaN
+            return np.array([np.nan if v is None else v for v in values], dtype=dtype)
+    column = np.empty(len(values), dtype=object)
+    if kind == 'String':
+        # Identifiers repeat a lot, so share one string object per distinct value
+        column[:] = [v if v is None else sys.intern(v) for v in values]
+    else:
+        column[:] = values
+    return column
+
+
+def _value(column, i):
+    """Convert an array element back to a plain Python value"""
+    value = column[i]
+    if isinstance(value, np.generic):
+        value = value.item()
+        if value != value:     # NaN marks a missing value
+            return None
+    return value
+
+
+class RecordBatch(object):
+    """A batch of records stored column by column
+
+    Attributes:
+        columns:    dict of field name to array of values, one entry per record
+        definition: Schema definition of the records
+    """
+    def __init__(self, columns, definition):
+        self.columns = columns
+        self.definition = definition
+
+    @classmethod
+    def from_dicts(cls, rows, definition):
+        """Create a batch from a list of dicts keyed by field name"""
+        columns = {field: _column([row.get(field) for row in rows], kind)
+                   for field, kind in definition.items()}
+        return cls(columns, definition)
+
+    def __len__(self):
+        for column in self.columns.values():
+            return len(column)
+        return 0
+
+    def __getitem__(self, field):
+        return self.columns[field]
+
+    def __contains__(self, field):
+        return field in self.columns
+
+    def rows(self):
+        """Iterate over the records in the batch as dicts"""
+        fields = list(self.columns.items())
+        for i in range(len(self)):
+            yield {field: _value(column, i) for field, column in fields}
@@ -0,0 +1,124 @@
+"""Batched consumption of a topic for the standalone streaming engines.
+
+Messages are received in batches of up to `batch_size` messages, waiting at most
+`batch_timeout` milliseconds to fill a batch, and are acknowledged once the whole
+batch has been processed:
+    cumulative:  One cumulative acknowledgement of the last message of the batch.
+                 Not available on shared subscriptions.
+    batch:       Every message of the batch is acknowledged after the batch.
+    message:     Every message is acknowledged as soon as it is received, as
+                 before batching was introduced.
+The consumer prefetches up to `receiver_queue_size` messages from the broker.
+"""
+import logging
+import time
+
+import pulsar
+
+
+logger = logging.getLogger(__name__)
+
+ACK_MODES = ('cumulative', 'batch', 'message')
+
+
+def initial_position(name):
+    """Pulsar initial position of a subscription from its name"""
+    if name == 'earliest':
+        return pulsar.InitialPosition.Earliest
+    if name == 'latest':
+        return pulsar.InitialPosition.Latest
+    raise ValueError('Initial position must be latest or earliest.')
+
+
+class BatchConsumer(object):
+    """Receives and acknowledges the messages of a consumer in batches"""
+    def __init__(self, consumer, batch_size=100, batch_timeout=10, ack='cumulative',
+                 timeout=None):
+        """Initialize the batch consumer
+
+        Args:
+            consumer:       A subscribed `pulsar.Consumer`
+            batch_size:     Maximum number of messages in a batch
+            batch_timeout:  Maximum time in milliseconds spent filling a batch
+                            once its first message has arrived
+            ack:            Acknowledgement mode: cumulative, batch or message
+            timeout:        Time in milliseconds to wait for the first message of
+                            a batch.  Wait forever if None."""
+        if ack not in ACK_MODES:
+            raise ValueError('Acknowledgement mode must be one of ' + ', '.join(ACK_MODES))
+        self.consumer = consumer
+        self.batch_size = max(1, batch_size)
+        self.batch_timeout = batch_timeout
+        self.ack = ack
+        self.timeout = timeout
+        self.batches = 0
+
+    def receive(self, max_messages=None, wait=None):
+        """Receive the next batch of messages.  Returns an empty list if no message
+        arrived within `timeout`, or within `wait` milliseconds if given."""
+        consumer = self.consumer
+        size = self.batch_size if max_messages is None else min(self.batch_size, max_messages)
+        try:
+            message = consumer.receive(self.timeout if wait is None else wait)
+        except Exception as e:
+            if wait is None:
+                logger.info('Consumer has been depleted.  Message %s', str(e))
+            return []
+        batch = [message]
+        if self.ack == 'message':
+            consumer.acknowledge(message)
+        deadline = time.time() + self.batch_timeout * 1e-3
+        while len(batch) < size:
+            remaining = int((deadline - time.time()) * 1e3)
+            if remaining <= 0:
+                break
+            try:
+                message = consumer.receive(remaining)
+            except Exception:
+                break
+            batch.append(message)
+            if self.ack == 'message':
+                consumer.acknowledge(message)
+        self.batches += 1
+        return batch
+
+    def acknowledge(self, batch):
+        """Acknowledge a processed batch"""
+        if not batch:
+            return
+        if self.ack == 'cumulative':
+            self.consumer.acknowledge_cumulative(batch[-1])
+        elif self.ack == 'batch':
+            acknowledge = self.consumer.acknowledge
+            for message in batch:
+                acknowledge(message)
+
+    def __iter__(self):
+        """Iterate over batches until the consumer is depleted.  Each batch is
+        acknowledged when the next one is requested."""
+        while True:
+            batch = self.receive()
+            if not batch:
+                return
+            yield batch
+            self.acknowledge(batch)
+
+
+def subscribe_batches(client, topic, subscription_name, schema=None,
+                      initial_position_name='latest', consumer_type=None,
+                      receiver_queue_size=1000, batch_size=100, batch_timeout=10,
+                      ack='cumulative', timeout=None):
+    """Subscribe to a topic and returns a `BatchConsumer` of the subscription"""
+    if consumer_type == pulsar.ConsumerType.Shared and ack == 'cumulative':
+        logger.info('Cumulative acknowledgement is not supported on shared '
+                    'subscriptions.  Acknowledging per batch instead.')
+        ack = 'batch'
+    options = {}
+    if schema is not None:
+        options['schema'] = schema
+    if consumer_type is not None:
+        options['consumer_type'] = consumer_type
+    consumer = client.subscribe(topic, subscription_name=subscription_name,
+                                initial_position=initial_position(initial_position_name),
+                                receiver_queue_size=receiver_queue_size, **options)
+    return BatchConsumer(consumer, batch_size, batch_timeout, ack, timeout)
@@ -0,0 +1,173 @@
+"""In-process queue of the events in a sliding time window, to find the events
+leaving the window without reading the input topic a second time.
+
+Only the timestamp, the key and a few fields of each event are kept, serialized
+with `marshal`.  Once the queue passes its memory budget, newer events are
+appended to spill files on disk that are read back through `mmap`.
+"""
+import logging
+import marshal
+import mmap
+import os
+import shutil
+import struct
+import sys
+import tempfile
+from collections import deque
+
+
+logger = logging.getLogger(__name__)
+
+_length = struct.Struct('<I')
+
+
+class SpillSegment(object):
+    """A spill file of length prefixed records.  Records are appended until the
+    segment is sealed, then read back in order through a memory map."""
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'wb')
+        self.records = 0
+        self.map = None
+        self.offset = 0
+
+    def append(self, payload):
+        self.file.write(_length.pack(len(payload)))
+        self.file.write(payload)
+        self.records += 1
+
+    def seal(self):
+        self.file.close()
+        with open(self.path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def pop(self):
+        offset = self.offset
+        n, = _length.unpack_from(self.map, offset)
+        offset += _length.size
+        self.offset = offset + n
+        self.records -= 1
+        return self.map[offset:offset + n]
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+        elif not self.file.closed:
+            self.file.close()
+        os.remove(self.path)
+
+
+class EvictionBuffer(object):
+    """FIFO of (timestamp, key, fields) for the events in a window.
+
+    Events are kept in memory, oldest first, until they use `budget` bytes.  From
+    then on new events are spilled to segments of up to `segment_size` bytes in
+    `spill_dir`, until the events on disk have all been evicted.  Spill segments
+    are deleted as soon as they are consumed."""
+    def __init__(self, fields=(), budget=64 * 2 ** 20, spill_dir=None,
+                 segment_size=64 * 2 ** 20):
+        """Initialize the buffer
+
+        Args:
+            fields:     The fields of an event to keep, in addition to its key
+                        and timestamp
+            budget:     Memory budget of the in memory queue, in bytes
+            spill_dir:  Directory of the spill files.  A temporary directory is
+                        created when it is not given.
+            segment_size:   Size of a spill file in bytes"""
+        self.fields = tuple(fields)
+        self.budget = budget
+        self.segment_size = segment_size
+        self.spill_dir = spill_dir
+        self._own_dir = False
+        self.memory = deque()
+        self.memory_bytes = 0
+        self.segments = deque()     # Sealed spill segments, oldest first
+        self.writer = None          # Segment receiving the newest events
+        self.written = 0
+        self.spilled = 0            # Total number of events that went to disk
+        self.head = None            # Decoded oldest event
+        self.length = 0
+        self._segment_id = 0
+
+    def __len__(self):
+        return self.length
+
+    def append(self, stamp, key, data):
+        """Add an event at the newest end"""
+        payload = marshal.dumps((stamp, key, tuple([data[field] for field in self.fields])))
+        self.length += 1
+        if self.writer is None and not self.segments:
+            size = sys.getsizeof(payload)
+            if self.memory_bytes + size <= self.budget:
+                self.memory.append(payload)
+                self.memory_bytes += size
+                return
+            self.writer = self._new_segment()
+        elif self.writer is None or self.written >= self.segment_size:
+            self._seal()
+            self.writer = self._new_segment()
+        self.writer.append(payload)
+        self.written += len(payload) + _length.size
+        self.spilled += 1
+
+    def _new_segment(self):
+        if self.spill_dir is None:
+            self.spill_dir = tempfile.mkdtemp(prefix='eviction-')
+            self._own_dir = True
+        self._segment_id += 1
+        self.written = 0
+        path = os.path.join(self.spill_dir, 'segment-%06d' % self._segment_id)
+        logger.debug('Spilling window events to %s', path)
+        return SpillSegment(path)
+
+    def _seal(self):
+        if self.writer is not None:
+            self.writer.seal()
+            self.segments.append(self.writer)
+            self.writer = None
+
+    def _pop_payload(self):
+        if self.memory:
+            payload = self.memory.popleft()
+            self.memory_bytes -= sys.getsizeof(payload)
+            return payload
+        if not self.segments:
+            self._seal()
+        segment = self.segments[0]
+        payload = segment.pop()
+        if not segment.records:
+            self.segments.popleft()
+            segment.close()
+        return payload
+
+    def oldest(self):
+        """Timestamp of the oldest event, or None if the buffer is empty"""
+        if self.head is None:
+            if not self.length:
+                return None
+            self.head = marshal.loads(self._pop_payload())
+        return self.head[0]
+
+    def evict(self, stamp):
+        """Remove the events at or before `stamp`, oldest first.  Yields the key and
+        a dict of the kept fields of each of them."""
+        fields = self.fields
+        while self.length:
+            oldest = self.oldest()
+            if oldest > stamp:
+                break
+            _, key, values = self.head
+            self.head = None
+            self.length -= 1
+            yield key, dict(zip(fields, values))
+
+    def close(self):
+        """Delete the spill files"""
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        while self.segments:
+            self.segments.popleft().close()
+        if self._own_dir:
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
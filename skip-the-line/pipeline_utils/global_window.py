@@ -3,10 +3,11 @@ import logging
 import time
 
 import pulsar
-from redis import Redis
 
 from .schema_model import model_class_factory
 from .callback import CallbackHandler
+from .consume import subscribe_batches
+from .time_window import output_record
 
 
 logger = logging.getLogger(__name__)
@@ -18,10 +19,19 @@ def process_global_window(state, reduce_func, topic, schema,
                           init_func=None, key_by=None, name=None, timeout=None,
                           broker='pulsar://localhost:6650', max_records=-1,
                           batching=True, max_pending=5000, initial_position='latest',
-                          **settings):
+                          batch_size=100, batch_timeout=10, ack='cumulative',
+                          receiver_queue_size=1000, **settings):
     """Update the state correspond to an event stream for a continuously
     sliding time window.
+
+    Messages are received in batches, see `consume.BatchConsumer` for
+    `batch_size`, `batch_timeout`, `ack` and `receiver_queue_size`.
+
+    `output_field` may be a list of fields, filled from the tuple returned by
+    `output_func`.
     """
+    if not isinstance(output_field, (list, tuple)):
+        output_field = [output_field]
     if init_func is None:
         init_func = reduce_func
 
@@ -29,16 +39,10 @@ def process_global_window(state, reduce_func, topic, schema,
     Model = model_class_factory(**schema)
     avro_schema = pulsar.schema.AvroSchema(Model)
 
-    if initial_position == 'earliest':
-        position = pulsar.InitialPosition.Earliest
-    elif initial_position == 'latest':
-        position = pulsar.InitialPosition.Lastest
-    else:
-        raise ValueError('Initial position must be latest or earliest.')
-
-    consumer = client.subscribe(topic, initial_position=position,
-                                subscription_name=name,
-                                schema=avro_schema)
+    consumer = subscribe_batches(client, topic, name, avro_schema, initial_position,
+                                 receiver_queue_size=receiver_queue_size,
+                                 batch_size=batch_size, batch_timeout=batch_timeout,
+                                 ack=ack, timeout=timeout)
     if key_by is not None and key_by not in schema:
         logger.info('key_by:     %s', key_by)
         logger.info('Schema:     %s', str(schema))
@@ -49,12 +53,12 @@ def process_global_window(state, reduce_func, topic, schema,
                                       batching_enabled=batching,
                                       max_pending_messages=max_pending,
                                       schema=pulsar.schema.AvroSchema(OutModel))
-    if output_field not in output_schema:
+    if any(field not in output_schema for field in output_field):
         raise KeyError('The output field is not in the schema.')
     if key_by is not None and key_by not in schema:
         raise KeyError('No field matched the `key_by` setting')
     for key in output_schema:
-        if key == output_field:
+        if key in output_field:
             continue
         if key not in schema:
             raise KeyError('Output schema contains unknown fields')
@@ -63,27 +67,29 @@ def process_global_window(state, reduce_func, topic, schema,
     i = 0
     handler = CallbackHandler()
     while i != max_records:
-        try:
-            message = consumer.receive(timeout)
-        except Exception as e:
-            logger.info('Consumer has been depleted.  Message %s', str(e))
-            t0 += timeout * 1e-3
+        batch = consumer.receive(max_records - i if max_records > 0 else None)
+        if not batch:
+            if timeout is not None:
+                t0 += timeout * 1e-3
             break
-        data = message.value().__dict__
-        consumer.acknowledge(message)
-        i += 1
+        for message in batch:
+            data = message.value().__dict__
+            i += 1
 
-        key = "___all-fields___" if key_by is None else data[key_by]
-        if key in state:
-            add_func(state, key, data)
-        else:
-            init_func(state, key, data)
-        output = output_func(state, key, data)
-        if output is None:
-            continue
-        record = {field: output if field == output_field else data[field]
-                  for field in output_schema}
-        producer.send_async(OutModel.from_dict(record), handler.callback)
+            key = "___all-fields___" if key_by is None else data[key_by]
+            if key in state:
+                reduce_func(state, key, data)
+            else:
+                init_func(state, key, data)
+            output = output_func(state, key, data)
+            if output is None:
+                continue
+            record = output_record(output, data, output_field, output_schema)
+            producer.send_async(OutModel.from_dict(record), handler.callback)
+        consumer.acknowledge(batch)
+    # Write back the state updates still buffered by the state
+    if hasattr(state, 'flush'):
+        state.flush()
     producer.flush()
     logger.info('Total messages processed: %d', i)
     logger.info('Average processing rate: %.2f records/s', i/(time.time()-t0))
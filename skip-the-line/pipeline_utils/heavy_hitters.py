@@ -0,0 +1,141 @@
+"""Bounded memory top-K of the most frequent keys, with the Space-Saving sketch.
+
+`SpaceSaving` keeps at most `capacity` counters whatever the number of distinct
+keys.  When a key without a counter arrives, it takes over the smallest counter,
+whose value becomes the error of the key.  Counts are overestimated by at most
+their error, which is never more than `total / capacity`, and every key seen
+more than `total / capacity` times has a counter.
+
+`TopKState` keeps one sketch per group and can be used as the state of
+`global_window.process_global_window`.  Its top-K are meant to be emitted
+periodically rather than after every event, see scripts/top_k.py.
+"""
+import heapq
+import time
+
+
+class SpaceSaving(object):
+    """Space-Saving heavy hitter sketch"""
+    def __init__(self, capacity=1000):
+        self.capacity = capacity
+        self.counts = {}        # key => [count, error]
+        self.heap = []          # (count, key), may hold outdated counts
+        self.total = 0
+
+    def __len__(self):
+        return len(self.counts)
+
+    def __contains__(self, key):
+        return key in self.counts
+
+    def _compact(self):
+        """Drop the outdated heap entries"""
+        self.heap = [(counter[0], key) for key, counter in self.counts.items()]
+        heapq.heapify(self.heap)
+
+    def _pop_min(self):
+        """Remove the key with the smallest count and return its count"""
+        heap, counts = self.heap, self.counts
+        while True:
+            count, key = heapq.heappop(heap)
+            counter = counts.get(key)
+            if counter is not None and counter[0] == count:
+                del counts[key]
+                return count
+
+    def offer(self, key, count=1):
+        """Count `count` occurrences of a key"""
+        self.total += count
+        counter = self.counts.get(key)
+        if counter is None:
+            error = self._pop_min() if len(self.counts) >= self.capacity else 0
+            counter = self.counts[key] = [error, error]
+        counter[0] += count
+        heapq.heappush(self.heap, (counter[0], key))
+        if len(self.heap) > 4 * self.capacity:
+            self._compact()
+
+    def top(self, k):
+        """The `k` keys with the largest counts as a list of (key, count, error),
+        the largest first.  Ties are ordered by key."""
+        return [(key, count, error) for key, (count, error) in
+                heapq.nsmallest(k, self.counts.items(), key=lambda item: (-item[1][0], item[0]))]
+
+    def error_bound(self):
+        """Maximum overestimate of any count"""
+        return self.total // self.capacity
+
+    def guaranteed(self, k):
+        """Number of leading keys of `top(k)` certain to be in the true top-k:
+        their lower bound `count - error` is at least the largest possible count
+        of any key ranked below k"""
+        ranked = self.top(k + 1)
+        if len(ranked) > k:
+            threshold = ranked[k][1]
+        elif len(self.counts) >= self.capacity:
+            # Keys without a counter were seen at most as often as the smallest one
+            threshold = ranked[-1][1]
+        else:
+            return len(ranked)
+        n = 0
+        for _, count, error in ranked[:k]:
+            if count - error < threshold:
+                break
+            n += 1
+        return n
+
+
+class TopKState(object):
+    """One `SpaceSaving` sketch per group, with the periodic emission of the top-K"""
+    def __init__(self, k=100, capacity=1000, emit_every=1000, emit_interval=1000):
+        """Initialize the state
+
+        Args:
+            k:              Number of keys in each emitted top-K
+            capacity:       Number of counters of each sketch, at least k
+            emit_every:     Number of events of a group between two emissions
+            emit_interval:  Maximum time in milliseconds between two emissions
+                            of a group"""
+        if capacity < k:
+            raise ValueError('The capacity of the sketch must be at least k')
+        self.k = k
+        self.capacity = capacity
+        self.emit_every = emit_every
+        self.emit_interval = emit_interval * 1e-3
+        self.sketches = {}
+        self.updates = {}       # group => events since the last emission
+        self.deadlines = {}
+
+    def __contains__(self, key):
+        # Every key is counted the same way
+        return True
+
+    def __len__(self):
+        return len(self.sketches)
+
+    def offer(self, group, key, count=1):
+        sketch = self.sketches.get(group)
+        if sketch is None:
+            sketch = self.sketches[group] = SpaceSaving(self.capacity)
+            self.updates[group] = 0
+            self.deadlines[group] = time.time() + self.emit_interval
+        sketch.offer(key, count)
+        self.updates[group] += 1
+
+    def due(self, group):
+        """Whether the top-K of a group should be emitted now"""
+        updates = self.updates.get(group, 0)
+        return updates >= self.emit_every or \
+            (updates > 0 and time.time() >= self.deadlines[group])
+
+    def emit(self, group):
+        """The top-K of a group as (keys, counts, errors, guaranteed, total,
+        error_bound), restarting the emission period.  `guaranteed` is the
+        number of leading keys certain to be in the exact top-K."""
+        sketch = self.sketches[group]
+        top = sketch.top(self.k)
+        self.updates[group] = 0
+        self.deadlines[group] = time.time() + self.emit_interval
+        return ([key for key, _, _ in top], [count for _, count, _ in top],
+                [error for _, _, error in top], sketch.guaranteed(self.k),
+                sketch.total, sketch.error_bound())
@@ -0,0 +1,129 @@
+"""Numeric per-key state in NumPy arrays, for the in-memory window scripts.
+
+Keys are interned to dense integer ids by a `KeyIndex`, and each quantity of the
+state (e.g. count, sum and sum of squares) is a growable array indexed by the
+key id.  Batches of updates are applied with `np.add.at`.
+
+Requires NumPy, see `moving_stats.make_keyed_state` for a factory that only
+imports it for the memory backend.
+"""
+import sys
+
+import numpy as np
+
+
+class KeyIndex(object):
+    """Assigns dense integer ids to keys, in order of first appearance"""
+    def __init__(self):
+        self.ids = {}
+        self.keys = []
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self.ids
+
+    def get_id(self, key):
+        """The id of a key, assigning a new one if the key is unknown"""
+        ids = self.ids
+        i = ids.get(key)
+        if i is None:
+            i = ids[key] = len(self.keys)
+            self.keys.append(key)
+        return i
+
+    def get_ids(self, keys):
+        """The ids of a sequence of keys as an array"""
+        get_id = self.get_id
+        return np.fromiter((get_id(key) for key in keys), dtype=np.intp, count=len(keys))
+
+    def key(self, i):
+        return self.keys[i]
+
+
+class NumpyState(object):
+    """Per-key numeric columns in growable arrays.
+
+    The columns are zero for a new key.  `count` columns are integers and the
+    others floating point unless `dtypes` says otherwise."""
+    def __init__(self, columns=('count',), dtypes=None, capacity=1024):
+        """Initialize the state
+
+        Args:
+            columns:    Names of the quantities kept for each key
+            dtypes:     Dict of column name to NumPy dtype
+            capacity:   Initial number of keys the arrays can hold"""
+        dtypes = dtypes or {}
+        self.index = KeyIndex()
+        self.columns = tuple(columns)
+        self.arrays = {column: np.zeros(capacity, dtype=dtypes.get(
+            column, np.int64 if column == 'count' else np.float64)) for column in columns}
+        self.capacity = capacity
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def _reserve(self, size):
+        """Grow the arrays to hold at least `size` keys"""
+        capacity = self.capacity
+        if size <= capacity:
+            return
+        while capacity < size:
+            capacity *= 2
+        for column, array in self.arrays.items():
+            grown = np.zeros(capacity, dtype=array.dtype)
+            grown[:self.capacity] = array
+            self.arrays[column] = grown
+        self.capacity = capacity
+
+    def key_id(self, key):
+        i = self.index.get_id(key)
+        if i >= self.capacity:
+            self._reserve(i + 1)
+        return i
+
+    def incr(self, key, column, value=1):
+        """Add `value` to a column of a key"""
+        i = self.key_id(key)
+        self.arrays[column][i] += value
+
+    def add(self, key, values, sign=1):
+        """Add a dict of column values to a key, or subtract them if `sign` is -1"""
+        i = self.key_id(key)
+        arrays = self.arrays
+        for column, value in values.items():
+            arrays[column][i] += sign * value
+
+    def add_batch(self, keys, values, sign=1):
+        """Add the values of a batch of updates.  Keys may repeat.
+
+        Args:
+            keys:   Sequence of keys, one per update
+            values: Dict of column name to a sequence of values, one per update,
+                    or a scalar added for every update
+            sign:   -1 to subtract the values instead"""
+        if not len(keys):
+            return
+        ids = self.index.get_ids(keys)
+        self._reserve(len(self.index))
+        for column, value in values.items():
+            value = np.asarray(value, dtype=self.arrays[column].dtype)
+            np.add.at(self.arrays[column], ids, value if sign > 0 else -value)
+
+    def get(self, key, column):
+        """The value of a column for a key, zero for an unknown key"""
+        i = self.index.ids.get(key)
+        if i is None:
+            return 0
+        return self.arrays[column][i].item()
+
+    def memory_usage(self):
+        """Estimated memory footprint in bytes"""
+        index = self.index
+        size = sys.getsizeof(index.ids) + sys.getsizeof(index.keys)
+        return size + sum(array.nbytes for array in self.arrays.values())
+
@@ -0,0 +1,117 @@
+"""Parsing of the JSON lines read by the producers, driven by the schema.
+
+Lines are parsed with orjson when it is installed, or with the standard `json`
+module, and only fall back to YAML when JSON parsing fails.  The fields are
+projected on the schema and the Array fields written as comma separated strings
+are split in the same pass.  `parse_many` parses a list of lines at once, as a
+single JSON array when the backend allows it.
+"""
+import json
+import logging
+
+import yaml
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = ('orjson', 'json', 'yaml')
+
+
+def default_backend():
+    return 'orjson' if orjson is not None else 'json'
+
+
+class LineParser(object):
+    """Parse lines into dicts holding the fields of a schema"""
+    def __init__(self, schema, vectorize=True, backend=None):
+        """Initialize the parser
+
+        Args:
+            schema:     Schema definition of the records, see `model_class_factory`
+            vectorize:  True to split every Array field given as a string, or the
+                        list of fields to split
+            backend:    orjson, json or yaml.  Defaults to orjson if installed."""
+        backend = backend or default_backend()
+        if backend not in BACKENDS:
+            raise ValueError('Unknown parser backend: ' + str(backend))
+        if backend == 'orjson' and orjson is None:
+            raise ImportError('orjson is not installed')
+        self.backend = backend
+        self.fields = list(schema)
+        if vectorize is True:
+            vectorize = [field for field, kind in schema.items() if kind[0] == 'Array']
+        self.vectorize = list(vectorize or ())
+        if backend == 'orjson':
+            self.loads = orjson.loads
+        elif backend == 'json':
+            self.loads = json.loads
+        else:
+            self.loads = yaml.safe_load
+        self.failed = 0
+
+    def _project(self, data):
+        """Keep the schema fields and split the vectorized ones"""
+        record = {field: data.get(field) for field in self.fields}
+        for field in self.vectorize:
+            value = record[field]
+            if isinstance(value, str):
+                record[field] = [entry.strip() for entry in value.split(',')]
+        return record
+
+    def _load(self, line):
+        """Parse one line, with the YAML fallback.  None for a bad line."""
+        try:
+            data = self.loads(line)
+        except ValueError:
+            try:
+                data = yaml.safe_load(line)
+            except yaml.YAMLError:
+                data = None
+        except yaml.YAMLError:
+            data = None
+        if not isinstance(data, dict):
+            self.failed += 1
+            logger.warning('Badly formed line skipped: %s', line)
+            return None
+        return data
+
+    def parse(self, line):
+        """The record of a line, or None if the line cannot be parsed"""
+        data = self._load(line)
+        return None if data is None else self._project(data)
+
+    def parse_many(self, lines):
+        """The records of a list of lines, with None for the bad lines"""
+        if self.backend != 'yaml':
+            try:
+                if self.backend == 'orjson':
+                    text = b'[' + b','.join(line.encode('utf-8') if isinstance(line, str)
+                                            else line for line in lines) + b']'
+                else:
+                    text = '[' + ','.join(lines) + ']'
+                parsed = self.loads(text)
+            except ValueError:
+                # A bad or empty line somewhere, parse them one by one
+                pass
+            else:
+                if len(parsed) == len(lines) and all(isinstance(data, dict)
+                                                     for data in parsed):
+                    return [self._project(data) for data in parsed]
+        return [self.parse(line) for line in lines]
+
+    def iter_lines(self, lines, batch_size=100):
+        """Parse an iterable of lines `batch_size` at a time and yield
+        (line, record) pairs, with a None record for bad lines"""
+        batch = []
+        for line in lines:
+            batch.append(line)
+            if len(batch) >= batch_size:
+                yield from zip(batch, self.parse_many(batch))
+                batch = []
+        if batch:
+            yield from zip(batch, self.parse_many(batch))
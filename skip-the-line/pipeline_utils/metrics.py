@@ -0,0 +1,113 @@
+"""Low overhead latency histograms for profiling the stages of a stream processor"""
+import bisect
+import math
+import time
+
+
+class LatencyHistogram(object):
+    """Histogram of durations in geometrically growing buckets, so quantiles are
+    accurate to a fixed relative error regardless of the latency scale."""
+    def __init__(self, min_value=1e-6, max_value=100.0, buckets_per_decade=20):
+        """Initialize the histogram
+
+        Args:
+            min_value:  Upper bound of the first bucket in seconds
+            max_value:  Durations above this are counted in the last bucket
+            buckets_per_decade:  Resolution.  20 gives about 12% relative error."""
+        decades = math.log10(max_value / min_value)
+        n = int(math.ceil(decades * buckets_per_decade))
+        self.bounds = [min_value * 10 ** (i / buckets_per_decade) for i in range(n + 1)]
+        self.counts = [0] * (n + 2)
+        self.count = 0
+        self.total = 0.
+
+    def record(self, seconds):
+        """Add one duration to the histogram"""
+        self.counts[bisect.bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+
+    def quantile(self, q):
+        """Estimate the `q` quantile (0 to 1) as the upper bound of its bucket"""
+        if not self.count:
+            return None
+        target = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= target and n:
+                return self.bounds[min(i, len(self.bounds) - 1)]
+        return self.bounds[-1]
+
+    def reset(self):
+        self.counts = [0] * len(self.counts)
+        self.count = 0
+        self.total = 0.
+
+
+class StageProfiler(object):
+    """Keeps one latency histogram per processing stage for a sample of the messages
+    and summarizes them periodically."""
+    stages = ('decode', 'kernel', 'encode', 'total')
+    quantiles = (0.5, 0.9, 0.99)
+
+    def __init__(self, sample=0.01, period=10.0):
+        """Initialize the profiler
+
+        Args:
+            sample:     Fraction of messages to time.  Every n-th message is timed.
+            period:     Interval in seconds between summaries"""
+        self.stride = max(1, int(round(1. / sample)))
+        self.period = period
+        self.histograms = {stage: LatencyHistogram() for stage in self.stages}
+        self.next_report = time.time() + period
+
+    def sampled(self, counter):
+        """Whether the message with this counter should be timed"""
+        return counter % self.stride == 0
+
+    def record(self, stage, seconds):
+        self.histograms[stage].record(seconds)
+
+    def due(self):
+        """Whether it is time for a new summary"""
+        return time.time() >= self.next_report
+
+    def summarize(self, reset=True):
+        """Returns {stage: (count, p50, p90, p99)} with quantiles in seconds
+        for the stages that have been timed since the last summary"""
+        summary = {}
+        for stage in self.stages:
+            histogram = self.histograms[stage]
+            if histogram.count:
+                summary[stage] = (histogram.count,) + tuple(histogram.quantile(q)
+                                                            for q in self.quantiles)
+            if reset:
+                histogram.reset()
+        self.next_report = time.time() + self.period
+        return summary
+
+
+def format_stage_summary(name, summary, t=None):
+    """Compact text form of a stage summary.  e.g.
+    `STAGES|<name>|<time>|decode=12,0.00002,0.00003,0.00005|kernel=...`
+    Quantiles are in seconds."""
+    if t is None:
+        t = time.time()
+    parts = ['STAGES', str(name), repr(t)]
+    for stage, values in summary.items():
+        parts.append('{}={},{:.3g},{:.3g},{:.3g}'.format(stage, *values))
+    return '|'.join(parts)
+
+
+def parse_stage_summary(message):
+    """Inverse of `format_stage_summary`.  Returns name, time and summary"""
+    parts = message.split('|')
+    if parts[0] != 'STAGES':
+        raise ValueError('Not a stage summary: ' + message)
+    summary = {}
+    for part in parts[3:]:
+        stage, values = part.split('=')
+        count, *quantiles = values.split(',')
+        summary[stage] = (int(count),) + tuple(float(q) for q in quantiles)
+    return parts[1], float(parts[2]), summary
@@ -0,0 +1,146 @@
+"""Moving count and moving mean and variance of the keys of a stream.
+
+The jobs of scripts/moving_count.py and scripts/mean_variance.py and of their
+in-memory variants.  The state of each key lives in Redis (`RedisState`) or in
+NumPy arrays (`NumpyState`), and the worker functions are the same for both.
+With the asyncio engine the Redis state is an `AsyncRedisState`, whose updates
+are coroutines: the worker functions return the result of their single state
+update, which the engine awaits.
+
+Redis layout, unchanged from the first versions of the scripts:
+    moving count:   the count of each key in the top-level Redis key of that key
+    mean/variance:  the hashes `count`, `sum` and `sumsq`, one field per key
+"""
+import asyncio
+import logging
+
+from .async_window import process_time_window_async
+from .parallel import process_time_window_sharded
+from .time_window import process_time_window
+
+
+logger = logging.getLogger(__name__)
+
+STATE_OPTIONS = ('state_server', 'state_port', 'state_id', 'flush_every', 'flush_interval')
+
+
+def make_keyed_state(backend='memory', columns=('count',), state_server='localhost',
+                     state_port=6379, state_id=0, flush_every=1000, flush_interval=100,
+                     top_level=None, asynchronous=False):
+    """Create a per-key numeric state in memory (`keyed_state.NumpyState`, which
+    requires NumPy) or in Redis (`redis_state.RedisState`), which share the same
+    interface.  `top_level` is the column kept in top-level Redis keys, and
+    `asynchronous` selects `redis_state.AsyncRedisState` for the asyncio engine."""
+    if backend == 'memory':
+        from .keyed_state import NumpyState
+        return NumpyState(columns)
+    if backend == 'redis':
+        from .redis_state import AsyncRedisState, RedisState
+        cls = AsyncRedisState if asynchronous else RedisState
+        return cls.connect(state_server, state_port, state_id, columns=columns,
+                           flush_every=flush_every, flush_interval=flush_interval,
+                           top_level=top_level)
+    raise ValueError('Unknown keyed state backend: ' + str(backend))
+
+
+def run_window_job(settings, columns, incr, decr, output_func, batch_func,
+                   backend=None, top_level=None):
+    """Run a time window job over a per-key numeric state
+
+    Args:
+        settings:   Settings of the script, see `process_time_window`, and
+                    state_backend (redis or memory), the state options, vectorized,
+                    workers and engine (blocking or async, with a single worker)
+        columns:    Columns of the state
+        incr, decr, output_func:  Worker functions, see `process_time_window`
+        batch_func: Worker function applying a batch, used unless `vectorized` is false
+        backend:    redis or memory, overrides `state_backend` of the settings
+        top_level:  Column kept in top-level Redis keys, see `RedisState`"""
+    state_backend = settings.pop('state_backend', 'redis')
+    backend = backend or state_backend
+    options = {name: settings[name] for name in STATE_OPTIONS if name in settings}
+    if backend == 'redis':
+        options['top_level'] = top_level
+    if settings.pop('vectorized', True):
+        settings['batch_func'] = batch_func
+    workers = settings.pop('workers', 1)
+    engine = settings.pop('engine', 'blocking')
+    if engine not in ('blocking', 'async'):
+        raise ValueError('Unknown engine: ' + str(engine))
+    if engine == 'async' and workers > 1:
+        raise ValueError('The async engine runs a single worker, set workers: 1')
+    if workers > 1:
+        # Each worker process creates the state of its own keys
+        state = lambda: make_keyed_state(backend, columns, **options)
+        process_time_window_sharded(state, incr, decr, output_func=output_func,
+                                    workers=workers, **settings)
+        return
+    if engine == 'async':
+        state = make_keyed_state(backend, columns, asynchronous=True, **options)
+        asyncio.run(process_time_window_async(state, incr, decr, output_func=output_func,
+                                              **settings))
+    else:
+        state = make_keyed_state(backend, columns, **options)
+        process_time_window(state, incr, decr, output_func=output_func, **settings)
+    logger.info('State of %d keys (%s)', len(state), backend)
+
+
+# Moving count
+def incr_count(state, key, data):
+    return state.incr(key, 'count', 1)
+
+def decr_count(state, key, data):
+    return state.incr(key, 'count', -1)
+
+def update_count_batch(state, added, removed):
+    """Apply a whole batch of events entering and leaving the window"""
+    return state.add_batch([key for key, _ in added] + [key for key, _ in removed],
+                           {'count': [1] * len(added) + [-1] * len(removed)})
+
+def output_count(state, key, data):
+    """Directly output the value associated with the key."""
+    return state.get(key, 'count')
+
+
+def run_moving_count(settings, backend=None):
+    """Count the events of each key in a sliding time window"""
+    run_window_job(settings, ('count',), incr_count, decr_count, output_count,
+                   update_count_batch, backend=backend, top_level='count')
+
+
+def run_mean_variance(settings, backend=None):
+    """Mean and variance of the `value_field` of the events of each key in a
+    sliding time window"""
+    field = settings['value_field']
+
+    # Helper worker functions
+    def incr(state, key, data):
+        value = data[field]
+        return state.add(key, {'count': 1, 'sum': value, 'sumsq': value * value})
+
+    def decr(state, key, data):
+        value = data[field]
+        return state.add(key, {'count': 1, 'sum': value, 'sumsq': value * value}, sign=-1)
+
+    def update_batch(state, added, removed):
+        """Apply a whole batch of events entering and leaving the window"""
+        signs = [1] * len(added) + [-1] * len(removed)
+        values = [float(data[field]) for _, data in added + removed]
+        return state.add_batch([key for key, _ in added + removed],
+                               {'count': signs,
+                                'sum': [sign * value for sign, value in zip(signs, values)],
+                                'sumsq': [sign * value * value
+                                          for sign, value in zip(signs, values)]})
+
+    def output_mean_variance(state, key, data):
+        """Returns the mean and variance for the key"""
+        n = state.get(key, 'count')
+        if not n:
+            return None, None
+        mean = state.get(key, 'sum') / n
+        variance = state.get(key, 'sumsq') / n - mean * mean
+        return mean, variance
+
+    # State table for:  count, sum and sum of squares in the window
+    run_window_job(settings, ('count', 'sum', 'sumsq'), incr, decr, output_mean_variance,
+                   update_batch, backend=backend)
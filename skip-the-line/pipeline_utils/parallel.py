@@ -0,0 +1,443 @@
+"""Multi-process execution of the standalone window engines, sharded by key.
+
+A single consumer in the main process decodes the messages and routes each of
+them, by a stable hash of its key, to one of `workers` processes over pipe
+queues.  Each worker owns the state of its keys and runs the usual `add_func`,
+`remove_func` and `output_func` (or `reduce_func`).  The outputs of all workers
+are sent back to the main process, where a single async producer publishes them.
+
+Workers are forked before the Pulsar client is created, so the state and the
+functions given to the engines are copied into each worker and do not need to
+be picklable.  A state holding a connection, such as Redis, should be given as
+a function creating the state instead, so that each worker opens its own.
+"""
+import logging
+import multiprocessing
+import queue
+import threading
+import time
+import traceback
+
+import pulsar
+
+from .callback import CallbackHandler
+from .coalesce import OutputCoalescer
+from .consume import subscribe_batches
+from .eviction import EvictionBuffer
+from .partitioner import partition
+from .schema_model import model_class_factory
+from .time_window import output_record
+from .timestamps import parse_timestamp
+
+
+logger = logging.getLogger(__name__)
+
+ALL_FIELDS = '___all-fields___'
+
+
+def shard_of(key, shards):
+    """Stable shard of a key, the same in every process and every run"""
+    return partition(key, shards)
+
+
+def _make_state(state):
+    """The state of a worker: a copy of `state`, or the result of calling it"""
+    if callable(state):
+        return state()
+    return state
+
+
+class TimeWindowWorker(object):
+    """Sliding time window over the keys of one shard.  Events leaving the window
+    are kept in an `EvictionBuffer`.  Besides the timestamps of its own events, the
+    window of a worker advances with the watermark, the latest timestamp seen by
+    the consumer, which is updated after every batch."""
+    def __init__(self, state, add_func, remove_func, output_func, output_field,
+                 output_schema, window=10.0, key_by=None, date_field='date',
+                 init_func=None, batch_func=None, eviction_fields=None, schema=(),
+                 eviction_budget=64, eviction_dir=None, coalesce=False,
+                 coalesce_interval=100, coalesce_pending=1000):
+        if not isinstance(output_field, (list, tuple)):
+            output_field = [output_field]
+        self.state = state
+        self.add_func = add_func
+        self.remove_func = remove_func
+        self.init_func = init_func or add_func
+        self.output_func = output_func
+        self.batch_func = batch_func
+        self.output_field = output_field
+        self.output_schema = output_schema
+        self.window = window
+        fields = [field for field in output_schema if field not in output_field]
+        if key_by is not None:
+            fields.append(key_by)
+        fields.append(date_field)
+        fields.extend(schema if eviction_fields is None else eviction_fields)
+        self.fields = list(dict.fromkeys(fields))
+        self.eviction_budget = eviction_budget
+        self.eviction_dir = eviction_dir
+        self.coalesce = coalesce, coalesce_interval, coalesce_pending
+        self.buffer = None
+        self.coalescer = None
+        self.records = []
+
+    def start(self, shards):
+        """Set up the worker in its own process"""
+        self.state = _make_state(self.state)
+        self.buffer = EvictionBuffer(self.fields, self.eviction_budget * 2 ** 20 / shards,
+                                     self.eviction_dir)
+        coalesce, interval, pending = self.coalesce
+        if coalesce:
+            self.coalescer = OutputCoalescer(self.send, interval, pending)
+
+    def send(self, keys_changed):
+        state, output_func = self.state, self.output_func
+        for key, data in keys_changed.items():
+            output = output_func(state, key, data)
+            if output is not None:
+                self.records.append(output_record(output, data, self.output_field,
+                                                  self.output_schema))
+
+    def emit(self, keys_changed):
+        if self.coalescer is not None:
+            self.coalescer.add(keys_changed)
+        else:
+            self.send(keys_changed)
+
+    def process(self, events, watermark):
+        """Process a list of (key, timestamp, data) and returns the output records"""
+        state, buffer, window, batch_func = self.state, self.buffer, self.window, self.batch_func
+        added, removed, batch_changed = [], [], {}
+        for key, stamp, data in events:
+            if batch_func is not None:
+                added.append((key, data))
+            elif key in state:
+                self.add_func(state, key, data)
+            else:
+                self.init_func(state, key, data)
+            keys_changed = {key: data}
+            buffer.append(stamp, key, data)
+            for keyl, data in buffer.evict(stamp - window):
+                if batch_func is not None:
+                    removed.append((keyl, data))
+                else:
+                    self.remove_func(state, keyl, data)
+                keys_changed[keyl] = data
+            if batch_func is not None:
+                batch_changed.update(keys_changed)
+            else:
+                self.emit(keys_changed)
+        # The events of the other shards move the window too
+        keys_changed = {}
+        for keyl, data in buffer.evict(watermark - window):
+            if batch_func is not None:
+                removed.append((keyl, data))
+            else:
+                self.remove_func(state, keyl, data)
+            keys_changed[keyl] = data
+        if batch_func is not None:
+            batch_changed.update(keys_changed)
+            batch_func(state, added, removed)
+            keys_changed = batch_changed
+        if keys_changed:
+            self.emit(keys_changed)
+        records, self.records = self.records, []
+        return records
+
+    def wait(self):
+        """Seconds until the worker needs a `tick`, None if it never does"""
+        return None if self.coalescer is None else self.coalescer.wait()
+
+    def tick(self):
+        """Flush the coalesced outputs that are due and returns the output records"""
+        if self.coalescer is not None:
+            self.coalescer.tick()
+        records, self.records = self.records, []
+        return records
+
+    def finish(self):
+        """Flush what is still pending and returns the last output records"""
+        if self.coalescer is not None:
+            self.coalescer.flush()
+            self.coalescer.report()
+        if hasattr(self.state, 'flush'):
+            self.state.flush()
+        self.buffer.close()
+        records, self.records = self.records, []
+        return records
+
+
+class GlobalWindowWorker(object):
+    """Reduction over the whole stream for the keys of one shard"""
+    def __init__(self, state, reduce_func, output_func, output_field, output_schema,
+                 init_func=None):
+        if not isinstance(output_field, (list, tuple)):
+            output_field = [output_field]
+        self.state = state
+        self.reduce_func = reduce_func
+        self.init_func = init_func or reduce_func
+        self.output_func = output_func
+        self.output_field = output_field
+        self.output_schema = output_schema
+
+    def start(self, shards):
+        self.state = _make_state(self.state)
+
+    def process(self, events, watermark):
+        state, output_func, output_field = self.state, self.output_func, self.output_field
+        records = []
+        for key, _, data in events:
+            if key in state:
+                self.reduce_func(state, key, data)
+            else:
+                self.init_func(state, key, data)
+            output = output_func(state, key, data)
+            if output is None:
+                continue
+            records.append(output_record(output, data, output_field, self.output_schema))
+        return records
+
+    def wait(self):
+        return None
+
+    def tick(self):
+        return []
+
+    def finish(self):
+        if hasattr(self.state, 'flush'):
+            self.state.flush()
+        return []
+
+
+class WorkerError(RuntimeError):
+    """A worker process failed"""
+
+
+def _run_worker(worker, shards, inbox, outbox):
+    """Run a worker until it receives None.  An exception is sent to the main
+    process as ('error', traceback), and the worker always ends with None."""
+    try:
+        worker.start(shards)
+        while True:
+            try:
+                item = inbox.get(timeout=worker.wait())
+            except queue.Empty:
+                # Nothing arrived before the worker had outputs due
+                records = worker.tick()
+                if records:
+                    outbox.put(records)
+                continue
+            if item is None:
+                break
+            records = worker.process(*item)
+            if records:
+                outbox.put(records)
+        records = worker.finish()
+        if records:
+            outbox.put(records)
+    except BaseException:
+        outbox.put(('error', traceback.format_exc()))
+    finally:
+        outbox.put(None)
+
+
+class ShardedExecutor(object):
+    """Runs a worker in `workers` forked processes and routes events to them by key"""
+    def __init__(self, worker, workers=4, queue_size=64):
+        """Fork the worker processes.  This must happen before any Pulsar client
+        is created in this process.
+
+        Args:
+            worker:     A `TimeWindowWorker` or `GlobalWindowWorker`
+            workers:    Number of worker processes
+            queue_size: Maximum number of batches waiting for each worker"""
+        context = multiprocessing.get_context('fork')
+        self.workers = workers
+        self.inboxes = [context.Queue(queue_size) for _ in range(workers)]
+        self.outbox = context.Queue()
+        self.processes = [context.Process(target=_run_worker, daemon=True,
+                                          args=(worker, workers, inbox, self.outbox))
+                          for inbox in self.inboxes]
+        for process in self.processes:
+            process.start()
+        self.watermark = float('-inf')
+        self.outputs = 0
+        self.sender = None
+        self.error = None
+
+    def start(self, on_output):
+        """Start passing the output records of the workers to `on_output`"""
+        self.sender = threading.Thread(target=self._drain, args=(on_output,), daemon=True)
+        self.sender.start()
+
+    def _drain(self, on_output):
+        finished = 0
+        while finished < self.workers:
+            try:
+                records = self.outbox.get(timeout=1)
+            except queue.Empty:
+                # A worker killed without sending None
+                dead = sum(not process.is_alive() for process in self.processes)
+                if dead > finished and self.outbox.empty():
+                    if self.error is None:
+                        self.error = 'A worker process died'
+                    return
+                continue
+            if records is None:
+                finished += 1
+                continue
+            if isinstance(records, tuple) and records[0] == 'error':
+                logger.error('Worker failed:\n%s', records[1])
+                if self.error is None:
+                    self.error = records[1]
+                continue
+            try:
+                self.outputs += len(records)
+                on_output(records)
+            except Exception:
+                if self.error is None:
+                    self.error = traceback.format_exc()
+
+    def check(self):
+        """Raise `WorkerError` if a worker has failed"""
+        if self.error is not None:
+            raise WorkerError(self.error)
+
+    def dispatch(self, events):
+        """Route a batch of (key, timestamp, data) to the workers.  Raises
+        `WorkerError` once a worker has failed."""
+        self.check()
+        shards = [[] for _ in range(self.workers)]
+        workers = self.workers
+        watermark = self.watermark
+        for event in events:
+            shards[shard_of(event[0], workers)].append(event)
+            stamp = event[1]
+            if stamp is not None and stamp > watermark:
+                watermark = stamp
+        self.watermark = watermark
+        for inbox, shard, process in zip(self.inboxes, shards, self.processes):
+            self._put(inbox, process, (shard, watermark))
+
+    def _put(self, inbox, process, item):
+        """Put an item in the inbox of a worker, without blocking forever on a
+        worker that died"""
+        while True:
+            try:
+                inbox.put(item, timeout=1)
+                return
+            except queue.Full:
+                self.check()
+                if not process.is_alive():
+                    raise WorkerError('Worker process %d died' % process.pid)
+
+    def close(self):
+        """Wait for the workers to process everything and send their outputs.
+        Raises `WorkerError` if a worker failed."""
+        try:
+            for inbox, process in zip(self.inboxes, self.processes):
+                if process.is_alive():
+                    self._put(inbox, process, None)
+            if self.sender is not None:
+                self.sender.join()
+        finally:
+            for process in self.processes:
+                process.join(1)
+                if process.is_alive():
+                    process.terminate()
+        self.check()
+
+
+def _run_sharded(executor, OutModel, topic, schema, output_topic, key_by=None,
+                 date_field=None, date_format='%Y-%m-%d %H:%M:%S', name=None,
+                 timeout=None, broker='pulsar://localhost:6650', max_records=-1,
+                 batching=True, max_pending=5000, initial_position='latest',
+                 batch_size=100, batch_timeout=10, ack='cumulative',
+                 receiver_queue_size=1000):
+    """Consume the topic, route the messages to the workers and publish the outputs"""
+    client = pulsar.Client(broker)
+    Model = model_class_factory(**schema)
+    consumer = subscribe_batches(client, topic, name, pulsar.schema.AvroSchema(Model),
+                                 initial_position, receiver_queue_size=receiver_queue_size,
+                                 batch_size=batch_size, batch_timeout=batch_timeout,
+                                 ack=ack, timeout=timeout)
+    producer = client.create_producer(output_topic, block_if_queue_full=True,
+                                      batching_enabled=batching,
+                                      max_pending_messages=max_pending,
+                                      schema=pulsar.schema.AvroSchema(OutModel))
+    handler = CallbackHandler()
+
+    def publish(records):
+        for record in records:
+            producer.send_async(OutModel.from_dict(record), callback=handler.callback)
+    executor.start(publish)
+
+    t0 = time.time()
+    i = 0
+    try:
+        while i != max_records:
+            batch = consumer.receive(max_records - i if max_records > 0 else None)
+            if not batch:
+                if timeout is not None:
+                    t0 += timeout * 1e-3
+                break
+            events = []
+            for message in batch:
+                data = Model.decode_dict(message.data())
+                key = ALL_FIELDS if key_by is None else data[key_by]
+                stamp = None if date_field is None else \
+                    parse_timestamp(data[date_field], date_format)
+                events.append((key, stamp, data))
+            executor.dispatch(events)
+            consumer.acknowledge(batch)
+            i += len(batch)
+        executor.close()
+    except Exception:
+        # Stop the other workers, without acknowledging the batch that failed
+        for process in executor.processes:
+            process.terminate()
+        client.close()
+        raise
+    producer.flush()
+    logger.info('Total messages processed: %d by %d workers', i, executor.workers)
+    logger.info('Average processing rate: %.2f records/s', i/(time.time()-t0))
+    logger.info('Outputs published: %d  (%d dropped)', executor.outputs, handler.dropped)
+    client.close()
+
+
+def process_time_window_sharded(state, add_func, remove_func, topic, schema,
+                                output_topic, output_func, output_field, output_schema,
+                                workers=4, queue_size=64, init_func=None, batch_func=None,
+                                window=10.0, key_by=None, date_field='date',
+                                eviction_fields=None, eviction_budget=64, eviction_dir=None,
+                                coalesce=False, coalesce_interval=100, coalesce_pending=1000,
+                                **settings):
+    """Same as `time_window.process_time_window`, with the keys sharded over
+    `workers` processes.  The events leaving the window are always found with
+    an eviction buffer, and `eviction_budget` is shared by the workers."""
+    worker = TimeWindowWorker(state, add_func, remove_func, output_func, output_field,
+                              output_schema, window, key_by, date_field, init_func,
+                              batch_func, eviction_fields, schema, eviction_budget,
+                              eviction_dir, coalesce, coalesce_interval, coalesce_pending)
+    executor = ShardedExecutor(worker, workers, queue_size)
+    options = {name: settings[name] for name in _engine_settings if name in settings}
+    _run_sharded(executor, model_class_factory(**output_schema), topic, schema, output_topic,
+                 key_by=key_by, date_field=date_field, **options)
+
+
+def process_global_window_sharded(state, reduce_func, topic, schema, output_topic,
+                                  output_func, output_field, output_schema, workers=4,
+                                  queue_size=64, init_func=None, key_by=None, **settings):
+    """Same as `global_window.process_global_window`, with the keys sharded over
+    `workers` processes"""
+    worker = GlobalWindowWorker(state, reduce_func, output_func, output_field,
+                                output_schema, init_func)
+    executor = ShardedExecutor(worker, workers, queue_size)
+    options = {name: settings[name] for name in _engine_settings if name in settings}
+    _run_sharded(executor, model_class_factory(**output_schema), topic, schema, output_topic,
+                 key_by=key_by, **options)
+
+
+_engine_settings = ('date_format', 'name', 'timeout', 'broker', 'max_records', 'batching',
+                    'max_pending', 'initial_position', 'batch_size', 'batch_timeout', 'ack',
+                    'receiver_queue_size')
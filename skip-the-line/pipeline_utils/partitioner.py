@@ -0,0 +1,83 @@
+"""Stable key partitioning, shared by the producers and the hashing stages.
+
+Keys are hashed with a 64 bit BLAKE2b digest of their string form, which unlike
+the built-in `hash` is the same in every process and every run, and mapped to a
+partition with jump consistent hashing (Lamping and Veach, 2014).
+When the number of partitions changes from n to m, only the keys that have to
+move do so: going from n to n + 1 partitions moves about 1 / (n + 1) of the
+keys, all to the new partition.  `Partitioner.resize` reports which of the keys
+seen so far moved, so that only their window state has to be rebuilt.
+"""
+import hashlib
+from collections import Counter
+from functools import lru_cache
+
+
+@lru_cache(maxsize=1 << 18)
+def stable_hash(key):
+    """64 bit hash of the string form of a key, stable across processes"""
+    return int.from_bytes(hashlib.blake2b(str(key).encode('utf-8'), digest_size=8).digest(),
+                          'little')
+
+
+def jump_hash(key, buckets):
+    """Jump consistent hash of a 64 bit integer to one of `buckets` buckets"""
+    b, j = -1, 0
+    while j < buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xffffffffffffffff
+        j = int((b + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return b
+
+
+def partition(key, partitions):
+    """Partition of a key among `partitions` partitions"""
+    return jump_hash(stable_hash(key), partitions)
+
+
+class Partitioner(object):
+    """Routes keys to partitions and tracks the keys seen, to report the keys
+    moved by a change of the number of partitions"""
+    def __init__(self, partitions, track=True):
+        """Initialize the partitioner
+
+        Args:
+            partitions: Number of partitions
+            track:      Remember the keys routed, for `resize` to report the moves"""
+        if partitions <= 0:
+            raise ValueError('The number of partitions must be positive')
+        self.partitions = partitions
+        self.track = track
+        self.keys = {}          # key => partition
+
+    def __call__(self, key):
+        return self.partition(key)
+
+    def partition(self, key):
+        keys = self.keys
+        index = keys.get(key)
+        if index is None:
+            index = jump_hash(stable_hash(key), self.partitions)
+            if self.track:
+                keys[key] = index
+        return index
+
+    def resize(self, partitions):
+        """Change the number of partitions.  Returns the moved keys among the
+        keys seen so far, as a dict of key => (old partition, new partition)."""
+        if partitions <= 0:
+            raise ValueError('The number of partitions must be positive')
+        moved = {}
+        if partitions != self.partitions:
+            for key, old in self.keys.items():
+                new = jump_hash(stable_hash(key), partitions)
+                if new != old:
+                    moved[key] = (old, new)
+                    self.keys[key] = new
+            self.partitions = partitions
+        return moved
+
+
+def summarize_moves(moved):
+    """Number of moved keys for each (old partition, new partition)"""
+    return dict(Counter(moved.values()))
@@ -0,0 +1,221 @@
+"""In-process ranking state with the semantics of Redis sorted sets.
+
+`RankedSet` keeps (score, member) pairs in a list of sorted sublists with a
+Fenwick tree of the sublist lengths, so updates and ranks take O(log n).  Ties
+are ordered by member as in Redis, so `rank` and `revrank` return what ZRANK and
+ZREVRANK would.  `RankingState` partitions the members by group and can mirror
+the scores to Redis sorted sets in batches from a background thread, for the
+readers of the rankings.
+"""
+import logging
+import time
+from bisect import bisect_left, insort
+from concurrent.futures import ThreadPoolExecutor
+
+from redis import Redis
+
+
+logger = logging.getLogger(__name__)
+
+
+class RankedSet(object):
+    """Members ordered by score, then by member"""
+    load = 500      # Sublists are split once they reach twice this length
+
+    def __init__(self):
+        self.lists = []
+        self.maxes = []
+        self.tree = []
+        self.scores = {}
+
+    def __len__(self):
+        return len(self.scores)
+
+    def __contains__(self, member):
+        return member in self.scores
+
+    def score(self, member):
+        return self.scores.get(member)
+
+    def _build_tree(self):
+        tree = [len(items) for items in self.lists]
+        for i in range(len(tree)):
+            j = i | (i + 1)
+            if j < len(tree):
+                tree[j] += tree[i]
+        self.tree = tree
+
+    def _tree_add(self, i, n):
+        tree = self.tree
+        while i < len(tree):
+            tree[i] += n
+            i |= i + 1
+
+    def _tree_prefix(self, i):
+        """Number of members in the sublists before sublist `i`"""
+        tree = self.tree
+        total = 0
+        i -= 1
+        while i >= 0:
+            total += tree[i]
+            i = (i & (i + 1)) - 1
+        return total
+
+    def add(self, member, score):
+        """Set the score of a member, adding it if needed"""
+        score = float(score)
+        old = self.scores.get(member)
+        if old is not None:
+            if old == score:
+                return
+            self._remove((old, member))
+        self.scores[member] = score
+        item = (score, member)
+        lists, maxes = self.lists, self.maxes
+        if not lists:
+            lists.append([item])
+            maxes.append(item)
+            self._build_tree()
+            return
+        i = bisect_left(maxes, item)
+        if i == len(maxes):
+            i -= 1
+            lists[i].append(item)
+            maxes[i] = item
+        else:
+            insort(lists[i], item)
+        self._tree_add(i, 1)
+        if len(lists[i]) >= 2 * self.load:
+            items = lists[i]
+            lists[i:i + 1] = [items[:self.load], items[self.load:]]
+            maxes[i:i + 1] = [items[self.load - 1], items[-1]]
+            self._build_tree()
+
+    def _remove(self, item):
+        lists, maxes = self.lists, self.maxes
+        i = bisect_left(maxes, item)
+        items = lists[i]
+        del items[bisect_left(items, item)]
+        if items:
+            maxes[i] = items[-1]
+            self._tree_add(i, -1)
+        else:
+            del lists[i]
+            del maxes[i]
+            self._build_tree()
+
+    def remove(self, member):
+        score = self.scores.pop(member, None)
+        if score is not None:
+            self._remove((score, member))
+
+    def rank(self, member):
+        """0-based rank by increasing score, as ZRANK.  None if not a member."""
+        score = self.scores.get(member)
+        if score is None:
+            return None
+        item = (score, member)
+        i = bisect_left(self.maxes, item)
+        return self._tree_prefix(i) + bisect_left(self.lists[i], item)
+
+    def revrank(self, member):
+        """0-based rank by decreasing score, as ZREVRANK"""
+        rank = self.rank(member)
+        return None if rank is None else len(self.scores) - 1 - rank
+
+
+class RankingState(object):
+    """One `RankedSet` per group, optionally mirrored to Redis sorted sets named
+    after the groups.  Score updates are sent to Redis in one pipeline every
+    `flush_every` updates or `flush_interval` milliseconds, by a background thread
+    so that processing does not wait for Redis.
+
+    The members already in the sorted set of a group are loaded when the group
+    is first updated, so that the ranks keep matching ZRANK after a restart.
+    Loaded members are strings, as Redis returns them."""
+    def __init__(self, redis=None, flush_every=1000, flush_interval=100):
+        """Initialize the state
+
+        Args:
+            redis:          A `Redis` connection to mirror the rankings to, or None
+            flush_every:    Number of updates between writes to Redis
+            flush_interval: Maximum time in milliseconds between writes"""
+        self.groups = {}
+        self.members = {}       # member => number of groups ranking it
+        self.redis = redis
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval * 1e-3
+        self.pending = {}       # group => {member: score}
+        self.updates = 0
+        self.deadline = time.time() + self.flush_interval
+        self.writer = ThreadPoolExecutor(1) if redis is not None else None
+        self.last_write = None
+
+    @classmethod
+    def connect(cls, host, port=6379, db=0, **options):
+        return cls(Redis(host, port=port, db=db), **options)
+
+    def __len__(self):
+        return sum(len(ranked) for ranked in self.groups.values())
+
+    def __contains__(self, member):
+        return member in self.members
+
+    def _add(self, ranked, member, score):
+        if member not in ranked:
+            self.members[member] = self.members.get(member, 0) + 1
+        ranked.add(member, score)
+
+    def load(self, group):
+        """Create the ranking of a group from its sorted set in Redis"""
+        ranked = self.groups[group] = RankedSet()
+        if self.redis is not None:
+            for member, score in self.redis.zrange(group, 0, -1, withscores=True):
+                if isinstance(member, bytes):
+                    member = member.decode('utf-8')
+                self._add(ranked, member, score)
+        return ranked
+
+    def update(self, group, member, score):
+        """Set the score of a member in a group"""
+        ranked = self.groups.get(group)
+        if ranked is None:
+            ranked = self.load(group)
+        self._add(ranked, member, score)
+        if self.redis is not None:
+            self.pending.setdefault(group, {})[member] = score
+            self.updates += 1
+            if self.updates >= self.flush_every or time.time() >= self.deadline:
+                self.mirror()
+
+    def rank(self, group, member, reverse=False):
+        """0-based rank of a member in its group, None if it is not ranked"""
+        ranked = self.groups.get(group)
+        if ranked is None:
+            return None
+        return ranked.revrank(member) if reverse else ranked.rank(member)
+
+    def mirror(self):
+        """Hand the pending updates to the background writer"""
+        if self.pending:
+            pending, self.pending = self.pending, {}
+            self.last_write = self.writer.submit(self._write, pending)
+        self.updates = 0
+        self.deadline = time.time() + self.flush_interval
+
+    def _write(self, pending):
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            for group, scores in pending.items():
+                pipe.zadd(group, scores)
+            pipe.execute()
+        except Exception:
+            logger.exception('Mirroring %d groups to Redis failed', len(pending))
+
+    def flush(self):
+        """Mirror the pending updates and wait until Redis has them"""
+        if self.redis is None:
+            return
+        self.mirror()
+        if self.last_write is not None:
+            self.last_write.result()
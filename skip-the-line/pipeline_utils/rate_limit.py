@@ -0,0 +1,105 @@
+"""Token bucket pacing of a publication rate.
+
+Tokens accumulate at `rate` per second up to `burst`, and every message takes
+one.  When the bucket runs dry the tokens go into debt and the sender sleeps
+until the debt is paid back, so messages leave evenly spaced instead of in
+bursts followed by long pauses.  Waits shorter than `min_sleep` are carried
+over to the next message rather than slept, which keeps the overhead of pacing
+high rates well under a millisecond per message.
+"""
+import math
+import time
+
+
+class TokenBucket(object):
+    """Paces events to a maximum rate"""
+    def __init__(self, rate, burst=None, min_sleep=2e-4, clock=time.perf_counter,
+                 sleep=time.sleep):
+        """Initialize the bucket, full
+
+        Args:
+            rate:       Maximum rate in events per second, may be fractional
+            burst:      Maximum number of events sent back to back after a pause.
+                        Defaults to a millisecond worth of events, at least one,
+                        which absorbs the oversleeping of `sleep`.
+            min_sleep:  Shortest wait in seconds worth sleeping for
+            clock:      Monotonic clock in seconds
+            sleep:      Function sleeping a number of seconds"""
+        self.clock = clock
+        self.sleep = sleep
+        self.max_burst = burst
+        self.min_sleep = min_sleep
+        self.stamp = clock()
+        self.rate = None
+        self.tokens = 0.
+        self.set_rate(rate)
+        self.tokens = self.burst
+        self.reset_stats()
+
+    def set_rate(self, rate):
+        """Change the rate, effective from now on"""
+        rate = float(rate)
+        if not rate > 0 or math.isinf(rate):
+            raise ValueError('rate must be positive')
+        self._refill(self.clock())
+        self.rate = rate
+        self.burst = float(self.max_burst) if self.max_burst else max(1., rate * 1e-3)
+
+    def _refill(self, now):
+        if self.rate is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def wait_time(self, n=1):
+        """Seconds to wait before `n` events can be sent"""
+        now = self.clock()
+        tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        return max(0., (n - tokens) / self.rate)
+
+    def acquire(self, n=1, timeout=None):
+        """Wait until `n` events may be sent.  Returns False without taking the
+        tokens if that would take more than `timeout` seconds."""
+        now = self.clock()
+        self._refill(now)
+        self.tokens -= n
+        if self.tokens < 0:
+            wait = -self.tokens / self.rate
+            if timeout is not None and wait > timeout:
+                self.tokens += n
+                if timeout > 0:
+                    self.sleep(timeout)
+                return False
+            if wait >= self.min_sleep:
+                self.sleep(wait)
+                now = self.clock()
+        self._record(now, n)
+        return True
+
+    def reset_stats(self):
+        self.count = 0
+        self.first = 0          # Events sent at the start of the measurement
+        self.intervals = 0
+        self.started = self.last = None
+        self.deviation = 0.     # Sum of squared deviations from the target spacing
+
+    def _record(self, now, n):
+        if self.last is not None:
+            self.deviation += (now - self.last - n / self.rate) ** 2
+            self.intervals += 1
+        else:
+            self.started = now
+            self.first = n
+        self.last = now
+        self.count += n
+
+    def stats(self):
+        """Achieved and target rates in events per second, and the jitter, the
+        root mean square deviation in seconds of the spacing between events from
+        1 / rate"""
+        if not self.intervals:
+            return {'count': self.count, 'rate': 0., 'target': self.rate, 'jitter': 0.}
+        elapsed = self.last - self.started
+        return {'count': self.count,
+                'rate': (self.count - self.first) / elapsed if elapsed > 0 else float('inf'),
+                'target': self.rate,
+                'jitter': math.sqrt(self.deviation / self.intervals)}
@@ -0,0 +1,257 @@
+"""Write-back Redis state for the standalone streaming engines.
+
+`RedisState` has the same interface as `keyed_state.NumpyState`, so the worker
+functions of a script are the same whether the state lives in memory or in
+Redis.  Each column is a Redis hash with one field per key, or for one column,
+the top-level Redis keys themselves (`top_level`).  Increments are
+applied to a local cache, which serves the reads, and are sent to Redis in a
+single pipeline every `flush_every` updates or `flush_interval` milliseconds.
+
+The cache assumes this process is the only writer of the hashes.
+
+`AsyncRedisState` is the same state on a `redis.asyncio` connection for the
+asyncio engines, whose updates are coroutines that do not block the event loop.
+"""
+import logging
+import time
+
+from redis import Redis
+
+
+logger = logging.getLogger(__name__)
+
+
+class RedisState(object):
+    """Per-key numeric columns in Redis hashes, with a local write-back cache"""
+    def __init__(self, redis, columns=('count',), prefix='', flush_every=1000,
+                 flush_interval=100, integer_columns=('count',), top_level=None):
+        """Initialize the state
+
+        Args:
+            redis:          A `Redis` connection
+            columns:        Names of the quantities kept for each key
+            prefix:         Prefix of the Redis hash of each column
+            flush_every:    Number of updates between flushes to Redis
+            flush_interval: Maximum time in milliseconds between flushes
+            integer_columns:  Columns holding integers, the others are floats
+            top_level:      Column stored in the top-level Redis key `prefix + key`
+                            of each key, instead of in a hash"""
+        if top_level is not None and top_level not in columns:
+            raise ValueError('The top level column is not one of the columns')
+        self.redis = redis
+        self.columns = tuple(columns)
+        self.prefix = prefix
+        # None for the top level column
+        self.hashes = {column: None if column == top_level else prefix + column
+                       for column in columns}
+        self.integers = set(integer_columns) & set(columns)
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval * 1e-3
+        self.cache = {}             # key => list of column values
+        self.pending = {}           # (key, column) => increment not yet in Redis
+        self.updates = 0
+        self.deadline = time.time() + self.flush_interval
+        self.flushes = 0
+
+    @classmethod
+    def connect(cls, host, port=6379, db=0, **options):
+        return cls(Redis(host, port=port, db=db), **options)
+
+    def __len__(self):
+        return len(self.cache)
+
+    def __contains__(self, key):
+        return self._row(key) is not None
+
+    def _convert(self, column, value):
+        if value is None:
+            return 0 if column in self.integers else 0.
+        return int(value) if column in self.integers else float(value)
+
+    def _row(self, key):
+        """The cached values of a key, loaded from Redis on first use.  Returns
+        None for a key that does not exist in Redis yet."""
+        row = self.cache.get(key)
+        if row is None:
+            self.load([key])
+            row = self.cache.get(key)
+        return row
+
+    def _missing(self, keys):
+        return [key for key in dict.fromkeys(keys) if key not in self.cache]
+
+    def _read(self, missing):
+        """Pipeline reading the columns of the missing keys"""
+        pipe = self.redis.pipeline(transaction=False)
+        for key in missing:
+            for column in self.columns:
+                if self.hashes[column] is None:
+                    pipe.get(self.prefix + str(key))
+                else:
+                    pipe.hget(self.hashes[column], key)
+        return pipe
+
+    def _loaded(self, missing, values):
+        """Cache the values read by `_read`.  Keys not in Redis are left out."""
+        n = len(self.columns)
+        for i, key in enumerate(missing):
+            row = values[i * n:(i + 1) * n]
+            if any(value is not None for value in row):
+                self.cache[key] = [self._convert(column, value)
+                                   for column, value in zip(self.columns, row)]
+
+    def load(self, keys):
+        """Read the keys missing from the cache from Redis in one pipeline"""
+        missing = self._missing(keys)
+        if missing:
+            self._loaded(missing, self._read(missing).execute())
+
+    def _apply(self, key, values, sign):
+        """Update a key whose values were looked up in Redis already"""
+        row = self.cache.get(key)
+        if row is None:
+            row = self.cache[key] = [self._convert(column, None) for column in self.columns]
+        pending = self.pending
+        for i, column in enumerate(self.columns):
+            if column in values:
+                value = sign * values[column]
+                row[i] += value
+                pending[key, column] = pending.get((key, column), 0) + value
+        self.updates += 1
+
+    @staticmethod
+    def _columns(keys, values):
+        """Batch values as one sequence per column"""
+        return {column: value if hasattr(value, '__len__') else [value] * len(keys)
+                for column, value in values.items()}
+
+    def _update(self, key, values, sign):
+        if key not in self.cache:
+            self.load([key])
+        self._apply(key, values, sign)
+
+    def incr(self, key, column, value=1):
+        """Add `value` to a column of a key"""
+        self._update(key, {column: value}, 1)
+        self.step()
+
+    def add(self, key, values, sign=1):
+        """Add a dict of column values to a key, or subtract them if `sign` is -1"""
+        self._update(key, values, sign)
+        self.step()
+
+    def add_batch(self, keys, values, sign=1):
+        """Add the values of a batch of updates.  Values are sequences, one
+        value per update, or scalars added for every update."""
+        self.load(keys)
+        columns = self._columns(keys, values)
+        for i, key in enumerate(keys):
+            self._apply(key, {column: value[i] for column, value in columns.items()}, sign)
+        self.step()
+
+    def get(self, key, column):
+        """The value of a column for a key, zero for an unknown key"""
+        row = self._row(key)
+        if row is None:
+            return self._convert(column, None)
+        return row[self.columns.index(column)]
+
+    def _due(self):
+        return self.updates >= self.flush_every or time.time() >= self.deadline
+
+    def step(self):
+        """Flush when enough updates or time have accumulated"""
+        if self._due():
+            self.flush()
+
+    def _write(self):
+        """Pipeline sending the pending increments, None if there are none"""
+        if not self.pending:
+            return None
+        pipe = self.redis.pipeline(transaction=False)
+        for (key, column), value in self.pending.items():
+            name = self.hashes[column]
+            if name is None:
+                if column in self.integers:
+                    pipe.incrby(self.prefix + str(key), int(value))
+                else:
+                    pipe.incrbyfloat(self.prefix + str(key), float(value))
+            elif column in self.integers:
+                pipe.hincrby(name, key, int(value))
+            else:
+                pipe.hincrbyfloat(name, key, float(value))
+        self.pending = {}
+        self.flushes += 1
+        return pipe
+
+    def _restart(self):
+        self.updates = 0
+        self.deadline = time.time() + self.flush_interval
+
+    def flush(self):
+        """Send the pending increments to Redis in a single pipeline"""
+        pipe = self._write()
+        if pipe is not None:
+            pipe.execute()
+        self._restart()
+
+
+class AsyncRedisState(RedisState):
+    """`RedisState` for the asyncio engines, on a `redis.asyncio` connection.
+
+    Updates and `flush` are coroutines, so the event loop keeps receiving and
+    publishing while Redis answers.  Reads are served from the cache without
+    waiting: it holds every key updated by this process, which are the keys
+    the outputs are computed for.  Other keys read as zero and are not `in`
+    the state.  Requires redis-py 4.2 or later."""
+    @classmethod
+    def connect(cls, host, port=6379, db=0, **options):
+        from redis.asyncio import Redis as AsyncRedis
+        return cls(AsyncRedis(host=host, port=port, db=db), **options)
+
+    def __contains__(self, key):
+        return key in self.cache
+
+    async def load(self, keys):
+        """Read the keys missing from the cache from Redis in one pipeline"""
+        missing = self._missing(keys)
+        if missing:
+            self._loaded(missing, await self._read(missing).execute())
+
+    async def incr(self, key, column, value=1):
+        """Add `value` to a column of a key"""
+        await self.add(key, {column: value})
+
+    async def add(self, key, values, sign=1):
+        """Add a dict of column values to a key, or subtract them if `sign` is -1"""
+        if key not in self.cache:
+            await self.load([key])
+        self._apply(key, values, sign)
+        await self.step()
+
+    async def add_batch(self, keys, values, sign=1):
+        """Add the values of a batch of updates, see `RedisState.add_batch`"""
+        await self.load(keys)
+        columns = self._columns(keys, values)
+        for i, key in enumerate(keys):
+            self._apply(key, {column: value[i] for column, value in columns.items()}, sign)
+        await self.step()
+
+    def get(self, key, column):
+        """The cached value of a column for a key, zero for a key not cached"""
+        row = self.cache.get(key)
+        if row is None:
+            return self._convert(column, None)
+        return row[self.columns.index(column)]
+
+    async def step(self):
+        """Flush when enough updates or time have accumulated"""
+        if self._due():
+            await self.flush()
+
+    async def flush(self):
+        """Send the pending increments to Redis in a single pipeline"""
+        pipe = self._write()
+        if pipe is not None:
+            await pipe.execute()
+        self._restart()
@@ -0,0 +1,152 @@
+"""Binary replay files of pre-encoded Avro messages.
+
+A replay file holds the messages of a source file already encoded, so that a
+producer can publish them again and again without parsing or encoding:
+
+    header:   MAGIC, then the length (u32) and the JSON of
+              {"schema": ..., "key_by": ..., "timestamp": ...}
+    records:  payload length (u32), key length (u16), timestamp offset (i32),
+              the key in UTF-8 and the Avro payload
+    index:    offset (u64) of every `index_every`-th record
+    trailer:  number of records (u64), index_every (u32), offset of the index
+              (u64) and MAGIC
+
+The timestamp offset is the position in the payload of the 8 bytes of the
+`timestamp` field, -1 if there is none, so that the producer can stamp the
+messages with the time of publication without encoding them again.  Readers
+map the file in memory.
+"""
+import json
+import mmap
+import struct
+
+
+MAGIC = b'STLREPLAY1'
+
+_length = struct.Struct('<I')
+_record = struct.Struct('<IHi')
+_offset = struct.Struct('<Q')
+_trailer = struct.Struct('<QIQ')
+_double = struct.Struct('<d')
+
+# Timestamp written by the writer, to locate the field in the encoded payload
+STAMP_SENTINEL = 1.2345678987654321e-301
+_SENTINEL = _double.pack(STAMP_SENTINEL)
+
+
+def stamp_payload(payload, offset, stamp):
+    """Copy of a payload with its timestamp field set to `stamp`"""
+    payload = bytearray(payload)
+    _double.pack_into(payload, offset, stamp)
+    return bytes(payload)
+
+
+def find_stamp(payload):
+    """Offset of the timestamp of a payload encoded with `STAMP_SENTINEL`, or -1"""
+    return payload.rfind(_SENTINEL)
+
+
+class ReplayWriter(object):
+    """Writes a replay file"""
+    def __init__(self, path, schema, key_by=None, timestamp=None, index_every=1024):
+        """Open the file and write the header
+
+        Args:
+            path:       Path of the replay file
+            schema:     Schema definition of the messages
+            key_by:     Field of the partition key of the messages
+            timestamp:  Double field stamped with the time of publication, or None
+            index_every:  Number of records between two index entries"""
+        self.file = open(path, 'wb')
+        header = json.dumps({'schema': schema, 'key_by': key_by,
+                             'timestamp': timestamp}).encode('utf-8')
+        self.file.write(MAGIC + _length.pack(len(header)) + header)
+        self.offset = len(MAGIC) + _length.size + len(header)
+        self.index_every = index_every
+        self.index = []
+        self.count = 0
+        self.timestamp = timestamp
+
+    def write(self, key, payload):
+        """Append an encoded message.  If the file has a timestamp field, the
+        payload must have been encoded with `STAMP_SENTINEL` as the timestamp."""
+        key = b'' if key is None else str(key).encode('utf-8')
+        stamp = find_stamp(payload) if self.timestamp else -1
+        if self.count % self.index_every == 0:
+            self.index.append(self.offset)
+        record = _record.pack(len(payload), len(key), stamp) + key + payload
+        self.file.write(record)
+        self.offset += len(record)
+        self.count += 1
+
+    def close(self):
+        index_offset = self.offset
+        for offset in self.index:
+            self.file.write(_offset.pack(offset))
+        self.file.write(_trailer.pack(self.count, self.index_every, index_offset) + MAGIC)
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ReplayReader(object):
+    """Reads a replay file through a memory map"""
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        data = self.map
+        if data[:len(MAGIC)] != MAGIC or data[-len(MAGIC):] != MAGIC:
+            raise ValueError('Not a replay file: ' + str(path))
+        size = _length.unpack_from(data, len(MAGIC))[0]
+        start = len(MAGIC) + _length.size
+        header = json.loads(data[start:start + size].decode('utf-8'))
+        self.schema = header['schema']
+        self.key_by = header['key_by']
+        self.timestamp = header['timestamp']
+        self.start = start + size
+        self.count, self.index_every, self.end = _trailer.unpack_from(
+            data, len(data) - len(MAGIC) - _trailer.size)
+        self.index = [_offset.unpack_from(data, self.end + i * _offset.size)[0]
+                      for i in range((self.count + self.index_every - 1) // self.index_every)]
+
+    def __len__(self):
+        return self.count
+
+    def offset_of(self, record):
+        """Offset in the file of a record, found from the index"""
+        if record >= self.count:
+            return self.end
+        offset = self.index[record // self.index_every]
+        for _ in range(record % self.index_every):
+            payload_size, key_size, _ = _record.unpack_from(self.map, offset)
+            offset += _record.size + key_size + payload_size
+        return offset
+
+    def records(self, offset=None):
+        """Yield (size, (key, payload, timestamp offset)) for the records from
+        a file offset, by default from the first one.  `size` is the size of
+        the record in the file."""
+        data, end, unpack = self.map, self.end, _record.unpack_from
+        header = _record.size
+        offset = self.start if offset is None else max(offset, self.start)
+        while offset < end:
+            payload_size, key_size, stamp = unpack(data, offset)
+            key_end = offset + header + key_size
+            size = header + key_size + payload_size
+            key = data[offset + header:key_end].decode('utf-8') if key_size else None
+            yield size, (key, data[key_end:offset + size], stamp)
+            offset += size
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
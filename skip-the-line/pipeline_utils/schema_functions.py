@@ -1,12 +1,22 @@
 """Slightly enriched Pulsar Functions that handles serialization and deserialization
 based on schema provided in user config.  Also allow the user to directly write
 a kernel using the user configurations and give them defaults more easily."""
+import threading
+import time
 import uuid
 from abc import abstractmethod
 
+import pulsar
 from pulsar import Function
 
 from .schema_model import model_class_factory
+from .metrics import StageProfiler, format_stage_summary
+from .snapshot import Checkpointer, FileSnapshotStore, FunctionStateSnapshotStore
+
+
+def message_position(message_id):
+    """Sortable position of a message id in its topic"""
+    return message_id.ledger_id(), message_id.entry_id(), message_id.batch_index()
 
 
 class SchemaFunction(Function):
@@ -17,12 +27,134 @@ class SchemaFunction(Function):
     Any field not in output will be cloned from input object
 
     Also provide an evaluation `counter` and a unique `name` for each instance.
+
+    Micro-batching is enabled by setting `batch_size` in the user config.  Messages
+    are then buffered until `batch_size` messages are pending or the oldest one has
+    waited `batch_timeout` milliseconds, and the whole batch goes through a single
+    `kernel_batch` call.  Outputs are published to the output topic of the function,
+    so micro-batching requires an `output_schema`.
+    A background thread flushes the batch when the deadline passes on a quiet topic.
+    Buffered messages are acknowledged with `context.ack` once their output is
+    published, or once the kernel ran if they have none, so the function must be
+    deployed with `autoAck: false` for at-least-once delivery.
+
+    Setting `stage_metrics_sample` to a fraction of messages turns on latency
+    histograms of the decode, kernel, encode and total stages.  Every
+    `stage_metrics_period` seconds counts and p50/p90/p99 of each stage are
+    recorded as metrics of the function, and also published as a compact string
+    to `stage_metrics_topic` if it is given.
+
+    Functions that keep their state in `self.state` as a `window_state.KeyedState`
+    can checkpoint it, to a local file with `snapshot_path` or to the Pulsar
+    Functions state store with `snapshot_state: yes`.  A checkpoint is taken every
+    `snapshot_interval` messages or `snapshot_period` seconds, and the latest one is
+    restored on startup.  If `snapshot_replay` is set to a broker URL, the messages
+    between the snapshot and the first message received are read back from the
+    input topic and replayed through the kernel.
     """
     def __init__(self, *args, **kwargs):
         """Initialize the counter and create the name field"""
         super().__init__(*args, **kwargs)
         self.counter = 0
         self.name = uuid.uuid4()
+        self._settings = None
+        self.profiler = None
+        self.metrics_topic = None
+        self.checkpointer = None
+        self._replay = None
+        self._batch = []            # (input, message id, topic)
+        self._batch_start = None
+        self._batch_lock = threading.Lock()
+        self._ticker = None
+        self._flushes = 0
+
+    def setup(self, context):
+        """Parse the user config.  This is done once per instance.
+
+        Returns:
+            input record class, output record class (or None), kernel config,
+            batch size and batch timeout in seconds"""
+        if self._settings is None:
+            config = dict(context.user_config)
+            schema = config.pop('schema', None)
+            output_schema = config.pop('output_schema', None)
+            batch_size = config.pop('batch_size', 0)
+            batch_timeout = config.pop('batch_timeout', 100)
+            sample = config.pop('stage_metrics_sample', 0)
+            period = config.pop('stage_metrics_period', 10)
+            self.metrics_topic = config.pop('stage_metrics_topic', None)
+            if sample:
+                self.profiler = StageProfiler(sample, period)
+            snapshot_path = config.pop('snapshot_path', None)
+            snapshot_state = config.pop('snapshot_state', False)
+            snapshot_interval = config.pop('snapshot_interval', 10000)
+            snapshot_period = config.pop('snapshot_period', 60)
+            snapshot_compact = config.pop('snapshot_compact', 50)
+            snapshot_replay = config.pop('snapshot_replay', None)
+            if not schema:
+                raise ValueError('Schema not found in user config')
+            if batch_size > 1 and not output_schema:
+                # Batched outputs are published directly, which needs encoded payloads
+                raise ValueError('Micro-batching requires an output_schema in user config')
+            RecordClass = model_class_factory(**schema)
+            ResultClass = model_class_factory(**output_schema) if output_schema else None
+            self.init_state(**config)
+
+            if snapshot_path or snapshot_state:
+                if snapshot_path:
+                    store = FileSnapshotStore(snapshot_path)
+                else:
+                    store = FunctionStateSnapshotStore(context)
+                self.checkpointer = Checkpointer(store, snapshot_interval, snapshot_period,
+                                                 snapshot_compact)
+                position = self.checkpointer.restore(self.state)
+                if position is not None and snapshot_replay:
+                    self._replay = snapshot_replay, position
+            self._settings = (RecordClass, ResultClass, config, batch_size, batch_timeout * 1e-3)
+        return self._settings
+
+    def init_state(self, **config):
+        """Create `self.state` from the kernel config before any message is processed.
+        Override this in functions whose state is checkpointed."""
+        pass
+
+    def checkpoint(self, context, messages=1, message_id=None):
+        """Count messages towards the next checkpoint of the state.  The position
+        is `message_id`, by default the id of the current message."""
+        if self.checkpointer is not None:
+            self.checkpointer.step(self.state, lambda: (
+                message_id or context.get_message_id()).serialize(), messages)
+
+    def open_replay_reader(self, broker, topic, position):
+        """Client and reader of the input topic from the message after `position`,
+        a serialized message id"""
+        client = pulsar.Client(broker)
+        return client, client.create_reader(topic, pulsar.MessageId.deserialize(position))
+
+    def replay(self, context):
+        """Run the kernel, without emitting outputs, over the messages between the
+        restored snapshot and the current message"""
+        RecordClass, _, config, _, _ = self.setup(context)
+        broker, position = self._replay
+        self._replay = None
+        # Stop at the first message at or past the current one, which may not be
+        # read back with the same id, e.g. with another batch index
+        current = message_position(context.get_message_id())
+        t0 = time.time()
+        n = 0
+        client, reader = self.open_replay_reader(
+            broker, context.get_current_message_topic_name(), position)
+        try:
+            while reader.has_message_available():
+                message = reader.read_next()
+                if message_position(message.message_id()) >= current:
+                    break
+                self.kernel(RecordClass.decode_dict(message.data()), context, **config)
+                n += 1
+        finally:
+            client.close()
+        context.get_logger().info('Replayed %d messages after the snapshot in %.3fs',
+                                  n, time.time() - t0)
 
     def process(self, input, context):
         """Process the customer count and compute its maximum over a window
@@ -33,34 +165,156 @@ class SchemaFunction(Function):
         If the output schema is missing, the results will be returned to
         Pulsar without additional treatment.
         """
-        config = dict(context.user_config)
-        schema = config.pop('schema', None)
-        output_schema = config.pop('output_schema', None)
-        if schema:
-            # Parse input message Schema
-            RecordClass = model_class_factory(**schema)
-            record = RecordClass.decode(input)
-        else:
-            raise ValueError('Schema not found in user config')
+        RecordClass, ResultClass, config, batch_size, batch_timeout = self.setup(context)
+        if self._replay is not None:
+            self.replay(context)
+        if batch_size > 1:
+            with self._batch_lock:
+                self._batch.append((input, context.get_message_id(),
+                                    context.get_current_message_topic_name()))
+                t = time.time()
+                if self._batch_start is None:
+                    self._batch_start = t
+                if len(self._batch) >= batch_size or t - self._batch_start >= batch_timeout:
+                    self.flush(context)
+            if self._ticker is None:
+                self._ticker = threading.Thread(target=self._tick, args=(context, batch_timeout),
+                                                daemon=True)
+                self._ticker.start()
+            return
+
+        if self.profiler is not None and self.profiler.sampled(self.counter):
+            return self.process_timed(input, context)
 
-        result = self.kernel(record.__dict__, context, **config)
+        # Parse input message Schema
+        record = RecordClass.decode_dict(input)
+        result = self.kernel(record, context, **config)
         self.counter += 1
+        if self.checkpointer is not None:
+            self.checkpoint(context)
         if not result:
             return
 
         # Output does not have a schema
-        if not output_schema:
+        if not ResultClass:
             return result
 
         # Encode the output message based on the proper schema and send it out
-        ResultClass = model_class_factory(**output_schema)
-        output = ResultClass.clone_from(record)
-        for key, value in result.items():
-            setattr(output, key, value)
-        return output.encode()
+        return self.encode_output(ResultClass, record, result)
+
+    def process_timed(self, input, context):
+        """Same as the unbatched `process` but records the time spent in each stage"""
+        RecordClass, ResultClass, config, _, _ = self.setup(context)
+        profiler = self.profiler
+        t0 = time.perf_counter()
+        record = RecordClass.decode_dict(input)
+        t1 = time.perf_counter()
+        result = self.kernel(record, context, **config)
+        self.counter += 1
+        self.checkpoint(context)
+        t2 = time.perf_counter()
+        if result and ResultClass:
+            result = self.encode_output(ResultClass, record, result)
+        t3 = time.perf_counter()
+        profiler.record('decode', t1 - t0)
+        profiler.record('kernel', t2 - t1)
+        if result and ResultClass:
+            profiler.record('encode', t3 - t2)
+        profiler.record('total', t3 - t0)
+        if profiler.due():
+            self.report_stages(context)
+        return result or None
+
+    def _tick(self, context, batch_timeout):
+        """Flush the batch of a quiet topic once its deadline has passed"""
+        while True:
+            with self._batch_lock:
+                start = self._batch_start
+                if start is not None and time.time() - start >= batch_timeout:
+                    try:
+                        self.flush(context)
+                    except Exception:
+                        context.get_logger().exception('Flushing a batch failed')
+                    start = None
+            wait = batch_timeout if start is None else start + batch_timeout - time.time()
+            time.sleep(max(wait, 1e-3))
 
+    @staticmethod
+    def _acknowledger(context, message_id, topic):
+        """Callback of the publication of an output, acknowledging its input"""
+        def callback(result, _):
+            if result == pulsar.Result.Ok:
+                context.ack(message_id, topic)
+            else:
+                context.get_logger().error('Publishing the output of %s failed: %s',
+                                           message_id, result)
+        return callback
+
+    def flush(self, context):
+        """Run the kernel over the buffered messages, publish the outputs and
+        acknowledge the messages.  Called with the batch lock held."""
+        RecordClass, ResultClass, config, _, _ = self.setup(context)
+        batch, self._batch = self._batch, []
+        self._batch_start = None
+        if not batch:
+            return
+        profiler = self.profiler
+        timed = profiler is not None and profiler.sampled(self._flushes)
+        self._flushes += 1
+        t0 = time.perf_counter()
+        records = [RecordClass.decode_dict(raw) for raw, _, _ in batch]
+        t1 = time.perf_counter()
+        results = self.kernel_batch(records, context, **config)
+        # The current message may be past the batch when the ticker flushes it
+        self.checkpoint(context, len(records), batch[-1][1])
+        t2 = time.perf_counter()
+
+        topic = context.get_output_topic()
+        for record, result, (_, message_id, input_topic) in zip(records, results, batch):
+            if not (result and topic):
+                context.ack(message_id, input_topic)
+                continue
+            result = self.encode_output(ResultClass, record, result)
+            context.publish(topic, result, callback=self._acknowledger(
+                context, message_id, input_topic))
+        if timed:
+            # Batches are timed as a whole and recorded as the cost per message
+            n = len(records)
+            t3 = time.perf_counter()
+            profiler.record('decode', (t1 - t0) / n)
+            profiler.record('kernel', (t2 - t1) / n)
+            profiler.record('encode', (t3 - t2) / n)
+            profiler.record('total', (t3 - t0) / n)
+            if profiler.due():
+                self.report_stages(context)
+
+    def report_stages(self, context):
+        """Record the stage latency summary as metrics and publish it to the metric topic"""
+        summary = self.profiler.summarize()
+        for stage, (count, *quantiles) in summary.items():
+            for q, value in zip(self.profiler.quantiles, quantiles):
+                context.record_metric('{}_p{:g}_ms'.format(stage, q * 100), value * 1e3)
+        if self.metrics_topic and summary:
+            context.publish(self.metrics_topic, format_stage_summary(self.name, summary))
+
+    @staticmethod
+    def encode_output(ResultClass, record, result):
+        """Encode the input fields updated by the kernel result"""
+        output = dict(record)
+        output.update(result)
+        return ResultClass.encode_dict(output)
 
     @abstractmethod
     def kernel(self, input, context, **config):
         """Process input message"""
         pass
+
+    def kernel_batch(self, records, context, **config):
+        """Process a list of input messages and return a list of results, one for
+        each of the messages.  Override this for a faster batched computation.
+        Like `process`, it must advance `self.counter` once per message."""
+        results = []
+        for record in records:
+            results.append(self.kernel(record, context, **config))
+            self.counter += 1
+        return results
@@ -1,3 +1,6 @@
+import os
+from collections import OrderedDict, namedtuple
+
 from pulsar import schema
 
 
@@ -12,6 +15,50 @@ type_map = {
     'Array': schema.Array,
     'Map': schema.Map
 }
+
+# Model classes are cached process wide so that identical schema definitions share
+# one class and one prebuilt codec instead of rebuilding them for every message.
+MODEL_CACHE_SIZE = 256
+
+# Which codec the model classes use: `pulsar` for the generic pulsar.schema.AvroSchema
+# or `compiled` for the schema specialized codec in `avro_codec`.
+CODEC_ENGINE = os.environ.get('PIPELINE_UTILS_CODEC', 'pulsar')
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+_model_cache = OrderedDict()
+_cache_stats = {'hits': 0, 'misses': 0}
+
+
+def _definition_key(definition):
+    """Hashable key of a schema definition.  Field order is kept because it
+    determines the order of the fields in the Avro schema."""
+    return tuple((name, tuple(value) if isinstance(value, (list, tuple)) else value)
+                 for name, value in definition.items())
+
+
+def model_cache_info():
+    """Report hits, misses, maximum and current size of the model class cache"""
+    return CacheInfo(_cache_stats['hits'], _cache_stats['misses'],
+                     MODEL_CACHE_SIZE, len(_model_cache))
+
+
+def clear_model_cache():
+    """Empty the model class cache and reset its counters"""
+    _model_cache.clear()
+    _cache_stats['hits'] = _cache_stats['misses'] = 0
+
+
+def set_codec_engine(engine):
+    """Select the codec engine, `pulsar` or `compiled`, of the model classes
+    created from now on.  Cached classes are discarded."""
+    global CODEC_ENGINE
+    if engine not in ('pulsar', 'compiled'):
+        raise ValueError('Codec engine must be pulsar or compiled.')
+    CODEC_ENGINE = engine
+    clear_model_cache()
+
+
 def model_class_factory(**definition):
     """Given a schema definition, returns the model class of that schema
 
@@ -43,9 +90,35 @@ def model_class_factory(**definition):
 
     It does not support Enum or subRecord classes at the moment.
 
-    technically a metaclass but we don't want to get into that.
+    Identical definitions return the same class, which holds a prebuilt codec.
+    The `MODEL_CACHE_SIZE` most recently used classes are kept, see
+    `model_cache_info()` for the cache statistics.  The codec engine is chosen
+    with `set_codec_engine()` or the PIPELINE_UTILS_CODEC environment variable.
     """
+    cache_key = _definition_key(definition)
+    try:
+        model = _model_cache[cache_key]
+    except KeyError:
+        _cache_stats['misses'] += 1
+    else:
+        _cache_stats['hits'] += 1
+        _model_cache.move_to_end(cache_key)
+        return model
+
+    model = _build_model_class(definition)
+    _model_cache[cache_key] = model
+    while len(_model_cache) > MODEL_CACHE_SIZE:
+        _model_cache.popitem(last=False)
+    return model
+
+
+def _build_model_class(definition):
+    """Create the model class of a schema definition.  See `model_class_factory`"""
     class RecordModel(schema.Record):
+        # Fields in name order, the layout of the 2.x clients the configs were written
+        # for, so that a producer and a consumer listing the same fields in another
+        # order (e.g. checkin.yml and print_checkin.yml) still agree on the wire
+        _sorted_fields = True
         env = locals()
         key = value = None
         for key, value in definition.items():
@@ -73,15 +146,48 @@ def model_class_factory(**definition):
         def decode(cls, raw):
             """Decode a row binary string to an RecordModel object"""
             if isinstance(raw, bytes):
-                return schema.AvroSchema(cls).decode(raw)
-            return schema.AvroSchema(cls).decode(raw.encode('utf-8'))
+                return cls._codec.decode(raw)
+            return cls._codec.decode(raw.encode('utf-8'))
 
         def encode(self):
-            return schema.AvroSchema(type(self)).encode(self)
+            return self._codec.encode(self)
 
         @classmethod
-        def avro_schema(cls):
-            return schema.AvroSchema(cls)
+        def decode_dict(cls, raw):
+            """Decode a binary string directly into a dict of field values"""
+            if cls._codec_engine == 'compiled':
+                return cls._codec.decode_dict(raw)
+            return {key: value for key, value in cls.decode(raw).__dict__.items()
+                    if key in definition}
 
-    return RecordModel
+        @classmethod
+        def encode_dict(cls, data):
+            """Encode a dict of field values.  Unknown keys are ignored."""
+            if cls._codec_engine == 'compiled':
+                return cls._codec.encode_dict(data)
+            return cls.from_dict(data).encode()
+
+        @classmethod
+        def decode_many(cls, raws):
+            """Decode a list of binary strings into a columnar `RecordBatch`.
+            Requires NumPy."""
+            from .columnar import RecordBatch
+            return RecordBatch.from_dicts([cls.decode_dict(raw) for raw in raws], definition)
+
+        @classmethod
+        def encode_many(cls, batch):
+            """Encode every record of a `RecordBatch` into a list of binary strings"""
+            return [cls.encode_dict(row) for row in batch.rows()]
 
+        @classmethod
+        def avro_schema(cls):
+            return cls._codec
+
+    # Built once per class and shared by every encode and decode
+    RecordModel._codec_engine = CODEC_ENGINE
+    if CODEC_ENGINE == 'compiled':
+        from .avro_codec import CompiledAvroSchema
+        RecordModel._codec = CompiledAvroSchema(RecordModel)
+    else:
+        RecordModel._codec = schema.AvroSchema(RecordModel)
+    return RecordModel
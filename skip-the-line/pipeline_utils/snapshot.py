@@ -0,0 +1,139 @@
+"""Periodic incremental checkpoints of keyed state, for a fast warm restart.
+
+A snapshot is a log of frames.  The first frame is a full dump of the state and
+the following ones only contain the keys changed since the previous frame.  Once
+enough incremental frames have accumulated, the log is compacted into a single
+full frame.  Each frame also records the position in the input stream, so that
+only the messages after it have to be replayed after a restart.
+
+The state must follow the `window_state.KeyedState` interface.
+"""
+import logging
+import os
+import pickle
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class FileSnapshotStore(object):
+    """Snapshot frames appended to a local file"""
+    def __init__(self, path):
+        self.path = path
+
+    def read_frames(self):
+        frames = []
+        if not os.path.exists(self.path):
+            return frames
+        with open(self.path, 'rb') as f:
+            while True:
+                try:
+                    frames.append(pickle.load(f))
+                except EOFError:
+                    break
+                except (pickle.UnpicklingError, ValueError):
+                    # A frame cut short by a crash.  Everything before it is valid.
+                    logger.warning('Truncated snapshot frame in %s ignored', self.path)
+                    break
+        return frames
+
+    def append_frame(self, frame):
+        with open(self.path, 'ab') as f:
+            pickle.dump(frame, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def replace_frames(self, frame):
+        """Atomically replace the whole log with a single frame"""
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump(frame, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+
+class FunctionStateSnapshotStore(object):
+    """Snapshot frames kept in the Pulsar Functions state store, one state entry
+    per frame plus one entry with the number of frames"""
+    def __init__(self, context, prefix='snapshot'):
+        self.context = context
+        self.prefix = prefix
+
+    def _frame_count(self):
+        count = self.context.get_state(self.prefix + ':frames')
+        return int(count) if count else 0
+
+    def read_frames(self):
+        return [pickle.loads(self.context.get_state('{}:{}'.format(self.prefix, i)))
+                for i in range(self._frame_count())]
+
+    def append_frame(self, frame):
+        count = self._frame_count()
+        self.context.put_state('{}:{}'.format(self.prefix, count),
+                               pickle.dumps(frame, protocol=pickle.HIGHEST_PROTOCOL))
+        self.context.put_state(self.prefix + ':frames', str(count + 1).encode())
+
+    def replace_frames(self, frame):
+        self.context.put_state(self.prefix + ':0',
+                               pickle.dumps(frame, protocol=pickle.HIGHEST_PROTOCOL))
+        self.context.put_state(self.prefix + ':frames', b'1')
+
+
+class Checkpointer(object):
+    """Checkpoints a keyed state every `interval` messages or `period` seconds"""
+    def __init__(self, store, interval=10000, period=60., compact_every=50):
+        """Initialize the checkpointer
+
+        Args:
+            store:      A snapshot store, e.g. `FileSnapshotStore`
+            interval:   Number of messages between checkpoints
+            period:     Maximum number of seconds between checkpoints
+            compact_every:  Number of incremental frames after which the log is
+                        compacted into a single full snapshot"""
+        self.store = store
+        self.interval = interval
+        self.period = period
+        self.compact_every = compact_every
+        self.pending = 0
+        self.frames = 0
+        self.deadline = time.time() + period
+
+    def restore(self, state):
+        """Load the latest snapshot into `state` and start tracking its changes.
+        Returns the position of the snapshot, or None if there is no snapshot."""
+        t0 = time.time()
+        frames = self.store.read_frames()
+        position = None
+        # Later frames override earlier ones, so merge them before loading
+        entries = {}
+        for frame in frames:
+            position = frame['position']
+            entries.update(frame['entries'])
+        state.restore(entries)
+        self.frames = len(frames)
+        state.track_changes()
+        if frames:
+            logger.info('Restored %d keys from %d snapshot frames in %.3fs', len(state),
+                        len(frames), time.time() - t0)
+        return position
+
+    def step(self, state, get_position, messages=1):
+        """Count processed messages and checkpoint when one is due.  `get_position`
+        returns a picklable position in the input stream after these messages.
+        It is only called when a checkpoint is taken."""
+        self.pending += messages
+        if self.pending >= self.interval or time.time() >= self.deadline:
+            self.checkpoint(state, get_position())
+
+    def checkpoint(self, state, position):
+        if self.frames == 0 or self.frames >= self.compact_every:
+            self.store.replace_frames({'position': position, 'entries': state.snapshot()})
+            self.frames = 1
+        else:
+            self.store.append_frame({'position': position,
+                                     'entries': state.snapshot(changed_only=True)})
+            self.frames += 1
+        self.pending = 0
+        self.deadline = time.time() + self.period
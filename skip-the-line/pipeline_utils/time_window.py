@@ -1,15 +1,33 @@
 """compute in a continuous event triggered sliding window"""
 import logging
 import time
-import datetime
 
 import pulsar
 
 from .schema_model import model_class_factory
 from .callback import CallbackHandler
+from .coalesce import OutputCoalescer
+from .consume import subscribe_batches
+from .eviction import EvictionBuffer
+from .timestamps import parse_timestamp
 
 
 logger = logging.getLogger(__name__)
+
+
+def output_record(output, data, output_field, output_schema):
+    """The output message of a key, from the result of `output_func` and the
+    input fields copied to the output.  With a single output field the whole
+    result goes to that field, even a list."""
+    if len(output_field) == 1:
+        output = [output]
+    elif len(output) != len(output_field):
+        raise ValueError('Expected {} output values for {}, got {}'.format(
+            len(output_field), ', '.join(output_field), len(output)))
+    output_dict = {key: value for key, value in zip(output_field, output)}
+    return {field: output_dict[field] if field in output_field else data[field]
+            for field in output_schema}
+
     
 def process_time_window(state, add_func, remove_func, topic, schema,
                         output_topic, output_func, output_field, output_schema,
@@ -17,24 +35,44 @@ def process_time_window(state, add_func, remove_func, topic, schema,
                         window=10.0, key_by=None, name=None, timeout=None,
                         broker='pulsar://localhost:6650', max_records=-1,
                         date_field='date', date_format='%Y-%m-%d %H:%M:%S',
-                        initial_position='latest', **settings):
+                        initial_position='latest', eviction='reader',
+                        eviction_fields=None, eviction_budget=64, eviction_dir=None,
+                        batch_size=100, batch_timeout=10, ack='cumulative',
+                        receiver_queue_size=1000, batch_func=None, coalesce=False,
+                        coalesce_interval=100, coalesce_pending=1000, **settings):
     """Update the state correspond to an event stream for a continuously
     sliding time window.
+
+    The events leaving the window are found by one of two `eviction` modes:
+        reader:  A second reader on the input topic reads every message again.
+                 Works for windows of any size.
+        buffer:  The key, timestamp and `eviction_fields` of the events in the
+                 window are kept in an `EvictionBuffer`, so each message is only
+                 read and decoded once.  `eviction_fields` are the fields needed
+                 by `remove_func`, all input fields by default.  The fields copied
+                 to the output are always kept.  Past `eviction_budget` MB the
+                 events are spilled to files in `eviction_dir`.
+
+    Messages are received in batches, see `consume.BatchConsumer` for
+    `batch_size`, `batch_timeout`, `ack` and `receiver_queue_size`.
+
+    If `batch_func(state, added, removed)` is given, it replaces `add_func` and
+    `remove_func`, and is called once per batch of messages with the lists of
+    (key, data) of the events entering and leaving the window.  This lets the
+    state apply the whole batch at once, e.g. `keyed_state.NumpyState`.  The
+    outputs are then sent once per batch for each key changed by the batch.
+
+    With `coalesce`, only the latest output of each changed key is sent, every
+    `coalesce_interval` milliseconds or when `coalesce_pending` keys are waiting.
     """
     client = pulsar.Client(broker)
     Model = model_class_factory(**schema)
     avro_schema = pulsar.schema.AvroSchema(Model)
 
-    if initial_position == 'earliest':
-        position = pulsar.InitialPosition.Earliest
-    elif initial_position == 'latest':
-        position = pulsar.InitialPosition.Lastest
-    else:
-        raise ValueError('Initial position must be latest or earliest.')
-
-    consumer = client.subscribe(topic, initial_position=position,
-                                subscription_name=name,
-                                schema=avro_schema)
+    consumer = subscribe_batches(client, topic, name, avro_schema, initial_position,
+                                 receiver_queue_size=receiver_queue_size,
+                                 batch_size=batch_size, batch_timeout=batch_timeout,
+                                 ack=ack, timeout=timeout)
     reader = None
     if key_by is not None and key_by not in schema or date_field not in schema:
         logger.info('key_by:     %s', key_by)
@@ -63,62 +101,126 @@ def process_time_window(state, add_func, remove_func, topic, schema,
     if init_func is None:
         init_func = add_func
 
+    buffer = None
+    if eviction == 'buffer':
+        fields = [field for field in output_schema if field not in output_field]
+        if key_by is not None:
+            fields.append(key_by)
+        fields.append(date_field)
+        fields.extend(schema if eviction_fields is None else eviction_fields)
+        buffer = EvictionBuffer(list(dict.fromkeys(fields)), eviction_budget * 2 ** 20,
+                                eviction_dir)
+    elif eviction != 'reader':
+        raise ValueError('Eviction mode must be reader or buffer.')
+
     t0 = time.time()
     i = 0
     handler = CallbackHandler()
     wall0 = wall1 = wall2 = wall3 = 0
-    while i != max_records:
-        tt0 = time.time()
-        try:
-            message = consumer.receive(timeout)
-        except Exception as e:
-            logger.info('Consumer has been depleted.  Message %s', str(e))
-            t0 += timeout * 1e-3
-            break
-        data = message.value().__dict__
-        consumer.acknowledge(message)
-        i += 1
-        key = "___all-fields___" if key_by is None else data[key_by]
-        t_right = datetime.datetime.strptime(data[date_field], date_format).timestamp()
-        # First time a key is encountered
-        if reader is None:
-            reader = client.create_reader(topic, schema=avro_schema,
-                                          start_message_id=message.message_id())
-            t_left = t_right
-        tt1 = time.time()
-        wall0 += tt1 - tt0
-        if key in state:
-            add_func(state, key, data)
-        else:
-            init_func(state, key, data)
-        tt2 = time.time()
-        wall1 += tt2 - tt1
-        keys_changed = {key: data}
-        key_decreased = False
-        while t_left <= t_right - window and reader.has_message_available():
-            message = reader.read_next()
-            data = message.value().__dict__
-            keyl = '___all-fields___' if key_by is None else data[key_by]
-            t_left =  datetime.datetime.strptime(data[date_field], date_format).timestamp()
-            remove_func(state, keyl, data)
-            keys_changed[keyl] = data
-        tt3 = time.time()
-        wall2 += tt3 - tt2
+    def send(keys_changed):
         for key, data in keys_changed.items():
             output = output_func(state, key, data)
             if output is None:
                 continue
-            if not isinstance(output, (tuple, list)) and len(output_field) == 1:
-                output = [output]
-            output_dict = {key: value for key, value in zip(output_field, output)}
-            record = {field: output_dict[field] if field in output_field else data[field]
-                      for field in output_schema}
+            record = output_record(output, data, output_field, output_schema)
             producer.send_async(OutModel.from_dict(record), callback=handler.callback)
-        tt4 = time.time()
-        wall3 += tt4 - tt3
+
+    coalescer = None
+    emit = send
+    if coalesce:
+        coalescer = OutputCoalescer(send, coalesce_interval, coalesce_pending)
+        emit = coalescer.add
+
+    idle = 0
+    while i != max_records:
+        tt0 = time.time()
+        remaining = max_records - i if max_records > 0 else None
+        if coalescer is None:
+            batch = consumer.receive(remaining)
+        else:
+            # Wake up at the next flush even if the topic is quiet
+            wait = max(1, int(coalescer.wait() * 1e3))
+            if timeout is not None:
+                wait = max(1, min(wait, timeout - idle))
+            batch = consumer.receive(remaining, wait)
+        if not batch:
+            if coalescer is not None:
+                coalescer.tick()
+                idle += wait
+                if timeout is None or idle < timeout:
+                    continue
+            if timeout is not None:
+                t0 += timeout * 1e-3
+            break
+        idle = 0
+        wall0 += time.time() - tt0
+        added, removed, batch_changed = [], [], {}
+        for message in batch:
+            tt0 = time.time()
+            data = message.value().__dict__
+            i += 1
+            key = "___all-fields___" if key_by is None else data[key_by]
+            t_right = parse_timestamp(data[date_field], date_format)
+            # First time a key is encountered
+            if buffer is None and reader is None:
+                reader = client.create_reader(topic, schema=avro_schema,
+                                              start_message_id=message.message_id())
+                t_left = t_right
+            tt1 = time.time()
+            wall0 += tt1 - tt0
+            if batch_func is not None:
+                added.append((key, data))
+            elif key in state:
+                add_func(state, key, data)
+            else:
+                init_func(state, key, data)
+            tt2 = time.time()
+            wall1 += tt2 - tt1
+            keys_changed = {key: data}
+            if buffer is not None:
+                buffer.append(t_right, key, data)
+                evicted = buffer.evict(t_right - window)
+            else:
+                evicted = []
+                while t_left <= t_right - window and reader.has_message_available():
+                    message = reader.read_next()
+                    data = message.value().__dict__
+                    t_left = parse_timestamp(data[date_field], date_format)
+                    evicted.append(('___all-fields___' if key_by is None else data[key_by], data))
+            for keyl, data in evicted:
+                if batch_func is not None:
+                    removed.append((keyl, data))
+                else:
+                    remove_func(state, keyl, data)
+                keys_changed[keyl] = data
+            tt3 = time.time()
+            wall2 += tt3 - tt2
+            if batch_func is not None:
+                batch_changed.update(keys_changed)
+            else:
+                emit(keys_changed)
+            wall3 += time.time() - tt3
+        if batch_func is not None:
+            tt0 = time.time()
+            batch_func(state, added, removed)
+            tt1 = time.time()
+            wall1 += tt1 - tt0
+            emit(batch_changed)
+            wall3 += time.time() - tt1
+        consumer.acknowledge(batch)
+    if coalescer is not None:
+        coalescer.flush()
+        coalescer.report()
+    # Write back the state updates still buffered by the state
+    if hasattr(state, 'flush'):
+        state.flush()
     producer.flush()
     logger.info('Total messages processsed: %d', i)
     logger.info('Average processing rate: %.2f records/s', i/(time.time()-t0))
     logger.info('Time cost composition: receive %.2f  add %.2f  remove %.2f  send %.2f', wall0, wall1, wall2, wall3)
+    if buffer is not None:
+        logger.info('Events in the eviction buffer: %d  (%d spilled to disk in total)',
+                    len(buffer), buffer.spilled)
+        buffer.close()
     client.close()
 
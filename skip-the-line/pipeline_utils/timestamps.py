@@ -0,0 +1,54 @@
+"""Fast parsing of event time stamps into POSIX timestamps.
+
+`datetime.strptime` is among the slowest calls on the hot path.  The default
+layout `%Y-%m-%d %H:%M:%S` is parsed by slicing instead, with the start of each
+hour cached, and the results for recently seen strings are kept in an LRU cache
+since many events share the same second.  Like `strptime(...).timestamp()`, the
+strings are interpreted in local time.
+"""
+from datetime import datetime
+from functools import lru_cache
+
+
+DEFAULT_FORMAT = '%Y-%m-%d %H:%M:%S'
+CACHE_SIZE = 4096
+
+
+@lru_cache(maxsize=1024)
+def _hour_start(year, month, day, hour):
+    """Timestamp of the start of an hour.  UTC offset changes happen on the hour
+    in almost every time zone, so minutes and seconds can be added to it."""
+    return datetime(year, month, day, hour).timestamp()
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _parse_default(text):
+    digits = text[0:4] + text[5:7] + text[8:10] + text[11:13] + text[14:16] + text[17:19]
+    if (len(text) != 19 or text[4] != '-' or text[7] != '-' or text[10] != ' '
+            or text[13] != ':' or text[16] != ':' or not (digits.isascii() and digits.isdigit())):
+        return datetime.strptime(text, DEFAULT_FORMAT).timestamp()
+    minute = int(text[14:16])
+    second = int(text[17:19])
+    if minute > 59 or second > 59:
+        # Let strptime raise the proper error
+        return datetime.strptime(text, DEFAULT_FORMAT).timestamp()
+    return _hour_start(int(text[0:4]), int(text[5:7]), int(text[8:10]),
+                       int(text[11:13])) + minute * 60 + second
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _parse_format(text, date_format):
+    return datetime.strptime(text, date_format).timestamp()
+
+
+def parse_timestamp(text, date_format=DEFAULT_FORMAT):
+    """Parse a date string into a timestamp in seconds.  Equivalent to
+    `datetime.strptime(text, date_format).timestamp()`"""
+    if date_format == DEFAULT_FORMAT:
+        return _parse_default(text)
+    return _parse_format(text, date_format)
+
+
+def cache_info():
+    """Statistics of the parsed string cache for the default format"""
+    return _parse_default.cache_info()
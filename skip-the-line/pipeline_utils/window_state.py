@@ -0,0 +1,399 @@
+"""Per-key state containers for sliding time windows.
+
+The containers for counting events share the same interface:
+    update(key, stamp, window):  Register an event of `key` at time `stamp` and
+                                 return the number of events of the key in the
+                                 window (stamp - window, stamp]
+    memory_usage():              Estimated memory footprint in bytes
+    len(container):              Number of keys tracked
+    snapshot(), restore():       Picklable copy of the state, see `KeyedState`
+
+`MaxWindowState` tracks the maximum of a value in the window instead.
+"""
+import math
+import sys
+from array import array
+from bisect import bisect_left
+from collections import defaultdict, deque
+
+
+class KeyedState(object):
+    """Base class of the containers, which keep the state of each key in `self.state`.
+
+    Snapshots are dicts of key to a picklable dump of its state.  After
+    `track_changes()` is called, the keys updated since the last snapshot are
+    recorded so that snapshots can be incremental."""
+    changed = None
+
+    def __len__(self):
+        return len(self.state)
+
+    def track_changes(self):
+        self.changed = set()
+
+    def snapshot(self, changed_only=False):
+        """Dump the state of all keys, or only of the keys changed since the last
+        snapshot.  Keys that no longer exist are dumped as None."""
+        keys = self.changed if changed_only else list(self.state.keys())
+        if self.changed is not None:
+            self.changed = set()
+        state = self.state
+        return {key: self.dump_key(key) if key in state else None for key in keys}
+
+    def restore(self, entries):
+        """Load a snapshot, or apply an incremental one"""
+        for key, data in entries.items():
+            if data is None:
+                self.state.pop(key, None)
+            else:
+                self.load_key(key, data)
+
+    def dump_key(self, key):
+        raise NotImplementedError
+
+    def load_key(self, key, data):
+        raise NotImplementedError
+
+
+class DequeWindowState(KeyedState):
+    """One deque of timestamps per key, with the most recent timestamp on the left"""
+    def __init__(self):
+        self.state = defaultdict(deque)
+
+    def update(self, key, stamp, window):
+        if self.changed is not None:
+            self.changed.add(key)
+        stamp_start = stamp - window
+        state = self.state[key]
+        state.appendleft(stamp)
+        while state:
+            tail = state.pop()
+            if tail > stamp_start and tail <= stamp:
+                state.append(tail)
+                break
+        return len(state)
+
+    def memory_usage(self):
+        size = sys.getsizeof(self.state)
+        for stamps in self.state.values():
+            size += sys.getsizeof(stamps) + sum(sys.getsizeof(stamp) for stamp in stamps)
+        return size
+
+    def dump_key(self, key):
+        return list(self.state[key])
+
+    def load_key(self, key, data):
+        self.state[key] = deque(data)
+
+
+class TimestampRing(object):
+    """Ring buffer of timestamps in a contiguous array of doubles.  Timestamps are
+    appended at the newest end and evicted from the oldest end.  The capacity is
+    a power of two and doubles or halves as needed, so all operations are
+    amortized O(1) and no Python object is kept per timestamp."""
+    __slots__ = ('buffer', 'head', 'size')
+    min_capacity = 4
+
+    def __init__(self, capacity=min_capacity):
+        self.buffer = array('d', bytes(8 * capacity))
+        self.head = 0
+        self.size = 0
+
+    @classmethod
+    def from_array(cls, stamps):
+        """Create a ring containing `stamps`, an array of doubles from oldest to newest"""
+        capacity = cls.min_capacity
+        while capacity < len(stamps):
+            capacity *= 2
+        ring = cls(capacity)
+        ring.buffer[:len(stamps)] = stamps
+        ring.size = len(stamps)
+        return ring
+
+    def to_array(self):
+        """Timestamps from oldest to newest"""
+        buffer, head = self.buffer, self.head
+        end = head + self.size
+        if end <= len(buffer):
+            return buffer[head:end]
+        return buffer[head:] + buffer[:end - len(buffer)]
+
+    def __len__(self):
+        return self.size
+
+    def _resize(self, capacity):
+        content = self.to_array()
+        size = self.size
+        content.extend(array('d', bytes(8 * (capacity - size))))
+        self.buffer = content
+        self.head = 0
+
+    def append(self, stamp):
+        """Add a timestamp at the newest end"""
+        if self.size == len(self.buffer):
+            self._resize(2 * len(self.buffer))
+        buffer = self.buffer
+        buffer[(self.head + self.size) & (len(buffer) - 1)] = stamp
+        self.size += 1
+
+    def oldest(self):
+        return self.buffer[self.head]
+
+    def newest(self):
+        return self.buffer[(self.head + self.size - 1) & (len(self.buffer) - 1)]
+
+    def evict(self, start, end=float('inf')):
+        """Remove timestamps from the oldest end until one in (start, end] is found"""
+        buffer, head, size = self.buffer, self.head, self.size
+        mask = len(buffer) - 1
+        while size:
+            stamp = buffer[head]
+            if stamp > start and stamp <= end:
+                break
+            head = (head + 1) & mask
+            size -= 1
+        self.head, self.size = head, size
+        capacity = len(buffer)
+        if capacity > self.min_capacity and size < capacity // 4:
+            self._resize(capacity // 2)
+
+    def evict_before(self, t):
+        """Remove the timestamps at or before `t` from the oldest end"""
+        self.evict(t)
+
+    def nbytes(self):
+        """Memory used by this ring, including its array"""
+        return sys.getsizeof(self) + sys.getsizeof(self.buffer)
+
+
+class RingWindowState(KeyedState):
+    """One `TimestampRing` per key"""
+    def __init__(self):
+        self.state = {}
+
+    def update(self, key, stamp, window):
+        if self.changed is not None:
+            self.changed.add(key)
+        ring = self.state.get(key)
+        if ring is None:
+            ring = self.state[key] = TimestampRing()
+        # Same as ring.append(stamp) and ring.evict(stamp - window, stamp), inlined
+        # because this is called for every event
+        buffer, head, size = ring.buffer, ring.head, ring.size
+        mask = len(buffer) - 1
+        if size == len(buffer):
+            ring.append(stamp)
+            buffer, head, size = ring.buffer, ring.head, ring.size
+            mask = len(buffer) - 1
+        else:
+            buffer[(head + size) & mask] = stamp
+            size += 1
+        start = stamp - window
+        while size:
+            oldest = buffer[head]
+            if oldest > start and oldest <= stamp:
+                break
+            head = (head + 1) & mask
+            size -= 1
+        ring.head, ring.size = head, size
+        if size < len(buffer) // 4 and len(buffer) > ring.min_capacity:
+            ring._resize(len(buffer) // 2)
+        return size
+
+    def memory_usage(self):
+        return sys.getsizeof(self.state) + sum(ring.nbytes() for ring in self.state.values())
+
+    def dump_key(self, key):
+        return self.state[key].to_array().tobytes()
+
+    def load_key(self, key, data):
+        stamps = array('d')
+        stamps.frombytes(data)
+        self.state[key] = TimestampRing.from_array(stamps)
+
+
+class CountBuckets(object):
+    """Event counts of one key in its non-empty time buckets.  `buckets` holds
+    the bucket indices in increasing order and `counts` their counts, from
+    position `head` on; the expired entries before `head` are dropped in bulk."""
+    __slots__ = ('buckets', 'counts', 'head', 'total')
+
+    def __init__(self, buckets=(), counts=()):
+        self.buckets = array('q', buckets)
+        self.counts = array('I', counts)
+        self.head = 0
+        self.total = sum(self.counts)
+
+    def expire(self, start):
+        """Remove the buckets at or before the bucket `start`"""
+        buckets, counts, head = self.buckets, self.counts, self.head
+        size = len(buckets)
+        total = self.total
+        while head < size and buckets[head] <= start:
+            total -= counts[head]
+            head += 1
+        self.total = total
+        if head == size:
+            del buckets[:], counts[:]
+            head = 0
+        elif head >= 16 and 2 * head >= size:
+            del buckets[:head], counts[:head]
+            head = 0
+        self.head = head
+
+
+class BucketWindowState(KeyedState):
+    """Approximate window counts from per-key event counts in fixed time buckets.
+
+    The window is covered by ceil(window / bucket_size) buckets, the last of which
+    contains the current event.  Only the non-empty buckets of a key are stored,
+    so memory per key is bounded by the number of buckets and by the number of
+    events in the window.  The count is a running sum updated as buckets expire,
+    so eviction costs O(buckets expired) regardless of the number of events.
+    Events older than the oldest bucket are not counted."""
+    def __init__(self, bucket_size=60.):
+        self.bucket_size = bucket_size
+        self.buckets = None
+        self.state = {}
+
+    def update(self, key, stamp, window):
+        if self.changed is not None:
+            self.changed.add(key)
+        n = self.buckets
+        if n is None:
+            n = self.buckets = max(1, int(math.ceil(window / self.bucket_size)))
+        index = int(stamp // self.bucket_size)
+        entry = self.state.get(key)
+        if entry is None:
+            entry = self.state[key] = CountBuckets()
+        buckets = entry.buckets
+        if len(buckets) == entry.head:
+            buckets.append(index)
+            entry.counts.append(1)
+        else:
+            last = buckets[-1]
+            if index == last:
+                entry.counts[-1] += 1
+            elif index > last:
+                if buckets[entry.head] <= index - n:
+                    entry.expire(index - n)
+                buckets.append(index)
+                entry.counts.append(1)
+            elif index > last - n:
+                # Late event, in an older bucket still in the window
+                i = bisect_left(buckets, index, entry.head)
+                if buckets[i] == index:
+                    entry.counts[i] += 1
+                else:
+                    buckets.insert(i, index)
+                    entry.counts.insert(i, 1)
+            else:
+                return entry.total
+        entry.total += 1
+        return entry.total
+
+    def memory_usage(self):
+        return sys.getsizeof(self.state) + sum(
+            sys.getsizeof(entry) + sys.getsizeof(entry.buckets) + sys.getsizeof(entry.counts)
+            for entry in self.state.values())
+
+    def dump_key(self, key):
+        entry = self.state[key]
+        head = entry.head
+        return entry.buckets[head:].tobytes(), entry.counts[head:].tobytes()
+
+    def load_key(self, key, data):
+        buckets, counts = array('q'), array('I')
+        buckets.frombytes(data[0])
+        counts.frombytes(data[1])
+        self.state[key] = CountBuckets(buckets, counts)
+
+
+class MaxWindowState(KeyedState):
+    """Maximum of a value of each key in a sliding time window
+
+    Each key has a deque of (timestamp, value) pairs with strictly decreasing
+    values from the oldest to the most recent entry, so the oldest entry still
+    in the window holds the maximum.  The same deque also answers the maximum
+    over any shorter window, see `update_horizons`."""
+    def __init__(self):
+        self.state = defaultdict(deque)
+
+    def update(self, key, value, stamp, window):
+        """Add a value of `key` at time `stamp` and returns the maximum value
+        of that key in the window ending at `stamp`"""
+        if self.changed is not None:
+            self.changed.add(key)
+        stamp_start = stamp - window
+
+        # The state contains a deque of uniformly decreasing max values, with the most recent
+        # value at the end.  First, pop all elements smaller than the current value
+        state = self.state[key]
+        while state:
+            t_head, value_head = state[0]
+            if value_head > value:
+                break
+            state.popleft()
+        # Push the current value to the top of the stack
+        state.appendleft((stamp, value))
+        # Retire elements at the bottom that are no longer within the time window.  This is
+        # actually not strictly necessary for the algorithm to work but does reduce the reading
+        # cost and decreases the memory foot print.
+        value_tail = value
+        while state:
+            t_tail, value_tail = state.pop()
+            if t_tail > stamp_start and t_tail <= stamp:
+                state.append((t_tail, value_tail))
+                break
+        return value_tail
+
+    def update_horizons(self, key, value, stamp, windows):
+        """Add a value of `key` at time `stamp` and returns the maximum value of that
+        key in each of the `windows` ending at `stamp`, in the same order.  Only the
+        longest window is kept in the state."""
+        longest = max(windows)
+        peak = self.update(key, value, stamp, longest)
+        state = self.state[key]
+        maxima = []
+        for window in windows:
+            if window == longest:
+                maxima.append(peak)
+                continue
+            # Timestamps decrease from the front to the back of the deque.  Binary
+            # search the oldest entry inside the window, which holds its maximum.
+            start = stamp - window
+            lo, hi = 0, len(state)
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if state[mid][0] > start:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            maxima.append(state[lo - 1][1])
+        return maxima
+
+    def memory_usage(self):
+        size = sys.getsizeof(self.state)
+        for entries in self.state.values():
+            size += sys.getsizeof(entries) + sum(sys.getsizeof(entry) for entry in entries)
+        return size
+
+    def dump_key(self, key):
+        return list(self.state[key])
+
+    def load_key(self, key, data):
+        self.state[key] = deque(tuple(entry) for entry in data)
+
+
+window_states = {
+    'deque': DequeWindowState,
+    'ring': RingWindowState,
+    'bucket': BucketWindowState,
+}
+
+
+def make_window_state(backend='deque', **options):
+    """Create a window state container by the name of its backend"""
+    if backend not in window_states:
+        raise ValueError('Unknown window state backend: ' + str(backend))
+    return window_states[backend](**options)
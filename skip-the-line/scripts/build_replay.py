@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+"""Convert a source file into a replay file of pre-encoded Avro messages, for
+`s3_producer.py` with the `replay_file` setting.  Takes the same settings file
+as the producer: the lines of `s3object` are parsed, vectorized and encoded with
+`schema`, keyed by `key_by`, and written to `replay_file`."""
+import logging
+import sys
+import time
+
+import smart_open
+import yaml
+
+from pipeline_utils import model_class_factory
+from pipeline_utils.line_parser import LineParser
+from pipeline_utils.replay import ReplayWriter, STAMP_SENTINEL
+
+
+logger = logging.getLogger(__name__)
+
+
+def build_replay(s3object, replay_file, schema, key_by=None, timestamp=None, vectorize=True,
+                 max_records=-1, parser=None, parse_batch=100, index_every=1024, **settings):
+    Model = model_class_factory(**schema)
+    line_parser = LineParser(schema, vectorize, parser)
+    t0 = time.time()
+    size = 0
+    with smart_open.open(s3object) as f, \
+            ReplayWriter(replay_file, schema, key_by, timestamp or None, index_every) as writer:
+        for i, (line, data) in enumerate(line_parser.iter_lines(f, parse_batch)):
+            if i == max_records:
+                break
+            size += len(line)
+            if data is None:
+                continue
+            if timestamp:
+                data[timestamp] = STAMP_SENTINEL
+            writer.write(data.get(key_by), Model.encode_dict(data))
+    logger.info('%d records written to %s', writer.count, replay_file)
+    logger.info('Source: %d characters  Replay file: %d bytes', size, writer.offset)
+    logger.info('Conversion rate: %.2f records/s', writer.count / (time.time() - t0))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        raise RuntimeError('Did not suppy settings through yaml file')
+    with open(sys.argv[1]) as f:
+        settings = yaml.safe_load(f)
+    logging.basicConfig(level=settings.pop('logging_level', 'INFO'))
+    build_replay(**settings)
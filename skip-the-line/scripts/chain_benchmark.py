@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+"""Operator chaining benchmark.  Run a synthetic check-in stream through the
+window count and window ratio functions, first as separate functions with the
+messages encoded and decoded between them, then as a single chained function,
+and compare the latency per event from the encoded input to the final output.
+
+The functions run in this process, so the broker hops saved by the chain come
+on top of the difference measured here."""
+import logging
+import random
+import sys
+import time
+from datetime import datetime
+
+import yaml
+
+from pipeline_utils import model_class_factory
+from pipeline_utils.chain import load_class
+from pipeline_utils.metrics import LatencyHistogram
+
+
+logger = logging.getLogger(__name__)
+
+
+class BenchmarkContext(object):
+    """The part of the Pulsar Functions context used by the functions.  Published
+    messages are counted and dropped."""
+    def __init__(self, user_config):
+        self.user_config = user_config
+        self.published = 0
+
+    def get_output_topic(self):
+        return 'output'
+
+    def publish(self, topic, message, **kwargs):
+        self.published += 1
+
+    def record_metric(self, name, value):
+        pass
+
+    def get_logger(self):
+        return logger
+
+
+def load_function(path, exclude=()):
+    """Create a function from its deployment config file"""
+    with open(path) as f:
+        config = yaml.safe_load(f)
+    user_config = config['userConfig']
+    if 'chain' in user_config:
+        user_config['chain'] = [entry for entry in user_config['chain']
+                                if entry['class'] not in exclude]
+    sys.path.append(user_config.get('chain_path', ''))
+    return load_class(config['className'])(), BenchmarkContext(user_config)
+
+
+def make_stream(max_records, keys, event_rate, seed):
+    rng = random.Random(seed)
+    names = ['business-%06d' % i for i in range(keys)]
+    weights = [rng.paretovariate(1.2) for _ in range(keys)]
+    t = 1.5e9
+    for key in rng.choices(names, weights=weights, k=max_records):
+        t += rng.expovariate(event_rate)
+        date = datetime.utcfromtimestamp(int(t)).strftime('%Y-%m-%d %H:%M:%S')
+        yield {'business_id': key, 'date': date, 'timestamp': t}
+
+
+def run(functions, events, Sink):
+    """Pass each encoded event through the functions in turn and decode the final
+    output as the sink would.  Returns the latency histogram."""
+    histogram = LatencyHistogram()
+    clock = time.perf_counter
+    for raw in events:
+        t0 = clock()
+        for function, context in functions:
+            raw = function.process(raw, context)
+            if raw is None:
+                break
+        else:
+            if Sink is not None:
+                Sink.decode_dict(raw)
+        histogram.record(clock() - t0)
+    return histogram
+
+
+def report(name, histogram, elapsed):
+    logger.info('%-9s %10.1f events/s   mean %7.1fus   p50 %7.1fus   p90 %7.1fus   '
+                'p99 %7.1fus', name, histogram.count / elapsed,
+                histogram.total / histogram.count * 1e6, histogram.quantile(0.5) * 1e6,
+                histogram.quantile(0.9) * 1e6, histogram.quantile(0.99) * 1e6)
+
+
+def test_chain(separate, chain, functions_path='../pulsar_functions', exclude=(),
+               max_records=200000, keys=20000, event_rate=50., seed=0):
+    """Compare the separate functions, given by their config files, to the chain"""
+    sys.path.append(functions_path)
+    stream = list(make_stream(max_records, keys, event_rate, seed))
+    functions = [load_function(path) for path in separate]
+    Input = model_class_factory(**functions[0][1].user_config['schema'])
+    Sink = model_class_factory(**functions[-1][1].user_config['output_schema'])
+    events = [Input.encode_dict(event) for event in stream]
+
+    t0 = time.time()
+    histogram = run(functions, events, Sink)
+    report('separate', histogram, time.time() - t0)
+    separate_p50 = histogram.quantile(0.5)
+
+    function = load_function(chain, exclude)
+    t0 = time.time()
+    histogram = run([function], events, None)
+    report('chained', histogram, time.time() - t0)
+    logger.info('Median latency reduced %.2fx by chaining', separate_p50 / histogram.quantile(0.5))
+
+
+if __name__ == '__main__':
+    # If Yaml setting file is not supplied
+    if len(sys.argv) < 2:
+        raise RuntimeError('Did not suppy settings through yaml file')
+    with open(sys.argv[1]) as f:
+        settings = yaml.safe_load(f)
+    logging.basicConfig(level=settings.pop('log_level', 'INFO'))
+
+    test_chain(**settings)
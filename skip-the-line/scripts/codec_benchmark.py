@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+"""Codec benchmark.  Encode and decode one record repeatedly with the generic
+pulsar Avro codec and the compiled codec, and compare the message rates."""
+import logging
+import sys
+import time
+
+import yaml
+
+from pipeline_utils import model_class_factory
+from pipeline_utils.schema_model import set_codec_engine
+
+
+logger = logging.getLogger(__name__)
+
+
+def measure(Model, record, max_records):
+    """Returns encode and decode rates in messages per second"""
+    message = Model.from_dict(record)
+    t0 = time.time()
+    for i in range(max_records):
+        raw = message.encode()
+    t1 = time.time()
+    for i in range(max_records):
+        Model.decode(raw)
+    t2 = time.time()
+    return raw, max_records / (t1 - t0), max_records / (t2 - t1)
+
+
+def test_codecs(schema, record, max_records=100000, engines=('pulsar', 'compiled')):
+    results = {}
+    for engine in engines:
+        set_codec_engine(engine)
+        Model = model_class_factory(**schema)
+        raw, encode_rate, decode_rate = measure(Model, record, max_records)
+        logger.info('%-10s encode: %12.2f msg/s   decode: %12.2f msg/s', engine,
+                    encode_rate, decode_rate)
+        results[engine] = raw
+        # Decoding into a plain dict skips the validation in Record.__init__
+        if hasattr(Model, 'decode_dict'):
+            t0 = time.time()
+            for i in range(max_records):
+                Model.decode_dict(raw)
+            logger.info('%-10s decode to dict: %12.2f msg/s', engine,
+                        max_records / (time.time() - t0))
+    encoded = set(results.values())
+    if len(encoded) != 1:
+        logger.error('Codecs disagree on the encoded message: %s', str(results))
+    else:
+        logger.info('All codecs produced identical output (%d bytes)', len(encoded.pop()))
+
+
+if __name__ == '__main__':
+    # If Yaml setting file is not supplied
+    if len(sys.argv) < 2:
+        raise RuntimeError('Did not suppy settings through yaml file')
+    with open(sys.argv[1]) as f:
+        settings = yaml.safe_load(f)
+    logging.basicConfig(level=settings.pop('log_level', 'INFO'))
+
+    test_codecs(**settings)
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+"""Consumer throughput test against a local broker, e.g. `pulsar standalone`.
+Publish a number of records to a topic, then consume them from the earliest
+position with each of the batch and acknowledgement settings, one subscription
+per setting.
+
+With `in_process: yes` no broker is needed: each setting consumes the encoded
+records from an `InProcessConsumer` in memory, which measures the client side
+cost of receiving, decoding and acknowledging.  `ack_cost` adds a busy wait of
+that many microseconds to every acknowledgement call, as a stand-in for the
+work of the client library."""
+import logging
+import sys
+import time
+import uuid
+
+import pulsar
+import yaml
+
+from pipeline_utils import model_class_factory, CallbackHandler
+from pipeline_utils.consume import BatchConsumer, subscribe_batches
+
+
+logger = logging.getLogger(__name__)
+
+
+class InProcessMessage(object):
+    __slots__ = ('payload', 'decode')
+
+    def __init__(self, payload, decode):
+        self.payload = payload
+        self.decode = decode
+
+    def data(self):
+        return self.payload
+
+    def value(self):
+        return self.decode(self.payload)
+
+
+class InProcessConsumer(object):
+    """Stand-in for a `pulsar.Consumer` serving encoded messages from memory"""
+    def __init__(self, payloads, decode, ack_cost=0.):
+        self.messages = iter([InProcessMessage(payload, decode) for payload in payloads])
+        self.ack_cost = ack_cost * 1e-6
+        self.acks = 0
+
+    def receive(self, timeout_millis=None):
+        try:
+            return next(self.messages)
+        except StopIteration:
+            raise Exception('Pulsar error: TimeOut') from None
+
+    def _ack(self):
+        self.acks += 1
+        if self.ack_cost:
+            end = time.perf_counter() + self.ack_cost
+            while time.perf_counter() < end:
+                pass
+
+    def acknowledge(self, message):
+        self._ack()
+
+    def acknowledge_cumulative(self, message):
+        self._ack()
+
+    def close(self):
+        pass
+
+
+def consume(consumer, max_records):
+    """Receive, decode and acknowledge `max_records` records.  Returns the
+    number of records and the time taken."""
+    i = 0
+    t0 = time.time()
+    while i < max_records:
+        batch = consumer.receive(max_records - i)
+        if not batch:
+            break
+        for message in batch:
+            message.value()
+        i += len(batch)
+        consumer.acknowledge(batch)
+    return i, time.time() - t0
+
+
+def describe(run):
+    return ', '.join('%s=%s' % item for item in sorted(run.items()))
+
+
+def test_consume_in_process(schema, record, runs, max_records=100000, timeout=1000,
+                            ack_cost=0.):
+    """Same as `test_consume` with an `InProcessConsumer` per setting"""
+    Model = model_class_factory(**schema)
+    avro_schema = pulsar.schema.AvroSchema(Model)
+    payloads = [avro_schema.encode(Model.from_dict(record))] * max_records
+    for run in runs:
+        options = {name: run[name] for name in ('batch_size', 'batch_timeout', 'ack')
+                   if name in run}
+        consumer = BatchConsumer(InProcessConsumer(payloads, avro_schema.decode, ack_cost),
+                                 timeout=timeout, **options)
+        i, dt = consume(consumer, max_records)
+        logger.info('%-60s %10.2f records/s  (%d records in %d batches, %d acks)',
+                    describe(run), i / dt, i, consumer.batches, consumer.consumer.acks)
+
+
+def test_consume(schema, record, runs, broker='pulsar://localhost:6650', topic=None,
+                 max_records=100000, timeout=1000, in_process=False, ack_cost=0.):
+    """Each run is a dict of `batch_size`, `batch_timeout`, `ack` and
+    `receiver_queue_size` given to `subscribe_batches`"""
+    if in_process:
+        test_consume_in_process(schema, record, runs, max_records, timeout, ack_cost)
+        return
+    client = pulsar.Client(broker)
+    Model = model_class_factory(**schema)
+    avro_schema = pulsar.schema.AvroSchema(Model)
+    topic = topic or 'consume-benchmark-' + uuid.uuid4().hex[:8]
+
+    handler = CallbackHandler()
+    producer = client.create_producer(topic, schema=avro_schema, block_if_queue_full=True,
+                                      batching_enabled=True, max_pending_messages=10000)
+    message = Model.from_dict(record)
+    # Subscribe before publishing so the topic retains the messages
+    consumers = [subscribe_batches(client, topic, 'benchmark-%d' % index, avro_schema,
+                                   'earliest', timeout=timeout, **run)
+                 for index, run in enumerate(runs)]
+    t0 = time.time()
+    for i in range(max_records):
+        producer.send_async(message, handler.callback)
+    producer.flush()
+    logger.info('Published %d records to %s at %.2f records/s  (%d dropped)', max_records,
+                topic, max_records / (time.time() - t0), handler.dropped)
+
+    for run, consumer in zip(runs, consumers):
+        i, dt = consume(consumer, max_records)
+        logger.info('%-60s %10.2f records/s  (%d records in %d batches)',
+                    describe(run), i / dt, i, consumer.batches)
+        consumer.consumer.close()
+    client.close()
+
+
+if __name__ == '__main__':
+    # If Yaml setting file is not supplied
+    if len(sys.argv) < 2:
+        raise RuntimeError('Did not suppy settings through yaml file')
+    with open(sys.argv[1]) as f:
+        settings = yaml.safe_load(f)
+    logging.basicConfig(level=settings.pop('log_level', 'INFO'))
+
+    test_consume(**settings)
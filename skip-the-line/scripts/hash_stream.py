@@ -9,6 +9,8 @@ import pulsar
 import yaml
 
 from pipeline_utils import model_class_factory, CallbackHandler
+from pipeline_utils.consume import subscribe_batches
+from pipeline_utils.partitioner import Partitioner
 
 
 if len(sys.argv) < 1:
@@ -21,22 +23,20 @@ logging.basicConfig(level=settings.get('logging_level', 'INFO'))
 logger = logging.getLogger(__name__)
 
 handler = CallbackHandler()
-initial_position = settings['initial_position']
-if initial_position == 'earliest':
-    position = pulsar.InitialPosition.Earliest
-elif initial_position == 'latest':
-    position = pulsar.InitialPosition.Lastest
-else:
-    raise ValueError('Initial position must be latest or earliest.')
+timeout = settings['timeout']
 
-# Connect the consumer, i.e. stream to be splitted.
+# Connect the consumer, i.e. stream to be splitted.  Shared subscriptions are
+# acknowledged per batch.
 client = pulsar.Client(settings['broker'])
 Model = model_class_factory(**settings['schema'])
 avro_schema = pulsar.schema.AvroSchema(Model)
-consumer = client.subscribe(settings['topic'], schema=avro_schema,
-                            subscription_name=settings['name'],
-                            initial_position=position,
-                            consumer_type=pulsar.ConsumerType.Shared)
+consumer = subscribe_batches(client, settings['topic'], settings['name'], avro_schema,
+                             settings['initial_position'],
+                             consumer_type=pulsar.ConsumerType.Shared,
+                             receiver_queue_size=settings.get('receiver_queue_size', 1000),
+                             batch_size=settings.get('batch_size', 100),
+                             batch_timeout=settings.get('batch_timeout', 10),
+                             ack=settings.get('ack', 'batch'), timeout=timeout)
 
 # Connect the producers for each substream
 partitions = settings['partitions']
@@ -49,25 +49,27 @@ producers = [client.create_producer(format_str.format(index + shift),
                                     max_pending_messages=settings['max_pending'])
              for index in range(partitions)]
 
+# Same routing as the producers, in every process
+partitioner = Partitioner(partitions, track=False)
+
 # Start hashing streams!!!!
 max_records = settings['max_records']
 key_by = settings['key_by']
-timeout = settings['timeout']
 t0 = time.time()
 i = 0
 while i != max_records:
-    try:
-        message = consumer.receive(timeout)
-    except Exception as e: 
-        logger.info('Source stream timeout. '+ str(e))
-        t0 += timeout * 0.001
+    batch = consumer.receive(max_records - i if max_records > 0 else None)
+    if not batch:
+        if timeout is not None:
+            t0 += timeout * 0.001
         break
-    data = message.value()
-    consumer.acknowledge(message)
-    i += 1
-    key = getattr(data, key_by)
-    index = hash(key) % partitions
-    producers[index].send_async(data, handler.callback)
+    for message in batch:
+        data = message.value()
+        key = getattr(data, key_by)
+        index = partitioner.partition(key)
+        producers[index].send_async(data, handler.callback)
+    i += len(batch)
+    consumer.acknowledge(batch)
 logger.info('Total messages processed: %d', i)
 logger.info('Average processing rate: %.2f records/s', i/(time.time()-t0))
 client.close()
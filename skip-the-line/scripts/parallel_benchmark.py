@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+"""Scaling benchmark of the key-sharded executor.  A synthetic check-in stream
+goes through the mean and variance of a sliding time window, first in this
+process, then sharded over each number of worker processes.  No broker is
+involved, so this measures the executor and the workers only."""
+import logging
+import random
+import sys
+import time
+from collections import defaultdict
+
+import yaml
+
+from pipeline_utils.parallel import ShardedExecutor, TimeWindowWorker
+
+
+logger = logging.getLogger(__name__)
+
+
+def incr(state, key, data):
+    value = data['count']
+    state[key] = [n + v for n, v in zip(state[key], (1, value, value * value))]
+
+def decr(state, key, data):
+    value = data['count']
+    state[key] = [n - v for n, v in zip(state[key], (1, value, value * value))]
+
+def output_mean_variance(state, key, data):
+    n, total, total_sq = state[key]
+    if not n:
+        return None, None
+    mean = total / n
+    return mean, total_sq / n - mean * mean
+
+def new_state():
+    return defaultdict(lambda: [0, 0., 0.])
+
+
+def make_worker(window):
+    return TimeWindowWorker(new_state, incr, decr, output_mean_variance, ['mean', 'variance'],
+                            {'business_id': 'String', 'mean': 'Float', 'variance': 'Float'},
+                            window, 'business_id', 'date', eviction_fields=['count'])
+
+
+def make_batches(max_records, keys, event_rate, batch_size, seed):
+    rng = random.Random(seed)
+    names = ['business-%06d' % i for i in range(keys)]
+    weights = [rng.paretovariate(1.2) for _ in range(keys)]
+    t = 1.5e9
+    events = []
+    for key in rng.choices(names, weights=weights, k=max_records):
+        t += rng.expovariate(event_rate)
+        events.append((key, t, {'business_id': key, 'date': t, 'count': rng.randrange(20)}))
+    return [events[i:i + batch_size] for i in range(0, max_records, batch_size)]
+
+
+def test_scaling(workers=(1, 2, 4, 8), max_records=500000, keys=20000, event_rate=50.,
+                 window=3600., batch_size=500, seed=0):
+    batches = make_batches(max_records, keys, event_rate, batch_size, seed)
+
+    worker = make_worker(window)
+    worker.start(1)
+    outputs = 0
+    t0 = time.time()
+    for batch in batches:
+        outputs += len(worker.process(batch, batch[-1][1]))
+    worker.finish()
+    baseline = max_records / (time.time() - t0)
+    logger.info('in process   %10.2f records/s  (%d outputs)', baseline, outputs)
+
+    for n in workers:
+        executor = ShardedExecutor(make_worker(window), n)
+        executor.start(lambda records: None)
+        t0 = time.time()
+        for batch in batches:
+            executor.dispatch(batch)
+        executor.close()
+        rate = max_records / (time.time() - t0)
+        logger.info('%2d workers   %10.2f records/s  (%d outputs, %.2fx in process)', n, rate,
+                    executor.outputs, rate / baseline)
+
+
+if __name__ == '__main__':
+    # If Yaml setting file is not supplied
+    if len(sys.argv) < 2:
+        raise RuntimeError('Did not suppy settings through yaml file')
+    with open(sys.argv[1]) as f:
+        settings = yaml.safe_load(f)
+    logging.basicConfig(level=settings.pop('log_level', 'INFO'))
+
+    test_scaling(**settings)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+"""Line parsing benchmark.  Parse the same JSON lines with every backend of
+`pipeline_utils.line_parser.LineParser`, one line and `parse_batch` lines at a
+time, and report the lines parsed per second."""
+import json
+import logging
+import random
+import sys
+import time
+
+import yaml
+
+from pipeline_utils.line_parser import BACKENDS, LineParser, orjson
+
+
+logger = logging.getLogger(__name__)
+
+
+def make_lines(schema, max_records, seed=0):
+    """JSON lines of random records of a schema, with Array fields written as
+    comma separated strings as in the Yelp files"""
+    rng = random.Random(seed)
+    values = {
+        'String': lambda: ''.join(rng.choice('abcdefghij') for _ in range(rng.randint(5, 40))),
+        'Integer': lambda: rng.randint(0, 1000),
+        'Long': lambda: rng.randint(0, 10**12),
+        'Float': lambda: round(rng.random() * 5, 1),
+        'Double': lambda: rng.random(),
+        'Boolean': lambda: rng.random() < 0.5,
+    }
+    lines = []
+    for _ in range(max_records):
+        record = {}
+        for field, kind in schema.items():
+            if isinstance(kind, (list, tuple)):
+                record[field] = ', '.join(values['String']() for _ in range(rng.randint(1, 5)))
+            else:
+                record[field] = values.get(kind, values['String'])()
+        lines.append(json.dumps(record) + '\n')
+    return lines
+
+
+def test_parsing(schema, s3object=None, max_records=20000, parse_batch=100,
+                 backends=BACKENDS, vectorize=True):
+    if s3object:
+        import smart_open
+        with smart_open.open(s3object) as f:
+            lines = [line for _, line in zip(range(max_records), f)]
+    else:
+        lines = make_lines(schema, max_records)
+    logger.info('Parsing %d lines', len(lines))
+    reference = None
+    for backend in backends:
+        if backend == 'orjson' and orjson is None:
+            logger.info('%-7s not installed', backend)
+            continue
+        parser = LineParser(schema, vectorize, backend)
+        t0 = time.time()
+        records = [parser.parse(line) for line in lines]
+        t1 = time.time()
+        batched = [record for i in range(0, len(lines), parse_batch)
+                   for record in parser.parse_many(lines[i:i + parse_batch])]
+        t2 = time.time()
+        if reference is None:
+            reference = records
+        if records != reference or batched != reference:
+            logger.error('%s parsed the lines differently', backend)
+        logger.info('%-7s one line:  %12.2f lines/s   %d lines at once: %12.2f lines/s',
+                    backend, len(lines) / (t1 - t0), parse_batch, len(lines) / (t2 - t1))
+
+
+if __name__ == '__main__':
+    # If Yaml setting file is not supplied
+    if len(sys.argv) < 2:
+        raise RuntimeError('Did not suppy settings through yaml file')
+    with open(sys.argv[1]) as f:
+        settings = yaml.safe_load(f)
+    logging.basicConfig(level=settings.pop('log_level', 'INFO'))
+
+    test_parsing(**settings)
@@ -8,6 +8,7 @@ import pulsar
 import yaml
 
 from pipeline_utils.schema_model import model_class_factory
+from pipeline_utils.consume import subscribe_batches
 
 
 if len(sys.argv) < 1:
@@ -19,29 +20,25 @@ logger = logging.getLogger(__name__)
 
 client = pulsar.Client(settings['broker'])
 
-initial_position = settings['initial_position']
-if initial_position == 'earliest':
-    position = pulsar.InitialPosition.Earliest
-elif initial_position == 'latest':
-    position = pulsar.InitialPosition.Latest
-else:
-    raise ValueError('Initial position must be latest or earliest.')
-
 Model = model_class_factory(**settings['schema'])
-consumer = client.subscribe(settings['topic'], subscription_name=settings['name'],
-                            initial_position=position,
-                            schema=pulsar.schema.AvroSchema(Model))
+consumer = subscribe_batches(client, settings['topic'], settings['name'],
+                             pulsar.schema.AvroSchema(Model), settings['initial_position'],
+                             receiver_queue_size=settings.get('receiver_queue_size', 1000),
+                             batch_size=settings.get('batch_size', 100),
+                             batch_timeout=settings.get('batch_timeout', 10),
+                             ack=settings.get('ack', 'cumulative'),
+                             timeout=settings.get('timeout', None))
 
 i = 0
 max_records = settings.get('max_records', -1)
-timeout = settings.get('timeout', None)
 while i != max_records: 
-    try:
-        message = consumer.receive(timeout)
-    except Exception as e:
-        print('Consumer time out.' + str(e))
+    batch = consumer.receive(max_records - i if max_records > 0 else None)
+    if not batch:
+        print('Consumer time out.')
         break
-    data = message.value()
-    print("Message: %s" % str(data))
-    consumer.acknowledge(message)
+    for message in batch:
+        data = message.value()
+        print("Message: %s" % str(data))
+    i += len(batch)
+    consumer.acknowledge(batch)
 client.close()
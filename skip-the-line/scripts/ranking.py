@@ -1,4 +1,7 @@
 #!/usr/bin/env python3
+"""Rank the keys of each group by a field.  The rankings are kept in memory in
+a `RankingState` and mirrored to Redis sorted sets for the readers, or kept in
+Redis only with `state_backend: redis`."""
 import logging
 import sys
 
@@ -6,37 +9,59 @@ import yaml
 from redis import Redis
 
 from pipeline_utils.global_window import process_global_window
+from pipeline_utils.ranked_set import RankingState
 
 
-if len(sys.argv) < 1:
-    raise ArgumentError('Did not suppy settings through yaml file')
-with open(sys.argv[1]) as f:
-    settings = yaml.safe_load(f)
+logger = logging.getLogger(__name__)
 
-name = settings['name']
-group_by = settings['group_by']
-rank_by = settings['rank_by']
-reverse = settings['reverse']
 
-def update_ranking(state, key, data):
-    """use Ordered Sets from Redis to do the ranking"""
-    if group_by is None:
-        group = name
-    else:
-        group = data[group_by]
-    state.zadd(group, {key: data[rank_by]})
+def run(settings):
+    name = settings['name']
+    group_by = settings['group_by']
+    rank_by = settings['rank_by']
+    reverse = settings['reverse']
 
-def output_ranking(state, key, data):
-    if group_by is None:
-        group = name
-    else:
-        group = data[group_by]
-    if reverse:
-        return int(state.zrevrank(group, key)) + 1
+    def group_of(data):
+        return name if group_by is None else data[group_by]
+
+    def update_ranking(state, key, data):
+        state.update(group_of(data), key, data[rank_by])
+
+    def output_ranking(state, key, data):
+        return state.rank(group_of(data), key, reverse) + 1
+
+    def update_ranking_redis(state, key, data):
+        """use Ordered Sets from Redis to do the ranking"""
+        state.zadd(group_of(data), {key: data[rank_by]})
+
+    def output_ranking_redis(state, key, data):
+        if reverse:
+            return int(state.zrevrank(group_of(data), key)) + 1
+        else:
+            return int(state.zrank(group_of(data), key)) + 1
+
+    backend = settings.pop('state_backend', 'memory')
+    if backend == 'redis':
+        state = Redis(settings['state_server'], port=settings['state_port'],
+                      db=settings['state_id'])
+        process_global_window(state, update_ranking_redis, output_func=output_ranking_redis,
+                              **settings)
+        return
+    if settings.pop('mirror', True):
+        state = RankingState.connect(settings['state_server'], settings['state_port'],
+                                     settings['state_id'],
+                                     flush_every=settings.get('flush_every', 1000),
+                                     flush_interval=settings.get('flush_interval', 100))
     else:
-        return int(state.zrank(group, key)) + 1
+        state = RankingState()
+    process_global_window(state, update_ranking, output_func=output_ranking, **settings)
+    logger.info('Ranked %d keys in %d groups', len(state), len(state.groups))
 
-logging.basicConfig(level=settings.get('logging_level', 'INFO'))
-logger = logging.getLogger(__name__)
-state = Redis(settings['state_server'], port=settings['state_port'], db=settings['state_id'])
-process_global_window(state, update_ranking, output_func=output_ranking, **settings)
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        raise RuntimeError('Did not suppy settings through yaml file')
+    with open(sys.argv[1]) as f:
+        settings = yaml.safe_load(f)
+    logging.basicConfig(level=settings.get('logging_level', 'INFO'))
+    run(settings)
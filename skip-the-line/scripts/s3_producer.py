@@ -3,18 +3,73 @@
 """A helper script that reads an object from S3, apply a schema to it
 then supply it to Pulsar as a stream producer.
 Here we dictate that Avro schema be used throughout the system."""
+import json
 import logging
+import multiprocessing
 import uuid
 import sys
 import time
+from collections import deque
 
 import smart_open
 import pulsar
 from pipeline_utils import model_class_factory, CallbackHandler
+from pipeline_utils.avro_codec import PreEncodedAvroSchema
+from pipeline_utils.line_parser import LineParser
+from pipeline_utils.partitioner import Partitioner, summarize_moves
+from pipeline_utils.rate_limit import TokenBucket
+from pipeline_utils.replay import ReplayReader, STAMP_SENTINEL, find_stamp, stamp_payload
 
 
 logger = logging.getLogger(__name__)
 
+# Parser and encoder of the worker processes of the parallel ingestion
+_worker = {}
+
+
+def _init_worker(schema, vectorize, parser, timestamp, key_by):
+    _worker.update(Model=model_class_factory(**schema), timestamp=timestamp, key_by=key_by,
+                   parser=LineParser(schema, vectorize, parser))
+
+
+def _encode_chunk(lines):
+    """Parse and encode a chunk of lines in a worker process.  Returns a list of
+    (key, payload, timestamp offset), with None for the bad lines.  The timestamp
+    is encoded as `STAMP_SENTINEL` and stamped when the payload is published."""
+    Model, timestamp, key_by = _worker['Model'], _worker['timestamp'], _worker['key_by']
+    encoded = []
+    for data in _worker['parser'].parse_many(lines):
+        if data is None:
+            encoded.append(None)
+            continue
+        if timestamp:
+            data[timestamp] = STAMP_SENTINEL
+        payload = Model.encode_dict(data)
+        encoded.append((data.get(key_by), payload, find_stamp(payload) if timestamp else -1))
+    return encoded
+
+
+def encode_lines(pool, lines, chunk_size=100, max_chunks=8):
+    """Parse and encode lines in a pool of worker processes, `chunk_size` lines
+    per task, and yield (line, (key, payload, timestamp offset)) in the order of the lines.  At most
+    `max_chunks` chunks are read ahead."""
+    pending = deque()
+    chunk = []
+    for line in lines:
+        chunk.append(line)
+        if len(chunk) < chunk_size:
+            continue
+        pending.append((chunk, pool.apply_async(_encode_chunk, (chunk,))))
+        chunk = []
+        if len(pending) >= max_chunks:
+            done, result = pending.popleft()
+            yield from zip(done, result.get())
+    if chunk:
+        pending.append((chunk, pool.apply_async(_encode_chunk, (chunk,))))
+    while pending:
+        done, result = pending.popleft()
+        yield from zip(done, result.get())
+
 
 def process_request(reader, wait=False, timeout=20):
     """Read requests from a Pulsar Reader.Returns None if there is no valid command
@@ -25,7 +80,7 @@ def process_request(reader, wait=False, timeout=20):
         PARTITIONS  <num partitions>        Change the number of partitions
         MULT        <multiplicity>          Change the multiplicity factor
         RATE        <max rate>              Change the maximum publication rate (before
-                                            multiplication of messages)
+                                            multiplication of messages), may be fractional
     """
     if not reader or not (reader.has_message_available() or wait):
         return
@@ -52,6 +107,16 @@ def process_request(reader, wait=False, timeout=20):
         value = value.upper()
         if value in ['PAUSE', 'RESUME', 'STOP']:
             return 'STAT', value
+    elif 'RATE'.startswith(command): # The rate may be fractional
+        try:
+            value = float(value)
+        except ValueError:
+            logger.warn('Value must be a number')
+            return
+        if not 0 < value < float('inf'):
+            logger.warn('Value must be positive')
+            return
+        return 'RATE', value
     else: # Then value must be an integer. Check that
         if not value.isdigit():
             logger.warn('Value must be an integer')
@@ -63,8 +128,6 @@ def process_request(reader, wait=False, timeout=20):
         
         if 'PARTITIONS'.startswith(command):
             return 'PART', value
-        if 'RATE'.startswith(command):
-            return 'RATE', value
         if 'MULTIPLICITY'.startswith(command):
             return 'MULT', value
     logger.warn('Unrecognized command [%s]', command)
@@ -74,7 +137,8 @@ def process_file(s3object, schema, broker='pulsar://localhost:6650', topic='test
                  max_records=-1, batching=True, max_pending=5000, multiplicity=1,
                  vectorize=True, timestamp=False, partitions=None, key_by='',
                  request_topic='', max_rate=1000, service_interval=200,
-                 response_time=0.2, start_position=0):
+                 response_time=0.2, start_position=0, parser=None, parse_batch=100,
+                 workers=1, moved_topic='', replay_file=''):
     """Read from S3 and publish to Pulsar.  It can also ingest from a local/network file
     or HDFS, if the URI of the file is supplied.
 
@@ -104,18 +168,61 @@ def process_file(s3object, schema, broker='pulsar://localhost:6650', topic='test
                       but is written in S3 as a String.
         partitions:   If specified, will partition the messaged based on a key.
         key_by:       Which field to use as partition key.  The key will be hashed and messages
-                      published to channels based on the key hash.
+                      published to channels based on the key hash, see `pipeline_utils.partitioner`.
+        moved_topic:  If specified, the keys moved to another partition by a change of the
+                      number of partitions are published to this topic, as a JSON message
+                      {"partitions": [old, new], "moved": {key: [old partition, new partition]}}
         max_rate:     Maximum publication rate per second. Before the multiplication factor.
+                      May be fractional.  Messages are spaced evenly by a token bucket.
         request_topic:      If specified, will listen to command in this topic and update settings.
         service_interval:   Interval between which the rates will be monitored and incoming
                             requests processed.
         response_time:      Minimum time interval for accepting requests.  This will increase
                             frequency of request polling if max_rate is low.
         start_position:     Start from this position, instead of the beginning.
+        parser:       Line parser backend, orjson, json or yaml.  Defaults to orjson if
+                      it is installed, else json.  JSON parsers fall back to YAML for the
+                      lines they cannot parse.
+        parse_batch:  Number of lines parsed at once.
+        workers:      If more than 1, the lines are parsed and encoded in this number of
+                      worker processes, `parse_batch` lines at a time, while this process
+                      reads the file, handles the requests and publishes the messages in
+                      the order of the file.  The timestamps are then taken when the
+                      records are encoded.
+        replay_file:  If specified, publish the pre-encoded messages of this replay file,
+                      built from the source file by build_replay.py, instead of reading
+                      s3object.  Nothing is parsed or encoded, and `start_position` is an
+                      offset in the replay file.  Files built with a timestamp field are
+                      always stamped, since their payloads hold a placeholder value.
     """
     # Create the schema model for the output topic
     Model = model_class_factory(**schema)
-    avro_schema = pulsar.schema.AvroSchema(Model)
+    replay = None
+    if replay_file:
+        replay = ReplayReader(replay_file)
+        if replay.schema != schema:
+            raise ValueError('The replay file was built with another schema: ' +
+                             str(replay.schema))
+        if timestamp and replay.timestamp != timestamp:
+            raise ValueError('The replay file has no timestamp field ' + str(timestamp))
+        if replay.timestamp and not timestamp:
+            # The payloads hold STAMP_SENTINEL, which must never be published
+            logger.info('Stamping the %s field of the replay file', replay.timestamp)
+            timestamp = replay.timestamp
+        key_by = replay.key_by or key_by
+        workers = 1
+    if workers > 1 or replay is not None:
+        # The messages are already encoded, by the workers or in the replay file
+        avro_schema = PreEncodedAvroSchema(Model)
+    else:
+        avro_schema = pulsar.schema.AvroSchema(Model)
+
+    # Worker processes are forked before the Pulsar client is created
+    pool = None
+    if workers > 1:
+        pool = multiprocessing.get_context('fork').Pool(
+            workers, _init_worker, (schema, vectorize, parser, timestamp, key_by))
+        logger.info('Parsing and encoding in %d worker processes', workers)
 
     logger.info('Initializing client and request reader.')
     # Create a Pulsar client and a group of producers
@@ -136,6 +243,13 @@ def process_file(s3object, schema, broker='pulsar://localhost:6650', topic='test
                           ) 
         return producers[i]
 
+    # Stable across processes, and moves few keys when the partitions change
+    partitioner = Partitioner(partitions) if partitions else None
+    moved_producer = None
+    if moved_topic:
+        moved_producer = client.create_producer(moved_topic,
+                                                schema=pulsar.schema.StringSchema())
+
     # Create the request reader
     request_reader = None
     if request_topic:   # Initiate a request reader.
@@ -145,117 +259,140 @@ def process_file(s3object, schema, broker='pulsar://localhost:6650', topic='test
                 reader_name='s3_reader:'+str(uuid.uuid4())  # Unique name
             )
         logger.info('Will read request from topic [%s]', request_topic)
-    # The last time a request has been processed or message rate measured
-    last_stamp = t0 = time.time()
-    last_i = -1
+    t0 = time.time()
     # If the reader has been paused
     paused = False
     stopped = False
 
     data = None
-    # Determine which fields will be vectorized
-    if vectorize is True:
-        vectorize = [field for field, kind in schema.items() if kind[0] == 'Array']
+    # Parses the lines, projects them on the schema and splits the vectorized fields
+    line_parser = LineParser(schema, vectorize, parser)
 
     # Callback handler for async producer.
     handler = CallbackHandler()
 
-    # Calculate the interval at which control requests and max rates will be processed
+    # Calculate the interval at which control requests will be processed
     min_interval = max(1, int(response_time * max_rate))
     interval = min(service_interval, min_interval) 
+    # Spaces the messages evenly at the maximum rate
+    pacer = TokenBucket(max_rate)
+
+    def serve_requests():
+        """Apply the pending requests.  While paused, wait for the next ones."""
+        nonlocal paused, stopped, partitions, multiplicity, max_rate, interval, partitioner
+        while True:
+            request = process_request(request_reader, wait=paused)
+            if not request and not paused:
+                break
+            command, value = request
+            logger.info('Received request {}, {} from {}'.format(command,
+                         value, request_reader.topic())) 
+            if command == 'STAT':  # Change status
+                if value == 'PAUSE':
+                    if not paused:
+                        logger.info('Publication paused.')
+                        paused = True
+                elif value == 'RESUME':
+                    if paused:
+                        logger.info('Publication resumed')
+                        paused = False
+                elif value == 'STOP':
+                    stopped = True
+                    logger.info('Publication stopped')
+            elif command == 'PART':   # Change partitions
+                logger.info('Number of partitions changed to %d', value)
+                if partitioner is None:
+                    partitioner = Partitioner(value)
+                else:
+                    moved = partitioner.resize(value)
+                    logger.info('%d of %d keys moved partition: %s', len(moved),
+                                len(partitioner.keys), str(summarize_moves(moved)))
+                    if moved_producer is not None:
+                        moved_producer.send(json.dumps({'partitions': [partitions, value],
+                                                        'moved': moved}))
+                partitions = value
+            elif command == 'MULT':
+                multiplicity = value
+                logger.info('Message multiplicity changed to %d', value)
+            elif command == 'RATE':
+                max_rate = value
+                pacer.set_rate(max_rate)
+                logger.info('Max rate changed to %g', value)
+                min_interval = max(1, int(response_time * max_rate))
+                interval = min(service_interval, min_interval) 
+            if not paused or stopped:
+                break
 
     # This is for keeping track where in the file we are, for restarting
-    logger.info('Starting to process %s', str(s3object))
+    logger.info('Starting to process %s', str(replay_file or s3object))
     position = 0
     try:    # Ensure that clients are properly closed on error exit
-        # Read content of the S3 object
-        with smart_open.open(s3object) as f:
+        # Read content of the S3 object, or of the replay file
+        with replay or smart_open.open(s3object) as f:
             # Track the current position.  This is for restarting purposes
             if start_position > 0:
-                f.seek(start_position)
+                if replay is None:
+                    f.seek(start_position)
                 position = start_position
 
-            for i, line in enumerate(f):
+            if replay is not None:
+                # (size, (key, payload, timestamp offset)) of each record
+                records = replay.records(start_position or None)
+                position = max(position, replay.start)
+            elif pool is None:
+                records = ((len(line), data)
+                           for line, data in line_parser.iter_lines(f, parse_batch))
+            else:
+                records = ((len(line), data)
+                           for line, data in encode_lines(pool, f, parse_batch, 2 * workers))
+            for i, (size, data) in enumerate(records):
                 if i == max_records:
                     logger.info('Maximum number of records reached.')
                     break
-                position += len(line)
-                # Check if we need to check publication rates 
+                position += size
+                # Check if we need to check for requests
                 if interval > 0 and i % interval == 0:
-                    # First read requests
-                    while True:
-                        request = process_request(request_reader, wait=paused)
-                        if not request and not paused:
-                            break
-                        command, value = request
-                        logger.info('Received request {}, {} from {}'.format(command,
-                                     value, request_reader.topic())) 
-                        if command == 'STAT':  # Change status
-                            if value == 'PAUSE':
-                                if not paused:
-                                    logger.info('Publication paused.')
-                                    paused = True
-                            elif value == 'RESUME':
-                                if paused:
-                                    logger.info('Publication resumed')
-                                    paused = False
-                                    last_i = i
-                            elif value == 'STOP':
-                                stopped = True
-                                logger.info('Publication stopped')
-                        elif command == 'PART':   # Change partitions
-                            partitions = value 
-                            logger.info('Number of partitions changed to %d', value)
-                        elif command == 'MULT':
-                            multiplicity = value
-                            logger.info('Message multiplicity changed to %d', value)
-                        elif command == 'RATE':
-                            max_rate = value
-                            logger.info('Max rate changed to %d', value)
-                            min_interval = max(1, int(response_time * max_rate))
-                            interval = min(service_interval, min_interval) 
-                        if not paused or stopped:
-                            break
-                    # Now check message rate is too high
-                    dt_plan = float(i - last_i) / max(max_rate, 0.1)
-                    t_now = time.time()
-                    dt_actual = t_now - last_stamp
-                    if dt_actual < dt_plan:
-                        logger.debug('Processed %d msg in %.2fs. Waiting %.3fs.',
-                            i - last_i, dt_actual, dt_plan - dt_actual)
-                        time.sleep(dt_plan - dt_actual)
-                    last_stamp = time.time()
-                    last_i = i
-
+                    serve_requests()
                 if stopped:
                     break
 
-                # Get the data from S3 and process it into proper dict form
-                try:
-                    data = yaml.safe_load(line)
-                except yaml.parser.ParserError:
-                    logger.warn('Badly formed line skipped: %s', line)
+                # Lines that could not be parsed are logged and skipped by the parser
+                if data is None:
                     continue
-                if vectorize:
-                    for key in vectorize:
-                        if isinstance(data[key], str):
-                            data[key] = [entry.strip() for entry in data[key].split(',')]
-                if timestamp:
-                    data[timestamp] = time.time()
+                # Pace the publication, still serving the requests during long waits
+                while not pacer.acquire(timeout=response_time):
+                    serve_requests()
+                    if stopped:
+                        break
+                if stopped:
+                    break
+                if pool is None and replay is None:
+                    if timestamp:
+                        data[timestamp] = time.time()
+                    key = data.get(key_by)
+                    message = Model.from_dict(data)
+                else:
+                    # Already encoded by a worker or in the replay file
+                    key, message, stamp = data
+                    if timestamp and stamp >= 0:
+                        message = stamp_payload(message, stamp, time.time())
                 # check which partition I am in 
                 if partitions:
                     if key_by not in schema:
                         raise ValueError('Need to specify a proper key field for partitioning.')
-                    index = hash(data[key_by]) % partitions
+                    index = partitioner.partition(key)
                     producer = get_producer(index)
                 else:
                     producer = get_producer()
                 for j in range(multiplicity):
-                    producer.send_async(Model.from_dict(data), handler.callback)
+                    producer.send_async(message, handler.callback)
         for producer in producers.values():
             producer.flush()
-        logger.info('Last record: %s', str(data))
+        logger.info('Last record: %s', str(data if replay is None else data[1]))
         logger.info("Processing rate: %.2f records/s", i * multiplicity/ (time.time()-t0))
+        pacing = pacer.stats()
+        logger.info('Paced rate: %.2f records/s for a maximum of %g, jitter %.3f ms',
+                    pacing['rate'], pacing['target'], pacing['jitter'] * 1e3)
         if handler.dropped:
             logger.info('Number of dropped messaged: %d', handler.dropped)
             logger.info('Last error result:          %s', handler.result)
@@ -264,6 +401,8 @@ def process_file(s3object, schema, broker='pulsar://localhost:6650', topic='test
         logger.info('An exception occured and registered.', exc_info=True)
         success = False
     finally:
+        if pool is not None:
+            pool.terminate()
         logger.info('Exit position: %d', position)
         client.close()
     if success:
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+"""Warm restart benchmark.  Build window state from a synthetic stream, checkpoint
+it to a local snapshot file and measure how long a restart takes to restore it.
+
+With `functions` set, the WindowCount and WindowRatio Pulsar functions found in
+`function_path` are also checked end to end: one instance processes part of a
+stream with incremental snapshots, a second one restores the snapshot and
+replays the messages after it from an in-process reader, and both must then
+hold the same state and produce the same outputs."""
+import logging
+import os
+import random
+import sys
+import time
+
+import pulsar
+import yaml
+
+from pipeline_utils import model_class_factory
+from pipeline_utils.snapshot import Checkpointer, FileSnapshotStore
+from pipeline_utils.window_state import make_window_state, MaxWindowState
+
+
+logger = logging.getLogger(__name__)
+
+
+def test_restart(path='/tmp/window_state.snapshot', backend='ring', max_records=1000000,
+                 keys=100000, event_rate=50., window=8.64e4, max_window=7.884e6,
+                 interval=100000, seed=0):
+    """Checkpoints are taken every `interval` events while the state is built, as
+    in a running function.  Then the state is restored into new containers."""
+    for suffix in ('.count', '.max'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    rng = random.Random(seed)
+    names = ['business-%06d' % i for i in range(keys)]
+    weights = [rng.paretovariate(1.2) for _ in range(keys)]
+    stream = rng.choices(names, weights=weights, k=max_records)
+    counts = make_window_state(backend)
+    maxima = MaxWindowState()
+    count_store = Checkpointer(FileSnapshotStore(path + '.count'), interval, 1e9)
+    max_store = Checkpointer(FileSnapshotStore(path + '.max'), interval, 1e9)
+    count_store.restore(counts)
+    max_store.restore(maxima)
+
+    t = 1.5e9
+    t0 = time.time()
+    for i, key in enumerate(stream):
+        t += rng.expovariate(event_rate)
+        count = counts.update(key, t, window)
+        maxima.update(key, count, t, max_window)
+        count_store.step(counts, lambda: i)
+        max_store.step(maxima, lambda: i)
+    logger.info('Processed %d events in %.2fs including checkpoints', max_records, time.time() - t0)
+    logger.info('Snapshot files: %.1f MB', (os.path.getsize(path + '.count') +
+                                            os.path.getsize(path + '.max')) / 1048576.)
+
+    t0 = time.time()
+    restored_counts = make_window_state(backend)
+    restored_maxima = MaxWindowState()
+    position = Checkpointer(FileSnapshotStore(path + '.count')).restore(restored_counts)
+    Checkpointer(FileSnapshotStore(path + '.max')).restore(restored_maxima)
+    dt = time.time() - t0
+    logger.info('Restart to ready: %.3fs for %d keys, resuming after event %d', dt,
+                len(restored_counts), position)
+    if restored_counts.snapshot() != counts.snapshot():
+        raise RuntimeError('Restored count state differs')
+    if restored_maxima.snapshot() != maxima.snapshot():
+        raise RuntimeError('Restored max state differs')
+    logger.info('Events to replay after the snapshot: %d', max_records - 1 - position)
+
+
+class InProcessMessage(object):
+    def __init__(self, message_id, payload):
+        self.id = message_id
+        self.payload = payload
+
+    def message_id(self):
+        return self.id
+
+    def data(self):
+        return self.payload
+
+
+class InProcessReader(object):
+    """Stand-in for a `pulsar.Reader` over a list of messages, starting after
+    the message of a serialized id"""
+    def __init__(self, messages, position):
+        start = pulsar.MessageId.deserialize(position)
+        entries = [message.message_id().entry_id() for message in messages]
+        self.messages = iter(messages[entries.index(start.entry_id()) + 1:])
+        self.next = next(self.messages, None)
+        self.read = 0
+
+    def has_message_available(self):
+        return self.next is not None
+
+    def read_next(self):
+        message, self.next = self.next, next(self.messages, None)
+        self.read += 1
+        return message
+
+
+class InProcessClient(object):
+    def close(self):
+        pass
+
+
+class InProcessContext(object):
+    """The parts of the Pulsar Functions context used by the window functions"""
+    def __init__(self, user_config):
+        self.user_config = user_config
+        self.message_id = None
+
+    def get_message_id(self):
+        return self.message_id
+
+    def get_current_message_topic_name(self):
+        return 'snapshot-benchmark-partition-0'
+
+    def get_output_topic(self):
+        return None
+
+    def get_logger(self):
+        return logger
+
+    def publish(self, topic, message, **options):
+        pass
+
+    def record_metric(self, name, value):
+        pass
+
+
+def check_function(name, Function, user_config, stream, path, interval):
+    """Restart a function from its snapshot part way through `stream`, a list
+    of (message id, payload), and check it catches up with an uninterrupted one"""
+    if os.path.exists(path):
+        os.remove(path)
+    config = dict(user_config, snapshot_path=path, snapshot_interval=interval,
+                  snapshot_period=1e9, snapshot_compact=1000, snapshot_replay='in-process')
+    messages = [InProcessMessage(message_id, payload) for message_id, payload in stream]
+    readers = []
+
+    class Restarted(Function):
+        def open_replay_reader(self, broker, topic, position):
+            readers.append(InProcessReader(messages, position))
+            return InProcessClient(), readers[-1]
+
+    original = Function()
+    context = InProcessContext(config)
+    restart = len(stream) * 3 // 4 + interval // 3
+    for message_id, payload in stream[:restart]:
+        context.message_id = message_id
+        original.process(payload, context)
+    frames = len(FileSnapshotStore(path).read_frames())
+
+    # The current message comes with the partition in its id, unlike the ids
+    # read back from the partition topic
+    message_id, payload = stream[restart]
+    current = pulsar.MessageId(3, message_id.ledger_id(), message_id.entry_id(),
+                               message_id.batch_index())
+    t0 = time.time()
+    restarted = Restarted()
+    restarted_context = InProcessContext(config)
+    restarted_context.message_id = current
+    outputs = [restarted.process(payload, restarted_context)]
+    dt = time.time() - t0
+    context.message_id = current
+    expected = [original.process(payload, context)]
+    if restarted.state.snapshot() != original.state.snapshot():
+        raise RuntimeError(name + ': restored and replayed state differs')
+    for message_id, payload in stream[restart + 1:]:
+        context.message_id = restarted_context.message_id = message_id
+        expected.append(original.process(payload, context))
+        outputs.append(restarted.process(payload, restarted_context))
+    if outputs != expected:
+        raise RuntimeError(name + ': outputs after the restart differ')
+    logger.info('%-20s restored %d snapshot frames and replayed %d messages in %.3fs, '
+                'state and outputs match', name, frames, readers[0].read - 1, dt)
+
+
+def test_functions(function_path, count_config, ratio_config, path='/tmp/function.snapshot',
+                   backends=('deque', 'ring', 'bucket'), max_records=20000, keys=1000,
+                   event_rate=1., interval=1000, seed=0):
+    """Snapshot, restart and replay check of WindowCount with each state backend
+    and of WindowRatio, on a synthetic stream.  The user configs are read from
+    the function config files."""
+    sys.path.insert(0, function_path)
+    from window_count import WindowCount
+    from window_ratio import WindowRatio
+
+    rng = random.Random(seed)
+    names = ['business-%06d' % i for i in range(keys)]
+    weights = [rng.paretovariate(1.2) for _ in range(keys)]
+    t = 1.5e9
+    events = []
+    for key in rng.choices(names, weights=weights, k=max_records):
+        t += rng.expovariate(event_rate)
+        events.append({'business_id': key, 'timestamp': t, 'count': rng.randint(1, 50),
+                       'date': time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(t))})
+    ids = [pulsar.MessageId(-1, 7, i, -1) for i in range(max_records)]
+
+    def load(config_path):
+        with open(config_path) as f:
+            config = yaml.safe_load(f)['userConfig']
+        if isinstance(config['window'], str):
+            config['window'] = float(config['window'])
+        Model = model_class_factory(**config['schema'])
+        stream = [(message_id, Model.encode_dict({field: event[field]
+                                                  for field in config['schema']}))
+                  for message_id, event in zip(ids, events)]
+        return config, stream
+
+    config, stream = load(count_config)
+    for backend in backends:
+        check_function('WindowCount/' + backend, WindowCount,
+                       dict(config, state_backend=backend), stream, path, interval)
+    config, stream = load(ratio_config)
+    check_function('WindowRatio', WindowRatio, config, stream, path, interval)
+
+
+if __name__ == '__main__':
+    # If Yaml setting file is not supplied
+    if len(sys.argv) < 2:
+        raise RuntimeError('Did not suppy settings through yaml file')
+    with open(sys.argv[1]) as f:
+        settings = yaml.safe_load(f)
+    logging.basicConfig(level=settings.pop('log_level', 'INFO'))
+
+    functions = settings.pop('functions', None)
+    test_restart(**settings)
+    if functions:
+        test_functions(**functions)
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+"""Timestamp parsing benchmark.  Parse a stream of date strings with strptime
+and with `pipeline_utils.timestamps.parse_timestamp` and compare the rates."""
+import logging
+import sys
+import time
+from datetime import datetime, timedelta
+
+import yaml
+
+from pipeline_utils.timestamps import parse_timestamp, cache_info, DEFAULT_FORMAT
+
+
+logger = logging.getLogger(__name__)
+
+
+def test_parsing(max_records=200000, events_per_second=5, start='2018-01-01 00:00:00'):
+    """Dates advance by one second every `events_per_second` records, similar to
+    a check-in stream where many events share the same second"""
+    t = datetime.strptime(start, DEFAULT_FORMAT)
+    dates = [(t + timedelta(seconds=i // events_per_second)).strftime(DEFAULT_FORMAT)
+             for i in range(max_records)]
+
+    t0 = time.time()
+    expected = [datetime.strptime(date, DEFAULT_FORMAT).timestamp() for date in dates]
+    t1 = time.time()
+    parsed = [parse_timestamp(date) for date in dates]
+    t2 = time.time()
+    if parsed != expected:
+        logger.error('Parsed timestamps differ from strptime')
+    logger.info('strptime:        %12.2f records/s', max_records / (t1 - t0))
+    logger.info('parse_timestamp: %12.2f records/s', max_records / (t2 - t1))
+    logger.info('Cache:           %s', str(cache_info()))
+
+
+if __name__ == '__main__':
+    # If Yaml setting file is not supplied
+    if len(sys.argv) < 2:
+        raise RuntimeError('Did not suppy settings through yaml file')
+    with open(sys.argv[1]) as f:
+        settings = yaml.safe_load(f)
+    logging.basicConfig(level=settings.pop('log_level', 'INFO'))
+
+    test_parsing(**settings)
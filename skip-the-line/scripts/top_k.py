@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+"""Most frequent keys of each group, e.g. the busiest places, from bounded memory
+Space-Saving sketches.  The top-K of a group is emitted every `emit_every` events
+of the group or `emit_interval` milliseconds, with the error of each count."""
+import logging
+import sys
+
+import yaml
+
+from pipeline_utils.global_window import process_global_window
+from pipeline_utils.heavy_hitters import TopKState
+
+
+logger = logging.getLogger(__name__)
+
+
+def run(settings):
+    name = settings['name']
+    group_by = settings.get('group_by')
+
+    def group_of(data):
+        return name if group_by is None else data[group_by]
+
+    def count_key(state, key, data):
+        state.offer(group_of(data), key)
+
+    def output_top_k(state, key, data):
+        group = group_of(data)
+        if state.due(group):
+            return state.emit(group)
+        return None
+
+    state = TopKState(settings.pop('k', 100), settings.pop('capacity', 1000),
+                      settings.pop('emit_every', 1000), settings.pop('emit_interval', 1000))
+    process_global_window(state, count_key, output_func=output_top_k, **settings)
+    for group, sketch in state.sketches.items():
+        logger.info('%s: %d events, %d counters, counts within %d',
+                    group, sketch.total, len(sketch), sketch.error_bound())
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        raise RuntimeError('Did not suppy settings through yaml file')
+    with open(sys.argv[1]) as f:
+        settings = yaml.safe_load(f)
+    logging.basicConfig(level=settings.get('logging_level', 'INFO'))
+    run(settings)
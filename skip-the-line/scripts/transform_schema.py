@@ -9,6 +9,7 @@ import pulsar
 import yaml
 
 from pipeline_utils.schema_model import model_class_factory
+from pipeline_utils.consume import subscribe_batches
 
 
 if __name__ == '__main__':
@@ -42,19 +43,29 @@ for key, target_definition in target_schema.items():
 
 client = pulsar.Client(settings['broker'])
 
-consumer = client.subscribe(settings['source_topic'],
-                            subscription_name=settings['name'],
-                            schema=pulsar.schema.AvroSchema(SourceModel))
+consumer = subscribe_batches(client, settings['source_topic'], settings['name'],
+                             pulsar.schema.AvroSchema(SourceModel),
+                             settings.get('initial_position', 'latest'),
+                             receiver_queue_size=settings.get('receiver_queue_size', 1000),
+                             batch_size=settings.get('batch_size', 100),
+                             batch_timeout=settings.get('batch_timeout', 10),
+                             ack=settings.get('ack', 'cumulative'), timeout=1000)
 producer = client.create_producer(settings['target_topic'],
                                   schema=pulsar.schema.AvroSchema(TargetModel))
 
 t0 = time.time()
-for i in range(settings['max_records']):
-    message = consumer.receive(1000)
-    source_data = message.value()
-    consumer.acknowledge(message)
-    target_data = {target_key: getattr(source_data, source_key)
-                   for target_key, source_key in schema_map.items()}
-    producer.send(TargetModel.from_dict(target_data))
+i = 0
+max_records = settings['max_records']
+while i < max_records:
+    batch = consumer.receive(max_records - i)
+    if not batch:
+        break
+    for message in batch:
+        source_data = message.value()
+        target_data = {target_key: getattr(source_data, source_key)
+                       for target_key, source_key in schema_map.items()}
+        producer.send(TargetModel.from_dict(target_data))
+    i += len(batch)
+    consumer.acknowledge(batch)
 logging.info('Average processing rate: %.2f records/s', i/(time.time()-t0))
 client.close()
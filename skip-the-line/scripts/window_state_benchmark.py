@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# -*- encoding: utf-8 -*-
+"""Window state benchmark.  Feed a synthetic check-in stream to each window state
+backend and compare the update rate and memory used per key."""
+import logging
+import random
+import sys
+import time
+
+import yaml
+
+from pipeline_utils.window_state import make_window_state
+
+
+logger = logging.getLogger(__name__)
+
+
+def synthetic_stream(max_records, keys, event_rate, skew, seed=0):
+    """Events of `keys` businesses with Pareto distributed popularity, arriving at
+    `event_rate` events per second of event time"""
+    rng = random.Random(seed)
+    weights = [rng.paretovariate(skew) for _ in range(keys)]
+    names = ['business-%06d' % i for i in range(keys)]
+    chosen = rng.choices(names, weights=weights, k=max_records)
+    t = 1.5e9
+    stream = []
+    for key in chosen:
+        t += rng.expovariate(event_rate)
+        stream.append((key, float(int(t))))
+    return stream
+
+
+def test_backends(backends=('deque', 'ring'), max_records=500000, keys=10000,
+                  event_rate=50., skew=1.2, window=8.64e4, options=None):
+    stream = synthetic_stream(max_records, keys, event_rate, skew)
+    options = options or {}
+    counts = None
+    for backend in backends:
+        state = make_window_state(backend, **options.get(backend, {}))
+        update = state.update
+        t0 = time.time()
+        result = [update(key, stamp, window) for key, stamp in stream]
+        dt = time.time() - t0
+        memory = state.memory_usage()
+        logger.info('%-8s %12.2f events/s  %10.1f bytes/key  (%d keys, %.1f MB)', backend,
+                    max_records / dt, memory / len(state), len(state), memory / 1048576.)
+        if counts is None:
+            counts = result
+        elif result != counts:
+            error = max(abs(a - b) for a, b in zip(result, counts))
+            logger.info('%-8s differs from %s by up to %d events', backend, backends[0], error)
+
+
+if __name__ == '__main__':
+    # If Yaml setting file is not supplied
+    if len(sys.argv) < 2:
+        raise RuntimeError('Did not suppy settings through yaml file')
+    with open(sys.argv[1]) as f:
+        settings = yaml.safe_load(f)
+    logging.basicConfig(level=settings.pop('log_level', 'INFO'))
+
+    test_backends(**settings)